@@ -7,6 +7,7 @@ from os.path import dirname
 from os.path import join as path_join
 import nxc
 from nxc.paths import NXC_PATH
+from nxc.config import fingerprint_ttl
 from nxc.loaders.protocolloader import ProtocolLoader
 from nxc.helpers.logger import highlight
 from nxc.logger import nxc_logger
@@ -40,6 +41,11 @@ def gen_cli_args():
     parser.add_argument("--timeout", default=None, type=int, help="max timeout in seconds of each thread (default: None)")
     parser.add_argument("--jitter", metavar="INTERVAL", type=str, help="sets a random delay between each connection (default: None)")
     parser.add_argument("--no-progress", action="store_true", help="Not displaying progress bar during scan")
+    parser.add_argument("--fast-discovery", action="store_true", help="only run the protocol against targets whose port answers a non-blocking TCP connect sweep")
+    parser.add_argument("--discovery-concurrency", type=int, default=1000, metavar="N", help="max number of in-flight TCP connects during fast discovery and the protocol probes (default: 1000)")
+    parser.add_argument("--discovery-timeout", type=float, default=2, metavar="SECONDS", help="TCP connect timeout in seconds during fast discovery (default: 2)")
+    parser.add_argument("--fingerprint-ttl", type=int, default=fingerprint_ttl, metavar="SECONDS", help=f"reuse the host information cached in the workspace if it is younger than SECONDS, 0 disables the cache (default: {fingerprint_ttl})")
+    parser.add_argument("--refresh-fingerprint", action="store_true", help="ignore the cached host information and fingerprint the hosts again")
     parser.add_argument("--verbose", action="store_true", help="enable verbose output")
     parser.add_argument("--debug", action="store_true", help="enable debug level information")
     parser.add_argument("--version", action="store_true", help="Display nxc version")
@@ -33,6 +33,7 @@ audit_mode = nxc_config.get("nxc", "audit_mode", fallback=False)
 reveal_chars_of_pwd = int(nxc_config.get("nxc", "reveal_chars_of_pwd", fallback=0))
 config_log = nxc_config.getboolean("nxc", "log_mode", fallback=False)
 ignore_opsec = nxc_config.getboolean("nxc", "ignore_opsec", fallback=False)
+fingerprint_ttl = int(nxc_config.get("nxc", "fingerprint_ttl", fallback=86400))
 host_info_colors = literal_eval(nxc_config.get("nxc", "host_info_colors", fallback=["green", "red", "yellow", "cyan"]))
 
 
@@ -1,6 +1,6 @@
 import random
 from os.path import isfile
-from threading import BoundedSemaphore
+from threading import Condition
 from functools import wraps
 from time import sleep
 from ipaddress import ip_address
@@ -15,9 +15,16 @@ from nxc.protocols.ldap.laps import laps_search
 from impacket.dcerpc.v5 import transport
 import sys
 
-sem = BoundedSemaphore(1)
+# Guards the fail counters below. Attempts in flight are counted as pending so the fail limits are never exceeded
+# while logins run in parallel, threads wait on it when only pending attempts could still reach a limit.
+fail_limit_cond = Condition()
 global_failed_logins = 0
+global_pending_logins = 0
 user_failed_logins = {}
+user_pending_logins = {}
+
+# Results of the protocol probes run by start_run() on the event loop, keyed by target, taken by the connection object
+probe_results = {}
 
 
 def gethost_addrinfo(hostname):
@@ -79,7 +86,13 @@ def dcom_FirewallChecker(iInterface, timeout):
 
 
 class connection:
+    # Optional `async def probe(args, db, target)` of the protocol, run on the event loop before the target gets a worker
+    # thread. It returns None when the target does not answer, so it never reaches the protocol class, or a dict of
+    # what it learned about the host (see probe_result)
+    probe = None
+
     def __init__(self, args, db, host):
+        self.probe_result = probe_results.pop(host, None) or {}
         self.domain = None
         self.args = args
         self.db = db
@@ -133,6 +146,52 @@ class connection:
     def enum_host_info(self):
         return
 
+    def fingerprint_attrs(self):
+        """Attributes set by enum_host_info() that can be restored from the workspace fingerprint cache"""
+        return ()
+
+    def load_fingerprint(self):
+        """Restores the fingerprint_attrs() of the host from the probe of the protocol or from the workspace cache.
+
+        Returns False if neither has them.
+        """
+        attrs = self.fingerprint_attrs()
+        if attrs and all(attr in self.probe_result for attr in attrs):
+            self.logger.debug(f"Using the fingerprint of {self.host}:{self.port} taken by the probe")
+            for attr in attrs:
+                setattr(self, attr, self.probe_result[attr])
+            self.save_fingerprint()
+            return True
+        if not attrs or self.args.refresh_fingerprint or self.args.fingerprint_ttl <= 0:
+            return False
+        try:
+            fingerprint = self.db.get_fingerprint(self.host, self.port, self.args.protocol, self.args.fingerprint_ttl)
+        except Exception as e:
+            self.logger.debug(f"Error reading the cached fingerprint of {self.host}: {e}")
+            return False
+        if not fingerprint or any(attr not in fingerprint for attr in attrs):
+            return False
+        self.logger.debug(f"Using the cached fingerprint of {self.host}:{self.port}, use --refresh-fingerprint to update it")
+        for attr in attrs:
+            setattr(self, attr, fingerprint[attr])
+        return True
+
+    def fingerprint_complete(self):
+        """True if every fingerprint_attrs() was read from the host, a failed probe leaves some of them empty"""
+        return all(getattr(self, attr, None) not in (None, "") for attr in self.fingerprint_attrs())
+
+    def save_fingerprint(self):
+        attrs = self.fingerprint_attrs()
+        if not attrs or self.args.fingerprint_ttl <= 0:
+            return
+        if not self.fingerprint_complete():
+            self.logger.debug(f"Not caching the incomplete fingerprint of {self.host}:{self.port}")
+            return
+        try:
+            self.db.add_fingerprint(self.host, self.port, self.args.protocol, {attr: getattr(self, attr) for attr in attrs})
+        except Exception as e:
+            self.logger.debug(f"Error caching the fingerprint of {self.host}: {e}")
+
     def print_host_info(self):
         return
 
@@ -235,29 +294,54 @@ class connection:
 
     def inc_failed_login(self, username):
         global global_failed_logins
-        global user_failed_logins
 
-        if username not in user_failed_logins:
-            user_failed_logins[username] = 0
-
-        user_failed_logins[username] += 1
-        global_failed_logins += 1
+        with fail_limit_cond:
+            user_failed_logins[username] = user_failed_logins.get(username, 0) + 1
+            global_failed_logins += 1
         self.failed_logins += 1
 
     def over_fail_limit(self, username):
-        global global_failed_logins
-        global user_failed_logins
-
-        if global_failed_logins == self.args.gfail_limit:
+        if self.args.gfail_limit is not None and global_failed_logins >= self.args.gfail_limit:
             return True
 
-        if self.failed_logins == self.args.fail_limit:
+        if self.args.fail_limit is not None and self.failed_logins >= self.args.fail_limit:
             return True
 
-        if username in user_failed_logins and self.args.ufail_limit == user_failed_logins[username]:
-            return True
+        return self.args.ufail_limit is not None and user_failed_logins.get(username, 0) >= self.args.ufail_limit
+
+    def reserve_login(self, username):
+        """Registers a login attempt as pending, returns False if it could exceed a fail limit.
 
-        return False
+        If the limit can only be reached by attempts still in flight, waits for them to finish first.
+        The per-host limit needs no reservation since the logins of a host are done by a single thread.
+        """
+        global global_pending_logins
+
+        if self.args.gfail_limit is None and self.args.ufail_limit is None:
+            return not self.over_fail_limit(username)
+
+        with fail_limit_cond:
+            while True:
+                if self.over_fail_limit(username):
+                    return False
+                gfail_free = self.args.gfail_limit is None or global_failed_logins + global_pending_logins < self.args.gfail_limit
+                ufail_free = self.args.ufail_limit is None or user_failed_logins.get(username, 0) + user_pending_logins.get(username, 0) < self.args.ufail_limit
+                if gfail_free and ufail_free:
+                    global_pending_logins += 1
+                    user_pending_logins[username] = user_pending_logins.get(username, 0) + 1
+                    return True
+                fail_limit_cond.wait()
+
+    def release_login(self, username):
+        global global_pending_logins
+
+        if self.args.gfail_limit is None and self.args.ufail_limit is None:
+            return
+
+        with fail_limit_cond:
+            global_pending_logins -= 1
+            user_pending_logins[username] -= 1
+            fail_limit_cond.notify_all()
 
     def query_db_creds(self):
         """Queries the database for credentials to be used for authentication.
@@ -392,13 +476,11 @@ class connection:
             - NTLM-hash (/kerberos)
             - AES-key
         """
-        if self.over_fail_limit(username):
-            return False
         if self.args.continue_on_success and owned:
             return False
-        if hasattr(self.args, "delegate") and self.args.delegate:
-            self.args.kerberos = True
-        with sem:
+        if not self.reserve_login(username):
+            return False
+        try:
             if cred_type == "plaintext":
                 if self.args.kerberos:
                     self.logger.debug("Trying to authenticate using Kerberos")
@@ -418,6 +500,8 @@ class connection:
                 return self.hash_login(domain, username, secret)
             elif cred_type == "aesKey":
                 return self.kerberos_login(domain, username, "", "", secret, self.kdcHost, False)
+        finally:
+            self.release_login(username)
 
     def login(self):
         """Try to login using the credentials specified in the command line or in the database.
@@ -453,12 +537,11 @@ class connection:
 
         if self.args.use_kcache:
             self.logger.debug("Trying to authenticate using Kerberos cache")
-            with sem:
-                username = self.args.username[0] if len(self.args.username) else ""
-                password = self.args.password[0] if len(self.args.password) else ""
-                self.kerberos_login(self.domain, username, password, "", "", self.kdcHost, True)
-                self.logger.info("Successfully authenticated using Kerberos cache")
-                return True
+            username = self.args.username[0] if len(self.args.username) else ""
+            password = self.args.password[0] if len(self.args.password) else ""
+            self.kerberos_login(self.domain, username, password, "", "", self.kdcHost, True)
+            self.logger.info("Successfully authenticated using Kerberos cache")
+            return True
 
         if hasattr(self.args, "laps") and self.args.laps:
             self.logger.debug("Trying to authenticate using LAPS")
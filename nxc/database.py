@@ -0,0 +1,319 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+from queue import Queue, Empty
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import Insert
+from sqlalchemy.engine import FrozenResult
+from sqlalchemy.exc import IntegrityError
+
+from nxc.logger import nxc_logger
+
+
+class BatchedWriter:
+    """Single writer thread that runs every database write of a protocol database and commits them in batches.
+
+    The engine runs in AUTOCOMMIT mode and is shared by all the worker threads, so every add_*() call used to take the
+    SQLite write lock and fsync on its own. Writes are now queued, executed in order on one dedicated connection and
+    committed every `batch_size` operations or every `flush_interval` seconds, whichever comes first.
+    Since a single thread executes them, the SELECT-then-upsert logic of the database classes sees all previous writes.
+    Every write runs in its own savepoint, so a write that fails leaves nothing behind in the batch. The result of a
+    write is only handed out once its batch is committed, if the commit fails every write of the batch fails with it.
+    Every write gets a sequence number, so a thread can tell whether its own writes are committed yet.
+    """
+
+    _STOP = object()
+    # kinds of queued items: a batched write, a write the caller waits for (committed at once) and a read
+    WRITE, CALL, READ = range(3)
+
+    def __init__(self, db_engine, batch_size=1000, flush_interval=0.5):
+        self.db_engine = db_engine.execution_options(isolation_level="SERIALIZABLE")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue()
+        self.conn = None
+        self.in_batch = False
+        # called on the writer thread after a write or a batch was rolled back, to drop state derived from its writes
+        self.on_rollback = None
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        # sequence number of the last queued write, of the last committed one and of the last one queued by each thread
+        self.submitted = 0
+        self.committed = 0
+        self.local = threading.local()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="nxc-db-writer", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        # make sure the last batch gets committed even if shutdown_db() is never called
+        atexit.register(self.shutdown)
+
+    def in_writer_thread(self):
+        return threading.current_thread() is self.thread
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def enqueue(self, kind, func, args, kwargs):
+        future = Future()
+        if kind == self.READ:
+            self.queue.put((kind, 0, future, func, args, kwargs))
+            return future
+        with self.pending_lock:
+            self.pending += 1
+            self.submitted += 1
+            self.local.last_write = self.submitted
+            self.queue.put((kind, self.submitted, future, func, args, kwargs))
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write, func is executed on the writer thread and the returned Future holds its result once committed"""
+        return self.enqueue(self.WRITE, func, args, kwargs)
+
+    def call(self, func, *args, **kwargs):
+        """Runs a write on the writer thread, commits it with the pending batch and returns its result"""
+        return self.enqueue(self.CALL, func, args, kwargs).result()
+
+    def read(self, func, *args, **kwargs):
+        """Runs func on the writer thread after the writes queued before it, without committing them"""
+        return self.enqueue(self.READ, func, args, kwargs).result()
+
+    def has_pending_writes(self):
+        """True if a write queued by the calling thread is not committed yet"""
+        return getattr(self.local, "last_write", 0) > self.committed
+
+    def flush(self):
+        """Barrier: blocks until every write queued before the call has been committed"""
+        if self.in_writer_thread() or not self.is_alive():
+            return
+        with self.pending_lock:
+            if not self.pending:
+                return
+        barrier = threading.Event()
+        self.queue.put(barrier)
+        barrier.wait()
+
+    def shutdown(self):
+        if self.is_alive():
+            self.queue.put(self._STOP)
+            self.thread.join()
+
+    def execute(self, func, args, kwargs):
+        """Runs a write in a savepoint of the batch, a write that raises is rolled back on its own"""
+        if not self.in_batch:
+            # pysqlite does not open a transaction for a SAVEPOINT, whose RELEASE would then commit on its own
+            self.conn.exec_driver_sql("BEGIN")
+            self.in_batch = True
+        savepoint = self.conn.begin_nested()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            savepoint.rollback()
+            self.rolled_back()
+            raise
+        savepoint.commit()
+        return result
+
+    def rolled_back(self):
+        if self.on_rollback:
+            try:
+                self.on_rollback()
+            except Exception as e:
+                nxc_logger.debug(f"Error resetting the state of the rolled back writes: {e}")
+
+    def commit(self, done, batch, last_write):
+        if not batch:
+            return
+        error = None
+        try:
+            self.conn.commit()
+        except Exception as e:
+            error = e
+            nxc_logger.error(f"Error committing {batch} database write(s), they are lost: {e}")
+            self.conn.rollback()
+            self.rolled_back()
+        self.in_batch = False
+        with self.pending_lock:
+            self.pending -= batch
+            self.committed = last_write
+        for future, result in done:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run(self):
+        with self.db_engine.connect() as conn:
+            self.conn = conn
+            self.started.set()
+            # (future, result) of the successful writes of the batch
+            done = []
+            batch = 0
+            batch_start = 0
+            last_write = 0
+            while True:
+                timeout = max(0, self.flush_interval - (time.monotonic() - batch_start)) if batch else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Empty:
+                    self.commit(done, batch, last_write)
+                    done, batch = [], 0
+                    continue
+
+                if item is self._STOP:
+                    self.commit(done, batch, last_write)
+                    break
+                if isinstance(item, threading.Event):
+                    self.commit(done, batch, last_write)
+                    done, batch = [], 0
+                    item.set()
+                    continue
+
+                kind, seq, future, func, args, kwargs = item
+                if kind == self.READ:
+                    try:
+                        future.set_result(func(*args, **kwargs))
+                    except Exception as e:
+                        future.set_exception(e)
+                    continue
+
+                if not batch:
+                    batch_start = time.monotonic()
+                try:
+                    done.append((future, self.execute(func, args, kwargs)))
+                except Exception as e:
+                    future.set_exception(e)
+                batch += 1
+                last_write = seq
+                if kind == self.CALL or batch >= self.batch_size:
+                    self.commit(done, batch, last_write)
+                    done, batch = [], 0
+        self.conn = None
+
+
+class SessionProxy:
+    """Wraps the database session so the writer thread uses its batched connection and other threads read committed data.
+
+    Statements issued from the writer thread go to the writer connection, so reads inside a queued write see the
+    uncommitted batch. A thread whose own writes are not committed yet runs its statements on the writer thread too,
+    queued after its writes (read-after-write) without committing the batch. Other threads read the committed data.
+    """
+
+    def __init__(self, session, writer):
+        self.session = session
+        self.writer = writer
+
+    def execute(self, *args, **kwargs):
+        if self.writer.in_writer_thread():
+            return self.writer.conn.execute(*args, **kwargs)
+        if self.writer.is_alive() and self.writer.has_pending_writes():
+            result = self.writer.read(self.execute_buffered, *args, **kwargs)
+            # A FrozenResult is called to get a new Result over its buffered rows
+            return result() if isinstance(result, FrozenResult) else result
+        return self.session.execute(*args, **kwargs)
+
+    def execute_buffered(self, *args, **kwargs):
+        """Runs on the writer thread, the rows are fetched there before the result is handed to the calling thread"""
+        result = self.writer.conn.execute(*args, **kwargs)
+        return result.freeze() if result.returns_rows else result
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def queued_write(func):
+    """Runs a database method on the writer thread of its BatchedWriter and returns its result once it is committed"""
+
+    @wraps(func)
+    def _decorator(self, *args, **kwargs):
+        writer = getattr(self, "writer", None)
+        if writer is None or writer.in_writer_thread() or not writer.is_alive():
+            return func(self, *args, **kwargs)
+        return writer.call(func, self, *args, **kwargs)
+
+    return _decorator
+
+
+def log_write_error(future):
+    if future.exception() is not None:
+        nxc_logger.error(f"Error in background database write: {future.exception()}")
+
+
+def background_write(func):
+    """Like queued_write for the writes whose result nobody waits for: the caller does not block, it gets None back
+    and errors, including a failed commit of the batch, are logged. Reads of the same thread are still queued after
+    the write (see SessionProxy).
+    """
+
+    @wraps(func)
+    def _decorator(self, *args, **kwargs):
+        writer = getattr(self, "writer", None)
+        if writer is None or writer.in_writer_thread() or not writer.is_alive():
+            return func(self, *args, **kwargs)
+        writer.submit(func, self, *args, **kwargs).add_done_callback(log_write_error)
+
+    return _decorator
+
+
+def create_indexes(execute, indexes):
+    """Creates the given (name, table, columns, unique) indexes if they do not exist yet.
+
+    Works with both a sqlite3 cursor (new workspaces) and SQLAlchemy's exec_driver_sql (schema migration).
+    If existing rows violate a UNIQUE index, a regular index is created instead so lookups are still fast.
+    """
+    for name, table, columns, unique in indexes:
+        try:
+            execute(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{name}" ON "{table}" ({columns})')
+        except (sqlite3.IntegrityError, IntegrityError) as e:
+            nxc_logger.debug(f"Duplicate rows in {table}, creating a non unique index {name}: {e}")
+            execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({columns})')
+
+
+fingerprints_schema = """CREATE TABLE IF NOT EXISTS "fingerprints" (
+    "ip" text,
+    "port" integer,
+    "protocol" text,
+    "data" text,
+    "updated" real,
+    PRIMARY KEY ("ip", "port", "protocol")
+    )"""
+
+
+class FingerprintCache:
+    """Mixin for the protocol databases caching the host information gathered by enum_host_info(), keyed by (ip, port, protocol).
+
+    The fingerprint is stored as JSON with the time it was taken, so repeated runs against known hosts can skip the discovery round-trips.
+    """
+
+    FingerprintsTable = None
+
+    def migrate_fingerprints(self):
+        """Adds the fingerprints table to workspaces that were created before it was part of the schema"""
+        with self.db_engine.connect() as conn:
+            try:
+                conn.exec_driver_sql(fingerprints_schema)
+            except Exception as e:
+                nxc_logger.debug(f"Error creating the fingerprints table for the {self.protocol} database: {e}")
+
+    def get_fingerprint(self, ip, port, protocol, ttl):
+        """Returns the fingerprint dict of the host if it was taken less than ttl seconds ago, None otherwise"""
+        q = select(self.FingerprintsTable.c.data).filter(
+            self.FingerprintsTable.c.ip == ip,
+            self.FingerprintsTable.c.port == port,
+            self.FingerprintsTable.c.protocol == protocol,
+            self.FingerprintsTable.c.updated >= time.time() - ttl,
+        )
+        row = self.conn.execute(q).first()
+        return json.loads(row[0]) if row else None
+
+    @background_write
+    def add_fingerprint(self, ip, port, protocol, fingerprint):
+        q = Insert(self.FingerprintsTable).values(ip=ip, port=port, protocol=protocol, data=json.dumps(fingerprint), updated=time.time())
+        q = q.on_conflict_do_update(index_elements=["ip", "port", "protocol"], set_={"data": q.excluded.data, "updated": q.excluded.updated})
+        self.conn.execute(q)
+        nxc_logger.debug(f"Stored fingerprint of {ip}:{port} ({protocol})")
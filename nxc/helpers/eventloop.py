@@ -0,0 +1,42 @@
+import asyncio
+from threading import Lock, Thread
+
+loop = None
+loop_lock = Lock()
+# host -> [asyncio.Semaphore, number of coroutines holding or waiting on it], only used from the loop thread
+host_semaphores = {}
+
+
+def get_loop():
+    """Returns the event loop shared by the whole process, it runs on its own daemon thread started on first use"""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name="nxc-event-loop", daemon=True).start()
+        return loop
+
+
+async def run_limited(coro, host, limit):
+    """Runs the coroutine under the semaphore of the host, which is dropped once nothing holds or waits on it"""
+    users = host_semaphores.setdefault(host, [asyncio.Semaphore(limit), 0])
+    users[1] += 1
+    try:
+        async with users[0]:
+            return await coro
+    finally:
+        users[1] -= 1
+        if not users[1]:
+            del host_semaphores[host]
+
+
+def run(coro, host=None, limit=1):
+    """Runs the coroutine on the shared event loop and blocks the calling thread until it is done, in place of asyncio.run().
+
+    Creating and tearing down a loop per connection attempt is avoided and all the protocol threads share one loop.
+    With a host, at most `limit` coroutines of that host run at the same time, the others wait for their turn.
+    Unlike asyncio.run(), tasks left behind by the coroutine are not cancelled, connections must be closed by the caller.
+    """
+    if host is not None:
+        coro = run_limited(coro, host, limit)
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
@@ -7,6 +7,7 @@ from enum import Enum
 from impacket.ldap import ldaptypes
 from impacket.uuid import bin_to_string
 from nxc.helpers.msada_guids import SCHEMA_OBJECTS, EXTENDED_RIGHTS
+from nxc.protocols.ldap.sidcache import get_sid_cache
 from ldap3.protocol.formatters.formatters import format_sid
 from ldap3.utils.conv import escape_filter_chars
 from ldap3.protocol.microsoft import security_descriptor_control
@@ -16,6 +17,14 @@ OBJECT_TYPES_GUID = {}
 OBJECT_TYPES_GUID.update(SCHEMA_OBJECTS)
 OBJECT_TYPES_GUID.update(EXTENDED_RIGHTS)
 
+# ACE types parsed by parse_ace(), the others are only displayed
+PARSED_ACE_TYPES = [
+    "ACCESS_ALLOWED_ACE",
+    "ACCESS_ALLOWED_OBJECT_ACE",
+    "ACCESS_DENIED_ACE",
+    "ACCESS_DENIED_OBJECT_ACE",
+]
+
 # Universal SIDs
 WELL_KNOWN_SIDS = {
     "S-1-0": "Null Authority",
@@ -277,6 +286,7 @@ class NXCModule:
         context.log.highlight("Be careful, this module cannot read the DACLS recursively.")
         self.baseDN = connection.ldapConnection._baseDN
         self.ldap_session = connection.ldapConnection
+        self.sid_cache = get_sid_cache(connection.domain)
 
         # Searching for the principal SID
         if self.principal_sAMAccountName is not None:
@@ -316,6 +326,11 @@ class NXCModule:
 
         # If there are multiple targets
         else:
+            # The trustees of all the DACLs are resolved from a single query of all the security principals
+            try:
+                self.sid_cache.prefill(self.ldap_session)
+            except Exception as e:
+                context.log.debug(f"Could not prefetch the security principals: {e}")
             targets = self.target_file.readlines()
             for target in targets:
                 try:
@@ -339,6 +354,12 @@ class NXCModule:
     # Main read funtion
     # Prints the parsed DACL
     def read(self, context):
+        # Resolves all the trustees of the DACL with batched queries before parsing the ACEs
+        sids = {ace["Ace"]["Sid"].formatCanonical() for ace in self.principal_security_descriptor["Dacl"]["Data"] if ace["TypeName"] in PARSED_ACE_TYPES}
+        try:
+            self.sid_cache.resolve(self.ldap_session, sids - WELL_KNOWN_SIDS.keys())
+        except Exception as e:
+            context.log.debug(f"Could not resolve the trustees of the DACL: {e}")
         parsed_dacl = self.parse_dacl(context, self.principal_security_descriptor["Dacl"])
         self.print_parsed_dacl(context, parsed_dacl)
 
@@ -408,22 +429,16 @@ class NXCModule:
         # Tries to resolve the SID from the well known SIDs
         if sid in WELL_KNOWN_SIDS:
             return WELL_KNOWN_SIDS[sid]
-        # Tries to resolve the SID from the LDAP domain dump
-        else:
-            try:
-                self.ldap_session.search(
-                    searchBase=self.baseDN,
-                    searchFilter=f"(objectSid={sid})",
-                    attributes=["sAMAccountName"],
-                )[0][0]
-                return self.ldap_session.search(
-                    searchBase=self.baseDN,
-                    searchFilter=f"(objectSid={sid})",
-                    attributes=["sAMAccountName"],
-                )[0][1][0][1][0]
-            except Exception:
-                context.log.debug(f"SID not found in LDAP: {sid}")
-                return ""
+        # Tries to resolve the SID from the domain SID cache
+        try:
+            principal = self.sid_cache.lookup(self.ldap_session, sid)
+        except Exception as e:
+            context.log.debug(f"Error resolving SID {sid}: {e}")
+            principal = None
+        if principal is None:
+            context.log.debug(f"SID not found in LDAP: {sid}")
+            return ""
+        return principal["name"]
 
     # Parses a full DACL
     #   - dacl : the DACL to parse, submitted in a Security Desciptor format
@@ -450,12 +465,7 @@ class NXCModule:
     #   - ace : the ACE to parse
     def parse_ace(self, context, ace):
         # For the moment, only the Allowed and Denied Access ACE are supported
-        if ace["TypeName"] in [
-            "ACCESS_ALLOWED_ACE",
-            "ACCESS_ALLOWED_OBJECT_ACE",
-            "ACCESS_DENIED_ACE",
-            "ACCESS_DENIED_OBJECT_ACE",
-        ]:
+        if ace["TypeName"] in PARSED_ACE_TYPES:
             _ace_flags = [FLAG.name for FLAG in ACE_FLAGS if ace.hasFlag(FLAG.value)]
             parsed_ace = {"ACE Type": ace["TypeName"], "ACE flags": ", ".join(_ace_flags) or "None"}
 
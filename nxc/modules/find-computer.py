@@ -1,7 +1,4 @@
 import socket
-from nxc.logger import nxc_logger
-from impacket.ldap.ldap import LDAPSearchError
-from impacket.ldap.ldapasn1 import SearchResultEntry
 import sys
 
 
@@ -37,35 +34,13 @@ class NXCModule:
     def on_login(self, context, connection):
         search_filter = f"(&(objectCategory=computer)(&(|(operatingSystem=*{self.TEXT}*))(name=*{self.TEXT}*)))"
 
-        try:
-            context.log.debug(f"Search Filter={search_filter}")
-            resp = connection.ldapConnection.search(searchFilter=search_filter, attributes=["dNSHostName", "operatingSystem"], sizeLimit=0)
-        except LDAPSearchError as e:
-            if e.getErrorString().find("sizeLimitExceeded") >= 0:
-                context.log.debug("sizeLimitExceeded exception caught, giving up and processing the data received")
-                resp = e.getAnswers()
-            else:
-                nxc_logger.debug(e)
-                return False
-
         answers = []
-        context.log.debug(f"Total no. of records returned: {len(resp)}")
-        for item in resp:
-            if isinstance(item, SearchResultEntry) is not True:
-                continue
-            dns_host_name = ""
-            operating_system = ""
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == "dNSHostName":
-                        dns_host_name = str(attribute["vals"][0])
-                    elif str(attribute["type"]) == "operatingSystem":
-                        operating_system = attribute["vals"][0]
-                if dns_host_name != "" and operating_system != "":
-                    answers.append([dns_host_name, operating_system])
-            except Exception as e:
-                context.log.debug("Exception:", exc_info=True)
-                context.log.debug(f"Skipping item, cannot process due to error {e}")
+        for entry in connection.search_paged(search_filter, ["dNSHostName", "operatingSystem"]):
+            dns_host_name = entry.get("dnshostname", [""])[0]
+            operating_system = entry.get("operatingsystem", [""])[0]
+            if dns_host_name != "" and operating_system != "":
+                answers.append([dns_host_name, operating_system])
+        context.log.debug(f"Total no. of records returned: {len(answers)}")
         if len(answers) > 0:
             context.log.success("Found the following computers: ")
             for answer in answers:
@@ -1,7 +1,4 @@
-from impacket.ldap import ldapasn1 as ldapasn1_impacket
-from impacket.ldap import ldap as ldap_impacket
 import re
-from nxc.logger import nxc_logger
 
 
 class NXCModule:
@@ -38,41 +35,11 @@ class NXCModule:
         # Building the search filter
         searchFilter = "(objectclass=user)"
 
-        try:
-            context.log.debug(f"Search Filter={searchFilter}")
-            resp = connection.ldapConnection.search(
-                searchFilter=searchFilter,
-                attributes=["sAMAccountName", "description"],
-                sizeLimit=0,
-            )
-        except ldap_impacket.LDAPSearchError as e:
-            if e.getErrorString().find("sizeLimitExceeded") >= 0:
-                context.log.debug("sizeLimitExceeded exception caught, giving up and processing the data received")
-                # We reached the sizeLimit, process the answers we have already and that's it. Until we implement
-                # paged queries
-                resp = e.getAnswers()
-            else:
-                nxc_logger.debug(e)
-                return False
-
         answers = []
-        context.log.debug(f"Total of records returned {len(resp)}")
-        for item in resp:
-            if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                continue
-            sAMAccountName = ""
-            description = ""
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == "sAMAccountName":
-                        sAMAccountName = str(attribute["vals"][0])
-                    elif str(attribute["type"]) == "description":
-                        description = attribute["vals"][0]
-                if sAMAccountName != "" and description != "":
-                    answers.append([sAMAccountName, description])
-            except Exception as e:
-                context.log.debug("Exception:", exc_info=True)
-                context.log.debug(f"Skipping item, cannot process due to error {e!s}")
+        for entry in connection.search_paged(searchFilter, ["sAMAccountName", "description"]):
+            if "samaccountname" in entry and entry.get("description", [""])[0]:
+                answers.append([entry["samaccountname"][0], entry["description"][0]])
+        context.log.debug(f"Total of records returned {len(answers)}")
         answers = self.filter_answer(context, answers)
         if len(answers) > 0:
             context.log.success("Found following users: ")
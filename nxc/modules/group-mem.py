@@ -1,6 +1,7 @@
-from impacket.ldap import ldapasn1 as ldapasn1_impacket
 import sys
 
+from nxc.protocols.ldap.sidcache import get_sid_cache, principal_attributes
+
 
 class NXCModule:
     """
@@ -16,7 +17,6 @@ class NXCModule:
     opsec_safe = True
     multiple_hosts = False
     primaryGroupID = ""
-    answers = []
 
     def options(self, context, module_options):
         """
@@ -34,58 +34,25 @@ class NXCModule:
             sys.exit(1)
 
     def on_login(self, context, connection):
-        # First look up the SID of the group passed in
-        search_filter = "(&(objectCategory=group)(cn=" + self.GROUP + "))"
-        attribute = "objectSid"
+        sid_cache = get_sid_cache(connection.domain)
 
-        search_result = do_search(self, context, connection, search_filter, attribute)
+        # First look up the SID and DN of the group passed in
+        search_filter = "(&(objectCategory=group)(cn=" + self.GROUP + "))"
+        group = next((sid_cache.add_entry(entry) for entry in connection.search_paged(search_filter, principal_attributes) if "objectsid" in entry), None)
         # If no SID for the Group is returned exit the program
-        if search_result is None:
+        if group is None:
             context.log.success('Unable to find any members of the "' + self.GROUP + '" group')
             return True
 
-        # Convert the binary SID to a primaryGroupID string to be used further
-        sid_string = connection.sid_to_str(search_result).split("-")
-        self.primaryGroupID = sid_string[-1]
+        # The RID of the group is the primaryGroupID of its primary members
+        self.primaryGroupID = group["sid"].split("-")[-1]
 
-        # Look up the groups DN
-        search_filter = "(&(objectCategory=group)(cn=" + self.GROUP + "))"
-        attribute = "distinguishedName"
-        distinguished_name = (do_search(self, context, connection, search_filter, attribute)).decode("utf-8")
+        # Carry out the search, the members are added to the SID cache for the other modules
+        search_filter = "(|(memberOf=" + group["dn"] + ")(primaryGroupID=" + self.primaryGroupID + "))"
+        members = [sid_cache.add_entry(entry) for entry in connection.search_paged(search_filter, principal_attributes) if "objectsid" in entry]
+        context.log.debug(f"Total number of records returned {len(members)}")
 
-        # Carry out the search
-        search_filter = "(|(memberOf=" + distinguished_name + ")(primaryGroupID=" + self.primaryGroupID + "))"
-        attribute = "sAMAccountName"
-        search_result = do_search(self, context, connection, search_filter, attribute)
-
-        if len(self.answers) > 0:
+        if len(members) > 0:
             context.log.success("Found the following members of the " + self.GROUP + " group:")
-            for answer in self.answers:
-                context.log.highlight(f"{answer[0]}")
-
-
-# Carry out an LDAP search for the Group with the supplied Group name
-def do_search(self, context, connection, searchFilter, attributeName):
-    try:
-        context.log.debug(f"Search Filter={searchFilter}")
-        resp = connection.ldapConnection.search(searchFilter=searchFilter, attributes=[attributeName], sizeLimit=0)
-        context.log.debug(f"Total number of records returned {len(resp)}")
-        for item in resp:
-            if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                continue
-            attribute_value = ""
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == attributeName:
-                        if attributeName in ["objectSid", "distinguishedName"]:
-                            return bytes(attribute["vals"][0])
-                        else:
-                            attribute_value = str(attribute["vals"][0])
-                    if attribute_value is not None:
-                        self.answers.append([attribute_value])
-            except Exception as e:
-                context.log.debug("Exception:", exc_info=True)
-                context.log.debug(f"Skipping item, cannot process due to error {e}")
-    except Exception as e:
-        context.log.debug(f"Exception: {e}")
-        return False
+            for member in members:
+                context.log.highlight(f"{member['name']}")
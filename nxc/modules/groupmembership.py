@@ -1,7 +1,7 @@
-from impacket.ldap import ldapasn1 as ldapasn1_impacket
-from impacket.ldap import ldap as ldap_impacket
 import sys
 
+from nxc.protocols.ldap.sidcache import get_sid_cache, sid_to_str
+
 
 class NXCModule:
     """
@@ -34,45 +34,23 @@ class NXCModule:
         """Concurrent. Required if on_admin_login is not present. This gets called on each authenticated connection"""
         # Building the search filter
         searchFilter = f"(&(objectClass=user)(sAMAccountName={self.user}))"
-
-        try:
-            context.log.debug(f"Search Filter={searchFilter}")
-            resp = connection.ldapConnection.search(
-                searchFilter=searchFilter,
-                attributes=["memberOf", "primaryGroupID"],
-                sizeLimit=0,
-            )
-        except ldap_impacket.LDAPSearchError as e:
-            if e.getErrorString().find("sizeLimitExceeded") >= 0:
-                context.log.debug("sizeLimitExceeded exception caught, giving up and processing the data received")
-                # We reached the sizeLimit, process the answers we have already and that's it. Until we implement
-                # paged queries
-                resp = e.getAnswers()
-            else:
-                context.log.debug(e)
-                return False
+        context.log.debug(f"Search Filter={searchFilter}")
 
         memberOf = []
-        primaryGroupID = ""
+        for entry in connection.search_paged(searchFilter, ["memberOf", "primaryGroupID", "objectSid"]):
+            memberOf += entry.get("memberof", [])
+            if "primarygroupid" in entry and "objectsid" in entry:
+                # The primary group is not listed in memberOf, its SID is the domain SID followed by the primaryGroupID
+                domain_sid = sid_to_str(entry["objectsid"][0]).rsplit("-", 1)[0]
+                try:
+                    primary_group = get_sid_cache(connection.domain).lookup(connection.ldapConnection, f"{domain_sid}-{entry['primarygroupid'][0]}")
+                except Exception as e:
+                    context.log.debug(f"Could not resolve the primary group: {e}")
+                    primary_group = None
+                if primary_group:
+                    memberOf.append(primary_group["dn"])
+        context.log.debug(f"Total of groups returned {len(memberOf)}")
 
-        context.log.debug(f"Total of records returned {len(resp)}")
-        for item in resp:
-            if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                continue
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == "primaryGroupID":
-                        primaryGroupID = attribute["vals"][0]
-                        # Hardcode value for Domain Users primary Group ID 513
-                        # For future improvement maybe we can query the primary ID value
-                        # Reference: https://social.technet.microsoft.com/Forums/Azure/en-US/373febac-665c-494d-91f7-834541c74bee/cant-get-all-member-objects-from-domain-users-in-ldap?forum=winserverDS
-                        if str(primaryGroupID) == "513":
-                            memberOf.append("CN=Domain Users,CN=Users,DC=XXXXX,DC=XXX")
-                    elif str(attribute["type"]) == "memberOf":
-                        memberOf += [str(group) for group in attribute["vals"] if isinstance(group._value, bytes)]
-            except Exception as e:
-                context.log.debug("Exception:", exc_info=True)
-                context.log.debug(f"Skipping item, cannot process due to error {e!s}")
         if len(memberOf) > 0:
             context.log.success(f"User: {self.user} is member of following groups: ")
             for group in memberOf:
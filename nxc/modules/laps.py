@@ -1,7 +1,6 @@
-import json
+from impacket.ldap.ldap import LDAPSearchError
 
-from impacket.ldap import ldapasn1 as ldapasn1_impacket
-from nxc.protocols.ldap.laps import LAPSv2Extract
+from nxc.protocols.ldap.laps import LAPSTable
 
 
 class NXCModule:
@@ -28,36 +27,22 @@ class NXCModule:
 
     def on_login(self, context, connection):
         context.log.display("Getting LAPS Passwords")
-        searchFilter = "(&(objectCategory=computer)(|(msLAPS-EncryptedPassword=*)(ms-MCS-AdmPwd=*)(msLAPS-Password=*))(name=" + self.computer + "))" if self.computer is not None else "(&(objectCategory=computer)(|(msLAPS-EncryptedPassword=*)(ms-MCS-AdmPwd=*)(msLAPS-Password=*)))"
-        attributes = [
-            "msLAPS-EncryptedPassword",
-            "msLAPS-Password",
-            "ms-MCS-AdmPwd",
-            "sAMAccountName",
-        ]
-        results = connection.search(searchFilter, attributes, 0)
-        results = [r for r in results if isinstance(r, ldapasn1_impacket.SearchResultEntry)]
-        if len(results) != 0:
+        table = LAPSTable(connection.username, connection.password, connection.domain, connection.nthash, connection.kerberos, connection.kdcHost)
+        try:
+            table.load(connection.ldapConnection, self.computer if self.computer is not None else "*")
+        except LDAPSearchError as e:
+            context.log.fail(f"Error searching the LAPS passwords: {e}")
+            return
+        if len(table.entries) != 0:
             laps_computers = []
-            for computer in results:
-                msMCSAdmPwd = ""
-                sAMAccountName = ""
-                values = {str(attr["type"]).lower(): attr["vals"][0] for attr in computer["attributes"]}
-                if "mslaps-encryptedpassword" in values:
-                    msMCSAdmPwd = values["mslaps-encryptedpassword"]
-                    d = LAPSv2Extract(bytes(msMCSAdmPwd), connection.username if connection.username else "", connection.password if connection.password else "", connection.domain, connection.nthash if connection.nthash else "", connection.kerberos, connection.kdcHost, 339)
-                    try:
-                        data = d.run()
-                    except Exception as e:
-                        self.logger.fail(str(e))
-                        return
-                    r = json.loads(data)
-                    laps_computers.append((str(values["samaccountname"]), r["n"], str(r["p"])))
-                elif "mslaps-password" in values:
-                    r = json.loads(str(values["mslaps-password"]))
-                    laps_computers.append((str(values["samaccountname"]), r["n"], str(r["p"])))
-                elif "ms-mcs-admpwd" in values:
-                    laps_computers.append((str(values["samaccountname"]), "", str(values["ms-mcs-admpwd"])))
+            for computer in table.entries:
+                try:
+                    laps = table.decode(computer)
+                except Exception as e:
+                    context.log.fail(str(e))
+                    return
+                if laps:
+                    laps_computers.append((computer["samaccountname"][0], laps[0], str(laps[1])))
                 else:
                     context.log.fail("No result found with attribute ms-MCS-AdmPwd or msLAPS-Password")
 
@@ -3,9 +3,12 @@ import errno
 import os
 import time
 import traceback
+import contextlib
+from queue import Queue
+from threading import Lock, Thread, local
 from nxc.protocols.smb.remotefile import RemoteFile
 from impacket.smb3structs import FILE_READ_DATA
-from impacket.smbconnection import SessionError
+from impacket.smbconnection import SMBConnection, SessionError
 
 
 CHUNK_SIZE = 4096
@@ -49,6 +52,70 @@ def get_list_from_option(opt):
     return [o.lower() for o in filter(bool, opt.split(","))]
 
 
+class CrawlState:
+    """Manifest and crawl frontier of a host, persisted next to the share-file metadata for incremental/resumed crawls.
+
+    `folders` maps share -> folder -> {"files": {name: [size, mtime, ctime, atime]}, "dirs": {name: mtime}} as seen at the last listing.
+    `frontier` maps share -> folders that were discovered but not listed yet, a non-empty frontier means the crawl was interrupted.
+    """
+
+    SAVE_INTERVAL = 5
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.folders = {}
+        self.frontier = {}
+        self.last_save = time.monotonic()
+        self.save_lock = Lock()
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                state = json.load(fd)
+            self.folders = state.get("folders", {})
+            self.frontier = {share: set(folders) for share, folders in state.get("frontier", {}).items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.fail(f'Failed to load crawl state "{self.path}", starting a full crawl: {e!s}')
+
+    def save(self, lock, force=False):
+        """Writes the state atomically, at most every SAVE_INTERVAL seconds unless forced.
+
+        `lock` guards `folders` and `frontier` against the crawler workers, the state is copied under it and written without it.
+        A periodic save is skipped while another thread is writing the state, a forced save waits for it.
+        """
+        if not self.save_lock.acquire(blocking=force):
+            return
+        try:
+            if not force and time.monotonic() - self.last_save < self.SAVE_INTERVAL:
+                return
+            self.last_save = time.monotonic()
+            with lock:
+                # Folder records are replaced and never modified once stored, copying the share mappings is enough
+                state = {
+                    "folders": {share: dict(folders) for share, folders in self.folders.items()},
+                    "frontier": {share: sorted(folders) for share, folders in self.frontier.items() if folders},
+                }
+            with open(f"{self.path}.tmp", "w", encoding="utf-8") as fd:
+                json.dump(state, fd)
+            os.replace(f"{self.path}.tmp", self.path)
+        except Exception as e:
+            self.logger.fail(f'Failed to save crawl state "{self.path}": {e!s}')
+        finally:
+            self.save_lock.release()
+
+    def stored_folders(self, share_name, folder, skip=()):
+        """Yields (path, record) of the folder and every folder recorded below it, without going into the `skip` folders"""
+        pending = [folder]
+        while pending:
+            current = pending.pop()
+            record = self.folders.get(share_name, {}).get(current)
+            if current in skip or record is None:
+                continue
+            yield current, record
+            pending.extend(f"{current}{name}/" for name in record["dirs"])
+
+
 class SMBSpiderPlus:
     def __init__(
         self,
@@ -60,9 +127,12 @@ class SMBSpiderPlus:
         exclude_filter,
         max_file_size,
         output_folder,
+        threads=1,
+        incremental=False,
     ):
         self.smb = smb
         self.host = self.smb.conn.getRemoteHost()
+        self.remote_name = self.smb.conn.getRemoteName()
         self.max_connection_attempts = 5
         self.logger = logger
         self.results = {}
@@ -81,6 +151,7 @@ class SMBSpiderPlus:
             "num_files_filtered": 0,
             "num_files_unmodified": 0,
             "num_files_updated": 0,
+            "num_folders_unchanged": 0,
         }
         self.download_flag = download_flag
         self.stats_flag = stats_flag
@@ -88,10 +159,32 @@ class SMBSpiderPlus:
         self.exclude_exts = exclude_exts
         self.max_file_size = max_file_size
         self.output_folder = output_folder
+        self.threads = threads
+        # Worker threads of the parallel crawler each use their own SMB session, stored thread-locally
+        self.local = local()
+        self.lock = Lock()
+        self.incremental = incremental
+        self.unchanged_files = set()
 
         # Make sure the output_folder exists
         make_dirs(self.output_folder)
 
+        self.state = CrawlState(os.path.join(self.output_folder, f"{self.host}.state.json"), self.logger) if self.incremental else None
+
+    @property
+    def conn(self):
+        """SMB connection of the current thread, the main connection outside the crawler workers"""
+        return getattr(self.local, "conn", None) or self.smb.conn
+
+    def new_session(self):
+        """Opens an additional SMB session to the host, authenticated with the credentials of the main connection"""
+        conn = SMBConnection(self.remote_name, self.host, None, self.smb.port, timeout=self.smb.args.smb_timeout)
+        if self.smb.kerberos:
+            conn.kerberosLogin(self.smb.username, self.smb.password, self.smb.domain, self.smb.lmhash, self.smb.nthash, self.smb.aesKey, self.smb.kdcHost, useCache=bool(self.smb.use_kcache))
+        else:
+            conn.login(self.smb.username, self.smb.password, self.smb.domain, self.smb.lmhash, self.smb.nthash)
+        return conn
+
     def reconnect(self):
         """Performs a series of reconnection attempts, up to `self.max_connection_attempts`, with a 3-second delay between each attempt.
         It renegotiates the session by creating a new connection object and logging in again.
@@ -101,8 +194,15 @@ class SMBSpiderPlus:
 
             # Renegotiate the session
             time.sleep(3)
-            self.smb.create_conn_obj()
-            self.smb.login()
+            if getattr(self.local, "conn", None):
+                try:
+                    self.local.conn = self.new_session()
+                except Exception as e:
+                    self.logger.debug(f"Failed to reopen crawler session: {e}")
+                    continue
+            else:
+                self.smb.create_conn_obj()
+                self.smb.login()
             return True
 
         return False
@@ -112,7 +212,7 @@ class SMBSpiderPlus:
         filelist = []
         try:
             # Get file list for the current folder
-            filelist = self.smb.conn.listPath(share, subfolder + "*")
+            filelist = self.conn.listPath(share, subfolder + "*")
 
         except SessionError as e:
             self.logger.debug(f'Failed listing files on share "{share}" in folder "{subfolder}".')
@@ -132,7 +232,7 @@ class SMBSpiderPlus:
     def get_remote_file(self, share, path):
         """Checks if a path is readable in a SMB share."""
         try:
-            return RemoteFile(self.smb.conn, path, share, access=FILE_READ_DATA)
+            return RemoteFile(self.conn, path, share, access=FILE_READ_DATA)
         except SessionError:
             if self.reconnect():
                 return self.get_remote_file(share, path)
@@ -154,7 +254,7 @@ class SMBSpiderPlus:
             except SessionError:
                 if self.reconnect():
                     # Little hack to reset the smb connection instance
-                    remote_file.__smbConnection = self.smb.conn
+                    remote_file.__smbConnection = self.conn
                     return self.read_chunk(remote_file)
 
             except Exception:
@@ -211,7 +311,15 @@ class SMBSpiderPlus:
                 try:
                     # Start the spider at the root of the share folder
                     self.results[share_name] = {}
-                    self.spider_folder(share_name, "")
+                    start_folders, replayed_files = self.resume_share(share_name) if self.incremental else ([""], [])
+                    if self.threads > 1:
+                        self.spider_share_parallel(share_name, start_folders, replayed_files)
+                    else:
+                        self.download_files(share_name, replayed_files)
+                        for folder in start_folders:
+                            self.spider_folder(share_name, folder)
+                    if self.incremental:
+                        self.state.save(self.lock, force=True)
                 except SessionError:
                     traceback.print_exc()
                     self.logger.fail("Got a session error while spidering.")
@@ -230,78 +338,279 @@ class SMBSpiderPlus:
 
         return self.results
 
-    def spider_folder(self, share_name, folder):
-        """Traverses through the contents of the specified share and folder.
+    def resume_share(self, share_name):
+        """Returns the folders to start the crawl from: the saved frontier if the last crawl was interrupted, the root otherwise,
+        and the files taken from the manifest that still have to go through the download checks.
 
-        It checks each entry (file or folder) against various filters, performs file metadata recording, and downloads eligible files if the download flag is set.
+        When resuming, the metadata of the folders listed before the interruption is taken from the manifest.
+        """
+        frontier = self.state.frontier.get(share_name)
+        if not frontier:
+            self.state.frontier[share_name] = {""}
+            return [""], []
+        self.logger.display(f'Resuming crawl of share "{share_name}" from {len(frontier)} pending folder(s).')
+        return sorted(frontier), self.replay_folder(share_name, "", skip=frontier)
+
+    def replay_folder(self, share_name, folder, skip=()):
+        """Adds the manifest metadata of a folder subtree to the results instead of listing it again.
+
+        Returns the (path, size, mtime) of its files, they are marked unchanged so only those missing locally are downloaded.
+        """
+        files = []
+        for folder_path, record in self.state.stored_folders(share_name, folder, skip):
+            with self.lock:
+                self.stats["num_folders"] += len(record["dirs"])
+                self.stats["num_files"] += len(record["files"])
+                for name, (file_size, mtime, ctime, atime) in record["files"].items():
+                    self.results[share_name][folder_path + name] = {
+                        "size": human_size(file_size),
+                        "ctime_epoch": human_time(ctime),
+                        "mtime_epoch": human_time(mtime),
+                        "atime_epoch": human_time(atime),
+                    }
+                    self.stats["file_sizes"].append(file_size)
+                    self.unchanged_files.add((share_name, folder_path + name))
+                    files.append((folder_path + name, file_size, mtime))
+        return files
+
+    def download_files(self, share_name, files, download_queue=None):
+        """Downloads the (path, size, mtime) files if the download flag is set, through the download queue when there is one"""
+        if not self.download_flag:
+            return
+        for file in files:
+            if download_queue is None:
+                self.download_file(share_name, *file)
+            else:
+                download_queue.put(file)
+
+    def list_folder(self, share_name, folder):
+        """Lists the specified share folder and yields the (full path, entry) of every entry that passes the exclusion filter
+
+        In incremental mode, sub-folders whose mtime did not change since the last crawl are taken from the manifest instead of being yielded.
+        A folder's mtime only changes when its direct entries are added, removed or renamed.
         """
         self.logger.info(f'Spider share "{share_name}" in folder "{folder}".')
 
         filelist = self.list_path(share_name, folder + "*")
+        entries = []
+        record = {"files": {}, "dirs": {}}
 
-        # For each entry:
-        # - It's a folder then we spider it (skipping `.` and `..`)
-        # - It's a file then we apply the checks
         for result in filelist:
             next_filedir = result.get_longname()
             if next_filedir in [".", ".."]:
                 continue
             next_fullpath = folder + next_filedir
             result_type = "folder" if result.is_directory() else "file"
-            self.stats[f"num_{result_type}s"] += 1
+            with self.lock:
+                self.stats[f"num_{result_type}s"] += 1
 
             # Check file-dir exclusion filter.
             if any(d in next_filedir.lower() for d in self.exclude_filter):
                 self.logger.info(f'The {result_type} "{next_filedir}" has been excluded')
-                self.stats[f"{result_type}s_filtered"] += 1
+                with self.lock:
+                    self.stats[f"num_{result_type}s_filtered"] += 1
                 continue
 
-            if result_type == "folder":
+            if result.is_directory():
+                record["dirs"][next_filedir] = result.get_mtime_epoch()
+            else:
+                record["files"][next_filedir] = [result.get_filesize(), result.get_mtime_epoch(), result.get_ctime_epoch(), result.get_atime_epoch()]
+            entries.append((next_fullpath, result))
+
+        if self.incremental:
+            entries = self.update_state(share_name, folder, record, entries)
+
+        yield from entries
+
+    def update_state(self, share_name, folder, record, entries):
+        """Stores the new folder listing in the manifest, moves it from the frontier to its changed sub-folders and returns the entries left to crawl"""
+        with self.lock:
+            share_folders = self.state.folders.setdefault(share_name, {})
+            previous = share_folders.get(folder, {"files": {}, "dirs": {}})
+            share_folders[folder] = record
+            frontier = self.state.frontier.setdefault(share_name, set())
+
+            crawl_entries = []
+            unchanged_folders = []
+            for next_fullpath, result in entries:
+                name = result.get_longname()
+                if not result.is_directory():
+                    if previous["files"].get(name, [])[:2] == record["files"][name][:2]:
+                        self.unchanged_files.add((share_name, next_fullpath))
+                    crawl_entries.append((next_fullpath, result))
+                elif previous["dirs"].get(name) == record["dirs"][name] and f"{next_fullpath}/" in share_folders:
+                    unchanged_folders.append(f"{next_fullpath}/")
+                else:
+                    frontier.add(f"{next_fullpath}/")
+                    crawl_entries.append((next_fullpath, result))
+            frontier.discard(folder)
+            self.stats["num_folders_unchanged"] += len(unchanged_folders)
+
+        for unchanged_folder in unchanged_folders:
+            self.logger.info(f'Folder "{unchanged_folder}" in share "{share_name}" is unchanged, using the manifest.')
+            self.download_files(share_name, self.replay_folder(share_name, unchanged_folder), getattr(self.local, "download_queue", None))
+        self.state.save(self.lock)
+        return crawl_entries
+
+    def spider_folder(self, share_name, folder):
+        """Traverses through the contents of the specified share and folder.
+
+        It checks each entry (file or folder) against various filters, performs file metadata recording, and downloads eligible files if the download flag is set.
+        """
+        # For each entry:
+        # - It's a folder then we spider it (skipping `.` and `..`)
+        # - It's a file then we apply the checks
+        for next_fullpath, result in self.list_folder(share_name, folder):
+            if result.is_directory():
                 self.logger.info(f'Current folder in share "{share_name}": "{next_fullpath}"')
                 self.spider_folder(share_name, next_fullpath + "/")
             else:
                 self.logger.info(f'Current file in share "{share_name}": "{next_fullpath}"')
                 self.parse_file(share_name, next_fullpath, result)
 
+    def spider_share_parallel(self, share_name, start_folders=("",), replayed_files=()):
+        """Breadth-first crawl of a share with `self.threads` SMB sessions.
+
+        Folders go through a listing queue and eligible files through a bounded download queue,
+        so listing blocks (backpressure) when the download workers can't keep up.
+        """
+        sessions = []
+        for _ in range(self.threads):
+            try:
+                sessions.append(self.new_session())
+            except Exception as e:
+                self.logger.debug(f"Could not open an additional SMB session: {e}")
+                break
+        if not sessions:
+            self.logger.info("No additional SMB session available, spidering serially.")
+            self.download_files(share_name, replayed_files)
+            for folder in start_folders:
+                self.spider_folder(share_name, folder)
+            return
+
+        # Without downloads every session lists folders, otherwise they are split between listing and downloading
+        num_listers = len(sessions) if not self.download_flag or len(sessions) == 1 else (len(sessions) + 1) // 2
+        list_queue = Queue()
+        for folder in start_folders:
+            list_queue.put(folder)
+        # With a single session the lister downloads the files inline (download_queue is None)
+        download_queue = Queue(maxsize=len(sessions) * 16) if sessions[num_listers:] else None
+
+        listers = [Thread(target=self.list_worker, args=(session, share_name, list_queue, download_queue), daemon=True) for session in sessions[:num_listers]]
+        downloaders = [Thread(target=self.download_worker, args=(session, share_name, download_queue), daemon=True) for session in sessions[num_listers:]]
+        for worker in listers + downloaders:
+            worker.start()
+        self.download_files(share_name, replayed_files, download_queue)
+
+        list_queue.join()
+        for _ in listers:
+            list_queue.put(None)
+        if downloaders:
+            download_queue.join()
+            for _ in downloaders:
+                download_queue.put(None)
+        for worker in listers + downloaders:
+            worker.join()
+
+        for session in sessions:
+            with contextlib.suppress(Exception):
+                session.logoff()
+                session.close()
+
+    def list_worker(self, session, share_name, list_queue, download_queue):
+        """Lists the folders of the listing queue, queues sub-folders for listing and files for download"""
+        self.local.conn = session
+        self.local.download_queue = download_queue
+        while True:
+            folder = list_queue.get()
+            if folder is None:
+                list_queue.task_done()
+                break
+            try:
+                for next_fullpath, result in self.list_folder(share_name, folder):
+                    if result.is_directory():
+                        self.logger.info(f'Current folder in share "{share_name}": "{next_fullpath}"')
+                        list_queue.put(next_fullpath + "/")
+                    else:
+                        self.logger.info(f'Current file in share "{share_name}": "{next_fullpath}"')
+                        if not self.record_file(share_name, next_fullpath, result):
+                            continue
+                        self.download_files(share_name, [(next_fullpath, result.get_filesize(), result.get_mtime_epoch())], download_queue)
+            except Exception as e:
+                self.logger.fail(f'Error spidering folder "{folder}" in share "{share_name}": {e}')
+            finally:
+                list_queue.task_done()
+
+    def download_worker(self, session, share_name, download_queue):
+        """Downloads the files of the download queue"""
+        self.local.conn = session
+        while True:
+            item = download_queue.get()
+            if item is None:
+                download_queue.task_done()
+                break
+            try:
+                self.download_file(share_name, *item)
+            except Exception as e:
+                self.logger.fail(f'Error downloading file "{item[0]}" from share "{share_name}": {e}')
+            finally:
+                download_queue.task_done()
+
     def parse_file(self, share_name, file_path, file_info):
         """Checks file attributes against various filters, records file metadata, and downloads eligible files if the download flag is set"""
-        # Record the file metadata
+        if self.record_file(share_name, file_path, file_info):
+            self.download_file(share_name, file_path, file_info.get_filesize(), file_info.get_mtime_epoch())
+
+    def record_file(self, share_name, file_path, file_info):
+        """Records the file metadata, returns True if the file should be downloaded"""
         file_size = file_info.get_filesize()
-        file_creation_time = file_info.get_ctime_epoch()
-        file_modified_time = file_info.get_mtime_epoch()
-        file_access_time = file_info.get_atime_epoch()
-        self.results[share_name][file_path] = {
-            "size": human_size(file_size),
-            "ctime_epoch": human_time(file_creation_time),
-            "mtime_epoch": human_time(file_modified_time),
-            "atime_epoch": human_time(file_access_time),
-        }
-        self.stats["file_sizes"].append(file_size)
+        with self.lock:
+            self.results[share_name][file_path] = {
+                "size": human_size(file_size),
+                "ctime_epoch": human_time(file_info.get_ctime_epoch()),
+                "mtime_epoch": human_time(file_info.get_mtime_epoch()),
+                "atime_epoch": human_time(file_info.get_atime_epoch()),
+            }
+            self.stats["file_sizes"].append(file_size)
 
         # Check if proceeding with download attempt.
-        if not self.download_flag:
-            return
+        return self.download_flag
+
+    def download_file(self, share_name, file_path, file_size, file_modified_time):
+        """Applies the extension and size filters and downloads the file if it is not already up-to-date"""
 
         # Check file extension filter.
         _, file_extension = os.path.splitext(file_path)
         if file_extension:
-            self.stats["file_exts"].add(file_extension.lower())
+            with self.lock:
+                self.stats["file_exts"].add(file_extension.lower())
             if file_extension.lower() in self.exclude_exts:
                 self.logger.info(f'The file "{file_path}" has an excluded extension.')
-                self.stats["num_files_filtered"] += 1
+                with self.lock:
+                    self.stats["num_files_filtered"] += 1
                 return
 
         # Check file size limits.
         if file_size > self.max_file_size:
             self.logger.info(f"File {file_path} has size {human_size(file_size)} > max size {human_size(self.max_file_size)}.")
-            self.stats["num_files_filtered"] += 1
+            with self.lock:
+                self.stats["num_files_filtered"] += 1
+            return
+
+        # Unchanged since the last crawl and already downloaded: no need to open the remote file.
+        local_path = os.path.join(self.output_folder, self.host, share_name, *file_path.split("/"))
+        if (share_name, file_path) in self.unchanged_files and os.path.exists(local_path) and os.path.getsize(local_path) == file_size:
+            self.logger.info(f'File unchanged since last crawl "{file_path}" => "{local_path}".')
+            with self.lock:
+                self.stats["num_files_unmodified"] += 1
             return
 
         # Check if the remote file is readable.
         remote_file = self.get_remote_file(share_name, file_path)
         if not remote_file:
             self.logger.fail(f'Cannot read remote file "{file_path}".')
-            self.stats["num_get_fail"] += 1
+            with self.lock:
+                self.stats["num_get_fail"] += 1
             return
 
         # Check if the file is already downloaded and up-to-date.
@@ -311,7 +620,8 @@ class SMBSpiderPlus:
         if os.path.exists(download_path):
             if file_modified_time <= os.stat(download_path).st_mtime and os.path.getsize(download_path) == file_size:
                 self.logger.info(f'File already downloaded "{file_path}" => "{download_path}".')
-                self.stats["num_files_unmodified"] += 1
+                with self.lock:
+                    self.stats["num_files_unmodified"] += 1
                 return
             else:
                 needs_update_flag = True
@@ -331,12 +641,13 @@ class SMBSpiderPlus:
             self.logger.fail(f'Failed to download file "{file_path}". Error: {e!s}')
 
         # Increment stats counters
-        if download_success:
-            self.stats["num_get_success"] += 1
-            if needs_update_flag:
-                self.stats["num_files_updated"] += 1
-        else:
-            self.stats["num_get_fail"] += 1
+        with self.lock:
+            if download_success:
+                self.stats["num_get_success"] += 1
+                if needs_update_flag:
+                    self.stats["num_files_updated"] += 1
+            else:
+                self.stats["num_get_fail"] += 1
 
     def save_file(self, remote_file, share_name):
         """Reads the `remote_file` in chunks using the `read_chunk` method.
@@ -408,9 +719,11 @@ class SMBSpiderPlus:
         # Folder statistics.
         num_folders = self.stats.get("num_folders", 0)
         self.logger.display(f"Total folders found:  {num_folders}")
-        num_folders_filtered = self.stats.get("num_folders_filtered", 0)
-        if num_folders_filtered:
-            num_filtered_folders = len(num_folders_filtered)
+        num_folders_unchanged = self.stats.get("num_folders_unchanged", 0)
+        if num_folders_unchanged:
+            self.logger.display(f"Unchanged folders:    {num_folders_unchanged} (taken from the manifest)")
+        num_filtered_folders = self.stats.get("num_folders_filtered", 0)
+        if num_filtered_folders:
             self.logger.display(f"Folders Filtered:     {num_filtered_folders}")
 
         # File statistics.
@@ -486,6 +799,8 @@ class NXCModule:
         EXCLUDE_FILTER    Case-insensitive filter to exclude folders/files (Default: print$,ipc$)
         MAX_FILE_SIZE     Max file size to download (Default: 51200)
         OUTPUT_FOLDER     Path of the local folder to save files (Default: /tmp/nxc_spider_plus)
+        THREADS           Number of concurrent SMB sessions per host, split between listing and downloading (Default: 1)
+        INCREMENTAL       Keep a manifest and crawl frontier in the `OUTPUT_FOLDER`: resume interrupted crawls and skip folders whose mtime did not change (Default: False)
         """
         self.download_flag = False
         if any("DOWNLOAD" in key for key in module_options):
@@ -499,6 +814,10 @@ class NXCModule:
         self.exclude_filter = [d.lower() for d in self.exclude_filter]  # force case-insensitive
         self.max_file_size = int(module_options.get("MAX_FILE_SIZE", 50 * 1024))
         self.output_folder = module_options.get("OUTPUT_FOLDER", os.path.join("/tmp", "nxc_spider_plus"))
+        self.threads = int(module_options.get("THREADS", 1))
+        self.incremental = False
+        if any("INCREMENTAL" in key for key in module_options):
+            self.incremental = True
 
     def on_login(self, context, connection):
         context.log.display("Started module spidering_plus with the following options:")
@@ -508,6 +827,8 @@ class NXCModule:
         context.log.display(f"  EXCLUDE_EXTS: {self.exclude_exts}")
         context.log.display(f" MAX_FILE_SIZE: {human_size(self.max_file_size)}")
         context.log.display(f" OUTPUT_FOLDER: {self.output_folder}")
+        context.log.display(f"       THREADS: {self.threads}")
+        context.log.display(f"   INCREMENTAL: {self.incremental}")
 
         spider = SMBSpiderPlus(
             connection,
@@ -518,6 +839,8 @@ class NXCModule:
             self.exclude_filter,
             self.max_file_size,
             self.output_folder,
+            self.threads,
+            self.incremental,
         )
 
         spider.spider_shares()
@@ -1,7 +1,5 @@
 from pathlib import Path
 from datetime import datetime
-from impacket.ldap import ldap, ldapasn1
-from impacket.ldap.ldap import LDAPSearchError
 
 
 class NXCModule:
@@ -75,16 +73,8 @@ class NXCModule:
         context.log.info(f"Starting LDAP search with search filter '{self.search_filter}'")
 
         try:
-            sc = ldap.SimplePagedResultsControl()
-            connection.ldapConnection.search(
-                searchFilter=self.search_filter,
-                attributes=["sAMAccountName", "description"],
-                sizeLimit=0,
-                searchControls=[sc],
-                perRecordCallback=self.process_record,
-            )
-        except LDAPSearchError as e:
-            context.log.fail(f"Obtained unexpected exception: {e!s}")
+            for entry in connection.search_paged(self.search_filter, ["sAMAccountName", "description"]):
+                self.process_record(entry)
         finally:
             self.delete_log_file()
 
@@ -115,7 +105,7 @@ class NXCModule:
 
     def process_record(self, item):
         """
-        Function that is called to process the items obtained by the LDAP search. All items are
+        Function that is called to process the entries obtained by the LDAP search. All items are
         written to the log file per default. Items that contain one of the keywords configured
         within this module are also printed to stdout.
 
@@ -124,21 +114,8 @@ class NXCModule:
         Not sure whether this is a fault by this module or by impacket. As a workaround, this
         function adds each new account name to a set and skips accounts that have already been added.
         """
-        if not isinstance(item, ldapasn1.SearchResultEntry):
-            return
-
-        sAMAccountName = ""
-        description = ""
-
-        try:
-            for attribute in item["attributes"]:
-                if str(attribute["type"]) == "sAMAccountName":
-                    sAMAccountName = attribute["vals"][0].asOctets().decode("utf-8")
-                elif str(attribute["type"]) == "description":
-                    description = attribute["vals"][0].asOctets().decode("utf-8")
-        except Exception as e:
-            entry = sAMAccountName or "item"
-            self.context.error(f"Skipping {entry}, cannot process LDAP entry due to error: '{e!s}'")
+        sAMAccountName = item.get("samaccountname", [""])[0]
+        description = item.get("description", [""])[0]
 
         if description and sAMAccountName not in self.account_names:
             self.desc_count += 1
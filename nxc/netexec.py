@@ -1,10 +1,11 @@
 import sys
 from nxc.helpers.logger import highlight
 from nxc.helpers.misc import identify_target_file
-from nxc.parsers.ip import parse_targets
+from nxc.parsers.ip import parse_targets, count_targets
 from nxc.parsers.nmap import parse_nmap_xml
 from nxc.parsers.nessus import parse_nessus_file
 from nxc.cli import gen_cli_args
+from nxc.connection import probe_results
 from nxc.loaders.protocolloader import ProtocolLoader
 from nxc.loaders.moduleloader import ModuleLoader
 from nxc.first_run import first_run_setup
@@ -12,8 +13,9 @@ from nxc.paths import NXC_PATH
 from nxc.console import nxc_console
 from nxc.logger import nxc_logger
 from nxc.config import nxc_config, nxc_workspace, config_log, ignore_opsec
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import contextlib
 from nxc.helpers import powershell
 import shutil
 import os
@@ -43,25 +45,126 @@ def create_db_engine(db_path):
     return sqlalchemy.create_engine(f"sqlite:///{db_path}", isolation_level="AUTOCOMMIT", future=True)
 
 
-async def start_run(protocol_obj, args, db, targets):
-    nxc_logger.debug("Creating ThreadPoolExecutor")
-    if args.no_progress or len(targets) == 1:
-        with ThreadPoolExecutor(max_workers=args.threads + 1) as executor:
-            nxc_logger.debug(f"Creating thread for {protocol_obj}")
-            _ = [executor.submit(protocol_obj, args, db, target) for target in targets]
+async def run_protocol(loop, executor, protocol_obj, args, db, target):
+    """Runs the probe of the protocol on the event loop, then hands the blocking protocol flow of the target to the worker pool"""
+    try:
+        # --jitter spaces out the connections of the worker threads, a probe would connect before the delay
+        if protocol_obj.probe and not args.jitter:
+            try:
+                probe_result = await protocol_obj.probe(args, db, target)
+            except Exception as e:
+                nxc_logger.debug(f"Error probing {target}, the protocol class takes over: {e}")
+                probe_result = {}
+            if probe_result is None:
+                nxc_logger.info(f"Skipping {target}: the {args.protocol} probe could not connect")
+                return
+            probe_results[target] = probe_result
+        await loop.run_in_executor(executor, protocol_obj, args, db, target)
+    except Exception as e:
+        nxc_logger.exception(f"Exception while running {protocol_obj} against {target}: {e}")
+
+
+async def is_port_open(target, ports, timeout):
+    """Non-blocking TCP connect() probe, returns True as soon as one of the ports accepts the connection"""
+    for port in ports:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(target, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            nxc_logger.debug(f"Port {port} on {target} is not reachable: {e}")
+            continue
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+        return True
+    return False
+
+
+async def discover_and_run(loop, executor, protocol_obj, args, db, target, ports):
+    """Only hands the target to the protocol if its port answers the TCP connect sweep"""
+    if await is_port_open(target, ports, args.discovery_timeout):
+        await run_protocol(loop, executor, protocol_obj, args, db, target)
     else:
-        with Progress(console=nxc_console) as progress, ThreadPoolExecutor(max_workers=args.threads + 1) as executor:
-            current = 0
-            total = len(targets)
-            tasks = progress.add_task(
-                f"[green]Running nxc against {total} {'target' if total == 1 else 'targets'}",
-                total=total,
-            )
-            nxc_logger.debug(f"Creating thread for {protocol_obj}")
-            futures = [executor.submit(protocol_obj, args, db, target) for target in targets]
-            for _ in as_completed(futures):
-                current += 1
-                progress.update(tasks, completed=current)
+        nxc_logger.info(f"Skipping {target}: no open port in {ports}")
+
+
+def gen_targets(target_args, protocol):
+    """Lazily yields every target from the CLI arguments, target files and scan files"""
+    for target in target_args:
+        if exists(target) and os.path.isfile(target):
+            target_file_type = identify_target_file(target)
+            if target_file_type == "nmap":
+                yield from parse_nmap_xml(target, protocol)
+            elif target_file_type == "nessus":
+                yield from parse_nessus_file(target, protocol)
+            else:
+                with open(target) as target_file:
+                    for target_entry in target_file:
+                        yield from parse_targets(target_entry.strip())
+        else:
+            yield from parse_targets(target)
+
+
+def count_all_targets(target_args):
+    """Computes the number of targets gen_targets() will yield without expanding any range.
+
+    Returns None when a nmap or nessus scan file is given, counting its hosts would mean parsing the whole file
+    twice, so the progress bar runs without a total.
+    """
+    total = 0
+    for target in target_args:
+        if exists(target) and os.path.isfile(target):
+            if identify_target_file(target) in ("nmap", "nessus"):
+                return None
+            with open(target) as target_file:
+                total += sum(count_targets(target_entry.strip()) for target_entry in target_file)
+        else:
+            total += count_targets(target)
+    return total
+
+
+async def start_run(protocol_obj, args, db, targets, total=None):
+    """Schedules the targets on the event loop and only hands the protocol flow to a bounded thread pool.
+
+    The event loop owns the scheduling, so the number of pending targets is not tied to the number of threads.
+    Protocols with a probe (smb) connect, negotiate and fingerprint every target on the event loop first: dead hosts
+    never reach a worker thread and the live ones skip those round-trips in the thread, which only runs the blocking
+    impacket work (session, login, RPC) of the protocol class.
+    Targets are pulled lazily from the iterable and at most a small window of them is in flight at any time,
+    so memory usage does not grow with the size of the target set.
+    With --fast-discovery every target first goes through a non-blocking TCP connect() probe on the event loop
+    and only targets with an open port reach the protocol class.
+    """
+    loop = asyncio.get_running_loop()
+    window = (args.threads + 1) * 2
+    if protocol_obj.probe or args.fast_discovery:
+        # Most of the in-flight targets are just waiting on a socket, so the window follows the discovery concurrency
+        window = max(window, args.discovery_concurrency)
+    if args.fast_discovery:
+        ports = [int(port) for port in (args.port if isinstance(args.port, list) else [args.port])]
+    nxc_logger.debug("Creating ThreadPoolExecutor")
+    with ThreadPoolExecutor(max_workers=args.threads + 1) as executor, Progress(console=nxc_console, disable=bool(args.no_progress or total == 1)) as progress:
+        progress_task = progress.add_task(
+            f"[green]Running nxc against {total if total is not None else 'streamed'} {'target' if total == 1 else 'targets'}",
+            total=total,
+        )
+        nxc_logger.debug(f"Scheduling targets for {protocol_obj} with a window of {window}")
+        window_slots = asyncio.Semaphore(window)
+        pending = set()
+
+        def target_done(task):
+            pending.discard(task)
+            window_slots.release()
+            progress.advance(progress_task)
+
+        for target in targets:
+            await window_slots.acquire()
+            if args.fast_discovery:
+                task = asyncio.ensure_future(discover_and_run(loop, executor, protocol_obj, args, db, target, ports))
+            else:
+                task = asyncio.ensure_future(run_protocol(loop, executor, protocol_obj, args, db, target))
+            pending.add(task)
+            task.add_done_callback(target_done)
+        await asyncio.gather(*pending)
 
 
 def main():
@@ -104,6 +207,7 @@ def main():
 
     module_server = None
     targets = []
+    total_targets = 0
     server_port_dict = {"http": 80, "https": 443, "smb": 445}
 
     if hasattr(args, "cred_id") and args.cred_id:
@@ -119,19 +223,8 @@ def main():
                     exit(1)
 
     if hasattr(args, "target") and args.target:
-        for target in args.target:
-            if exists(target) and os.path.isfile(target):
-                target_file_type = identify_target_file(target)
-                if target_file_type == "nmap":
-                    targets.extend(parse_nmap_xml(target, args.protocol))
-                elif target_file_type == "nessus":
-                    targets.extend(parse_nessus_file(target, args.protocol))
-                else:
-                    with open(target) as target_file:
-                        for target_entry in target_file:
-                            targets.extend(parse_targets(target_entry.strip()))
-            else:
-                targets.extend(parse_targets(target))
+        targets = gen_targets(args.target, args.protocol)
+        total_targets = count_all_targets(args.target)
 
     # The following is a quick hack for the powershell obfuscation functionality, I know this is yucky
     if hasattr(args, "clear_obfscripts") and args.clear_obfscripts:
@@ -206,7 +299,7 @@ def main():
                     if ans.lower() not in ["y", "yes", ""]:
                         exit(1)
 
-            if not module.multiple_hosts and len(targets) > 1:
+            if not module.multiple_hosts and (total_targets is None or total_targets > 1):
                 ans = input(
                     highlight(
                         "[!] Running this module on multiple hosts doesn't really make any sense, are you sure you want to continue? [Y/n] ",
@@ -231,6 +324,10 @@ def main():
             protocol_object.module = current_modules
             nxc_logger.debug(f"proto object module after adding: {protocol_object.module}")
 
+    # S4U delegation always authenticates with Kerberos, set it here rather than from the login threads
+    if hasattr(args, "delegate") and args.delegate:
+        args.kerberos = True
+
     if hasattr(args, "ntds") and args.ntds and not args.userntds:
         ans = input(
             highlight(
@@ -242,12 +339,13 @@ def main():
             exit(1)
 
     try:
-        asyncio.run(start_run(protocol_object, args, db, targets))
+        asyncio.run(start_run(protocol_object, args, db, targets, total_targets))
     except KeyboardInterrupt:
         nxc_logger.debug("Got keyboard interrupt")
     finally:
         if module_server:
             module_server.shutdown()
+        db.shutdown_db()
         db_engine.dispose()
 
 
@@ -23,3 +23,25 @@ def parse_targets(target):
                     yield str(ip)
     except ValueError:
         yield str(target)
+
+
+def count_targets(target):
+    """Returns how many targets parse_targets() would yield, without expanding the range"""
+    try:
+        if "-" in target:
+            start_ip, end_ip = target.split("-")
+            try:
+                end_ip = ip_address(end_ip)
+            except ValueError:
+                first_three_octets = start_ip.split(".")[:-1]
+                first_three_octets.append(end_ip)
+                end_ip = ip_address(".".join(first_three_octets))
+
+            return sum(ip_range.num_addresses for ip_range in summarize_address_range(ip_address(start_ip), end_ip))
+        else:
+            if ip_interface(target).ip.version == 6 and ip_address(target).is_link_local:
+                return 1
+            else:
+                return ip_network(target, strict=False).num_addresses
+    except ValueError:
+        return 1
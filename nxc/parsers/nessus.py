@@ -1,4 +1,6 @@
-import xmltodict
+from xml.etree import ElementTree
+
+from nxc.logger import nxc_logger
 
 # Ideally i'd like to be able to pull this info out dynamically from each protocol object but i'm a lazy bastard
 protocol_dict = {
@@ -11,31 +13,23 @@ protocol_dict = {
 
 
 def parse_nessus_file(nessus_file, protocol):
-    targets = []
-
-    def handle_nessus_file(path, item):
-        # Must return True otherwise xmltodict will throw a ParsingIterrupted() exception
-        # https://github.com/martinblech/xmltodict/blob/master/xmltodict.py#L219
-
-        if any("ReportHost" and "ReportItem" in values for values in path):
-            item = dict(path)
-            ip = item["ReportHost"]["name"]
-            if ip in targets:
-                return True
-
-            port = item["ReportItem"]["port"]
-            svc_name = item["ReportItem"]["svc_name"]
-
-            if port in protocol_dict[protocol]["ports"]:
-                targets.append(ip)
-            if svc_name in protocol_dict[protocol]["services"]:
-                targets.append(ip)
-
-            return True
-        else:
-            return True
-
-    with open(nessus_file) as file_handle:
-        xmltodict.parse(file_handle, item_depth=4, item_callback=handle_nessus_file)
-
-    return targets
+    """Yields the hosts of a .nessus report with a finding on a port or service of the protocol, streaming the file"""
+    ports = protocol_dict[protocol]["ports"]
+    services = protocol_dict[protocol]["services"]
+    ip = None
+    found = False
+
+    for event, element in ElementTree.iterparse(nessus_file, events=("start", "end")):
+        if element.tag == "ReportHost":
+            if event == "start":
+                ip = element.get("name")
+                found = False
+            else:
+                # free the findings of the host, a report can hold thousands of them
+                element.clear()
+        elif element.tag == "ReportItem" and event == "end":
+            if not found and (int(element.get("port", 0)) in ports or element.get("svc_name") in services):
+                found = True
+                nxc_logger.debug(f"Target parsed from Nessus scan: {ip}")
+                yield ip
+            element.clear()
@@ -16,13 +16,10 @@ protocol_dict = {
 
 def parse_nmap_xml(nmap_output_file, protocol):
     nmap_report = NmapParser.parse_fromfile(nmap_output_file)
-    targets = []
 
     for host in nmap_report.hosts:
         for port, _proto in host.get_open_ports():
             if port in protocol_dict[protocol]["ports"]:
-                targets.append(host.ipv4)
+                nxc_logger.debug(f"Target parsed from Nmap scan: {host.ipv4}")
+                yield host.ipv4
                 break
-    nxc_logger.debug(f"Targets parsed from Nmap scan: {targets}")
-
-    return targets
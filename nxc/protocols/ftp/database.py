@@ -7,6 +7,7 @@ from sqlalchemy.exc import (
     NoInspectionAvailable,
     NoSuchTableError,
 )
+from nxc.database import BatchedWriter, SessionProxy, background_write, queued_write
 from nxc.logger import nxc_logger
 import sys
 
@@ -25,7 +26,8 @@ class database:
 
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
         Session = scoped_session(session_factory)
-        self.sess = Session()
+        self.writer = BatchedWriter(self.db_engine)
+        self.sess = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -81,6 +83,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.sess.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -89,10 +92,12 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.sess.execute(table.delete())
 
+    @background_write
     def add_host(self, host, port, banner):
         """Check if this host is already in the DB, if not add it"""
         hosts = []
@@ -139,6 +144,7 @@ class database:
             nxc_logger.debug(f"add_host() - Host IDs Updated: {updated_ids}")
             return updated_ids
 
+    @queued_write
     def add_credential(self, username, password):
         """Check if this credential has already been added to the database, if not add it in."""
         credentials = []
@@ -181,6 +187,7 @@ class database:
         else:
             return credentials
 
+    @queued_write
     def remove_credentials(self, creds_id):
         """Removes a credential ID from the database"""
         del_hosts = []
@@ -267,6 +274,7 @@ class database:
             q = q.filter(func.lower(self.CredentialsTable.c.username).like(like_term))
         return self.sess.execute(q).all()
 
+    @background_write
     def add_loggedin_relation(self, cred_id, host_id):
         relation_query = select(self.LoggedinRelationsTable).filter(
             self.LoggedinRelationsTable.c.credid == cred_id,
@@ -297,6 +305,7 @@ class database:
             q = q.filter(self.LoggedinRelationsTable.c.hostid == host_id)
         return self.sess.execute(q).all()
 
+    @queued_write
     def remove_loggedin_relations(self, cred_id=None, host_id=None):
         q = delete(self.LoggedinRelationsTable)
         if cred_id:
@@ -305,11 +314,13 @@ class database:
             q = q.filter(self.LoggedinRelationsTable.c.hostid == host_id)
         self.sess.execute(q)
 
+    @background_write
     def add_directory_listing(self, lir_id, data):
         pass
 
     def get_directory_listing(self):
         pass
 
+    @queued_write
     def remove_directory_listing(self):
         pass
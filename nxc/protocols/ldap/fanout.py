@@ -0,0 +1,95 @@
+import string
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from nxc.protocols.ldap.search import paged_search
+
+# First characters of sAMAccountName split into ranges, the first and last range are open-ended
+SAM_PREFIX_CHARS = string.digits + string.ascii_lowercase
+
+# objectClass partitions, objects of none of these classes go to a last catch-all partition
+OBJECT_CLASSES = ["user", "group", "organizationalUnit", "container", "groupPolicyContainer"]
+
+_DONE = object()
+
+
+def sam_prefix_partitions(count):
+    """Splits the directory into `count` sAMAccountName ranges plus the objects without sAMAccountName"""
+    count = max(1, min(count, len(SAM_PREFIX_CHARS)))
+    bounds = [SAM_PREFIX_CHARS[round(i * len(SAM_PREFIX_CHARS) / count)] for i in range(1, count)]
+    partitions = []
+    lower = None
+    for upper in [*bounds, None]:
+        terms = []
+        if lower:
+            terms.append(f"(sAMAccountName>={lower})")
+        if upper:
+            terms.append(f"(!(sAMAccountName>={upper}))")
+        partitions.append(f"(&{''.join(terms)})" if len(terms) > 1 else (terms[0] if terms else "(sAMAccountName=*)"))
+        lower = upper
+    partitions.append("(!(sAMAccountName=*))")
+    return partitions
+
+
+def object_class_partitions():
+    """One partition per common objectClass and a catch-all, a computer is also a user so results must be deduplicated"""
+    return [f"(objectClass={object_class})" for object_class in OBJECT_CLASSES] + [f"(!(|{''.join(f'(objectClass={object_class})' for object_class in OBJECT_CLASSES)}))"]
+
+
+def fan_out_search(ldap_connections, search_filter, attributes, partitions, search_base=None, page_size=1000):
+    """Runs the search split in partitions over several LDAP connections in parallel, yields the merged entries once per DN.
+
+    Every connection gets its own thread that takes the next pending partition when its previous one is done,
+    so faster DCs end up answering more partitions. Entries are yielded as soon as their page is received.
+    Closing the generator stops the workers, their paged searches are abandoned. The first error is raised.
+    """
+    pending = Queue()
+    for partition in partitions:
+        pending.put(f"(&{partition}{search_filter if search_filter.startswith('(') else f'({search_filter})'})")
+    results = Queue(maxsize=page_size * len(ldap_connections))
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def worker(ldap_connection):
+        try:
+            while not stop.is_set():
+                try:
+                    partition_filter = pending.get_nowait()
+                except Empty:
+                    break
+                for entry in paged_search(ldap_connection, partition_filter, attributes, search_base=search_base, page_size=page_size):
+                    if not put(entry):
+                        break
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    threads = [Thread(target=worker, args=(ldap_connection,), daemon=True) for ldap_connection in ldap_connections]
+    for thread in threads:
+        thread.start()
+
+    seen = set()
+    running = len(threads)
+    try:
+        while running:
+            item = results.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            elif item["dn"].lower() not in seen:
+                seen.add(item["dn"].lower())
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
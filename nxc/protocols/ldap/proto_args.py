@@ -15,6 +15,8 @@ def proto_args(parser, std_parser, module_parser):
     egroup = ldap_parser.add_argument_group("Retrevie hash on the remote DC", "Options to get hashes from Kerberos")
     egroup.add_argument("--asreproast", help="Output AS_REP response to crack with hashcat to file")
     egroup.add_argument("--kerberoasting", help="Output TGS ticket to crack with hashcat to file")
+    egroup.add_argument("--roast-threads", type=int, default=10, metavar="THREADS", help="Number of concurrent AS-REQ/TGS-REQ sent to the KDCs when roasting (default: 10)")
+    egroup.add_argument("--roast-kdcs", nargs="+", metavar="KDC", help="KDC(s) to spread the roasting requests over (default: --kdcHost or the domain)")
 
     vgroup = ldap_parser.add_argument_group("Retrieve useful information on the domain", "Options to to play with Kerberos")
     vgroup.add_argument("--trusted-for-delegation", action="store_true", help="Get the list of users and computers with flag TRUSTED_FOR_DELEGATION")
@@ -26,6 +28,15 @@ def proto_args(parser, std_parser, module_parser):
     vgroup.add_argument("--get-sid", action="store_true", help="Get domain sid")
     vgroup.add_argument("--active-users", action="store_true", help="Get Active Domain Users Accounts")
 
+    fgroup = ldap_parser.add_argument_group("Multi-DC searches", "Options to spread large searches over several domain controllers")
+    fgroup.add_argument("--fanout", nargs="*", metavar="DC", help="Split large searches in partitions answered in parallel by several DCs, ldaps:// and gc:// URLs are accepted (default: every DC of the domain)")
+    fgroup.add_argument("--fanout-partition", choices={"samaccountname", "objectclass"}, default="samaccountname", help="How searches are partitioned with --fanout (default: samaccountname)")
+
+    sgroup = ldap_parser.add_argument_group("Offline snapshot", "Options to dump the directory once and enumerate it offline")
+    sgroup.add_argument("--dump-snapshot", nargs="?", const="", metavar="FILE", help="Dump the directory to a local snapshot file (default: in ~/.nxc/logs)")
+    sgroup.add_argument("--snapshot-attributes", nargs="+", default=["*"], metavar="ATTRIBUTE", help="Attributes to store in the snapshot (default: *)")
+    sgroup.add_argument("--snapshot", metavar="FILE", help="Run the enumeration options and modules against a snapshot instead of the DC")
+
     ggroup = ldap_parser.add_argument_group("Retrevie gmsa on the remote DC", "Options to play with gmsa")
     ggroup.add_argument("--gmsa", action="store_true", help="Enumerate GMSA passwords")
     ggroup.add_argument("--gmsa-convert-id", help="Get the secret name of specific gmsa or all gmsa if no gmsa provided")
@@ -35,6 +46,11 @@ def proto_args(parser, std_parser, module_parser):
     bgroup.add_argument("--bloodhound", action="store_true", help="Perform a Bloodhound scan")
     bgroup.add_argument("-ns", "--nameserver", help="Custom DNS IP")
     bgroup.add_argument("-c", "--collection", help="Which information to collect. Supported: Group, LocalAdmin, Session, Trusts, Default, DCOnly, DCOM, RDP, PSRemote, LoggedOn, Container, ObjectProps, ACL, All. You can specify more than one by separating them with a comma. (default: Default)'")
+    bgroup.add_argument("--bh-workers", type=int, default=10, metavar="THREADS", help="Number of computers enumerated concurrently by the collection (default: 10)")
+    bgroup.add_argument("--bh-disable-pooling", action="store_true", help="Parse the ACLs in the main process instead of a pool of subprocesses, slower but uses less memory")
+    bgroup.add_argument("--bh-no-cache", action="store_true", help="Do not load nor save the object resolver cache of the workspace")
+    bgroup.add_argument("--bh-chunk-size", type=int, default=1024 * 1024, metavar="BYTES", help="Size of the chunks the collection output is compressed in, it is streamed into the zip file (default: 1048576)")
+    bgroup.add_argument("--bh-known-computers", action="store_true", help="Only enumerate the computers of the domain found by the smb protocol in the workspace instead of all of them")
 
     return parser
 
@@ -0,0 +1,97 @@
+import contextlib
+
+from impacket.ldap import ldap as ldap_impacket
+from impacket.ldap import ldapasn1 as ldapasn1_impacket
+
+# Attributes whose values are kept as bytes by entry_to_dict(), every other value is decoded as UTF-8
+binary_attributes = {
+    "cacertificate",
+    "dnsrecord",
+    "jpegphoto",
+    "logonhours",
+    "msds-allowedtoactonbehalfofotheridentity",
+    "msds-generationid",
+    "msds-groupmsamembership",
+    "msds-managedpassword",
+    "mslaps-encryptedpassword",
+    "mslaps-encrypteddsrmpassword",
+    "ntsecuritydescriptor",
+    "objectguid",
+    "objectsid",
+    "securityidentifier",
+    "sidhistory",
+    "thumbnailphoto",
+    "tokengroups",
+    "usercertificate",
+}
+
+
+def entry_to_dict(entry):
+    """Converts a SearchResultEntry to a dict of lists of values keyed by lower-cased attribute name, the DN is stored under "dn"."""
+    result = {"dn": str(entry["objectName"])}
+    for attribute in entry["attributes"]:
+        name = str(attribute["type"]).lower()
+        values = [value.asOctets() for value in attribute["vals"]]
+        if name not in binary_attributes:
+            try:
+                values = [value.decode("utf-8") for value in values]
+            except UnicodeDecodeError:
+                pass
+        result[name] = values
+    return result
+
+
+def paged_search(ldap_connection, search_filter, attributes, size_limit=0, search_base=None, page_size=1000, raw=False):
+    """Paged LDAP search yielding every entry as a dict (see entry_to_dict) as soon as its page is received.
+
+    impacket's search() keeps every page in memory until the search is done, here only the current page is.
+    Closing the generator early abandons the paged search on the server.
+    Raises LDAPSearchError like impacket's search(), except for sizeLimitExceeded which just ends the search.
+    With raw=True the SearchResultEntry objects are yielded as is. Offline snapshots (see snapshot.py) answer locally.
+    """
+    if hasattr(ldap_connection, "search_entries"):
+        if raw:
+            yield from ldap_connection.search(searchBase=search_base, sizeLimit=size_limit, searchFilter=search_filter, attributes=attributes)
+        else:
+            yield from ldap_connection.search_entries(search_filter, attributes, size_limit, search_base)
+        return
+
+    paged_search_control = ldapasn1_impacket.SimplePagedResultsControl(criticality=True, size=page_size)
+    search_request = ldapasn1_impacket.SearchRequest()
+    search_request["baseObject"] = search_base if search_base is not None else ldap_connection._baseDN
+    search_request["scope"] = ldapasn1_impacket.Scope("wholeSubtree")
+    search_request["derefAliases"] = ldapasn1_impacket.DerefAliases("neverDerefAliases")
+    search_request["sizeLimit"] = size_limit
+    search_request["timeLimit"] = 0
+    search_request["typesOnly"] = False
+    search_request["filter"] = ldap_connection._parseFilter(search_filter)
+    search_request["attributes"].setComponents(*attributes)
+
+    done = False
+    try:
+        while not done:
+            entries = []
+            for message in ldap_connection.sendReceive(search_request, [paged_search_control]):
+                search_result = message["protocolOp"].getComponent()
+                if not search_result.isSameTypeWith(ldapasn1_impacket.SearchResultDone()):
+                    if search_result.isSameTypeWith(ldapasn1_impacket.SearchResultEntry()):
+                        entries.append(search_result)
+                elif search_result["resultCode"] == ldapasn1_impacket.ResultCode("success"):
+                    # Updates the cookie of the control for the next page
+                    done = ldap_connection._handleControls([paged_search_control], message["controls"])
+                elif search_result["resultCode"] == ldapasn1_impacket.ResultCode("sizeLimitExceeded"):
+                    done = True
+                else:
+                    done = True
+                    raise ldap_impacket.LDAPSearchError(
+                        error=int(search_result["resultCode"]),
+                        errorString=f"Error in searchRequest -> {search_result['resultCode'].prettyPrint()}: {search_result['diagnosticMessage']}",
+                    )
+            for entry in entries:
+                yield entry if raw else entry_to_dict(entry)
+    finally:
+        if not done:
+            # A page size of 0 with the current cookie tells the server to release the paged search
+            paged_search_control.setSize(0)
+            with contextlib.suppress(Exception):
+                ldap_connection.sendReceive(search_request, [paged_search_control])
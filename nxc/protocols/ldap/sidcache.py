@@ -0,0 +1,96 @@
+from threading import Lock
+
+from nxc.protocols.ldap.search import paged_search
+
+# Attributes fetched for every security principal stored in the cache
+principal_attributes = ["objectSid", "sAMAccountName", "sAMAccountType", "distinguishedName"]
+
+# sAMAccountType values, same mapping as BloodHound's ADUtils.resolve_ad_entry()
+group_account_types = {"268435456", "268435457", "536870912", "536870913"}
+account_types = {"805306368": "user", "805306369": "computer", "805306370": "trustaccount"}
+
+sid_caches = {}
+sid_caches_lock = Lock()
+
+
+def get_sid_cache(domain):
+    """Returns the SID cache of the domain, shared by every module and connection of the process"""
+    with sid_caches_lock:
+        return sid_caches.setdefault(domain.lower(), SIDCache(domain))
+
+
+def sid_to_str(sid):
+    """Converts a binary SID to its string representation"""
+    revision = sid[0]
+    sub_authorities = sid[1]
+    identifier_authority = int.from_bytes(sid[2:8], byteorder="big")
+    if identifier_authority >= 2**32:
+        identifier_authority = hex(identifier_authority)
+    sub_authority = "".join(f"-{int.from_bytes(sid[8 + (i * 4): 12 + (i * 4)], byteorder='little')}" for i in range(sub_authorities))
+    return f"S-{revision}-{identifier_authority}{sub_authority}"
+
+
+class SIDCache:
+    """SID -> security principal cache of a domain.
+
+    Principals are dicts with the "sid", "name" (sAMAccountName), "dn" and "type" (user, computer, group...) of the object.
+    SIDs that are not in the cache are resolved in batches, one OR-filter search per `batch_size` SIDs.
+    SIDs that could not be resolved are cached too, so they are only looked up once.
+    """
+
+    def __init__(self, domain, batch_size=50):
+        self.domain = domain
+        self.batch_size = batch_size
+        self.principals = {}
+        self.prefilled = False
+        self.lock = Lock()
+
+    def add_entry(self, entry):
+        """Stores an entry returned by paged_search() with at least the objectSid attribute, returns the principal"""
+        sid = sid_to_str(entry["objectsid"][0])
+        account_type = entry.get("samaccounttype", [""])[0]
+        principal = {
+            "sid": sid,
+            "name": entry.get("samaccountname", [""])[0],
+            "dn": entry["dn"],
+            "type": "group" if account_type in group_account_types else account_types.get(account_type, "base"),
+        }
+        with self.lock:
+            self.principals[sid] = principal
+        return principal
+
+    def prefill(self, ldap_connection):
+        """Loads every security principal of the domain with a single paged search"""
+        if self.prefilled:
+            return
+        for entry in paged_search(ldap_connection, "(sAMAccountType=*)", principal_attributes):
+            self.add_entry(entry)
+        self.prefilled = True
+
+    def resolve(self, ldap_connection, sids):
+        """Returns a {sid: principal} dict of the given SIDs, the principal is None if the SID does not exist in the domain"""
+        sids = set(sids)
+        with self.lock:
+            missing = [sid for sid in sids if sid not in self.principals]
+        if not self.prefilled:
+            for i in range(0, len(missing), self.batch_size):
+                search_filter = "(|{})".format("".join(f"(objectSid={sid})" for sid in missing[i:i + self.batch_size]))
+                for entry in paged_search(ldap_connection, search_filter, principal_attributes):
+                    self.add_entry(entry)
+        with self.lock:
+            for sid in missing:
+                self.principals.setdefault(sid, None)
+            return {sid: self.principals[sid] for sid in sids}
+
+    def lookup(self, ldap_connection, sid):
+        """Resolves a single SID, see resolve()"""
+        return self.resolve(ldap_connection, [sid])[sid]
+
+    def bloodhound_items(self):
+        """Returns the cached users, computers and groups in the format of BloodHound's SID cache (AD.newsidcache)"""
+        with self.lock:
+            return {
+                sid: {"ObjectIdentifier": sid, "ObjectType": principal["type"].capitalize()}
+                for sid, principal in self.principals.items()
+                if principal and principal["type"] in ("user", "computer", "group")
+            }
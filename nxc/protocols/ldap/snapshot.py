@@ -0,0 +1,237 @@
+import json
+import os
+import sqlite3
+import time
+from base64 import b64decode, b64encode
+from pathlib import Path
+from threading import Lock, local
+
+from impacket.ldap import ldapasn1 as ldapasn1_impacket
+
+from nxc.protocols.ldap.filter import compile_filter, parse_filter
+from nxc.protocols.ldap.search import binary_attributes, paged_search
+
+SNAPSHOT_VERSION = 2
+# Objects inserted per executemany() while dumping
+INSERT_BATCH = 1000
+
+snapshots = {}
+snapshots_lock = Lock()
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE info (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE objects (
+    id INTEGER PRIMARY KEY,
+    dn TEXT NOT NULL,
+    dn_key TEXT NOT NULL,
+    parent_key TEXT NOT NULL,
+    samaccountname TEXT,
+    category TEXT,
+    attributes TEXT NOT NULL
+);
+CREATE TABLE object_classes (object_id INTEGER NOT NULL, object_class TEXT NOT NULL);
+"""
+# Created once the objects are inserted
+SNAPSHOT_INDEXES = """
+CREATE INDEX objects_dn ON objects(dn_key);
+CREATE INDEX objects_parent ON objects(parent_key);
+CREATE INDEX objects_samaccountname ON objects(samaccountname);
+CREATE INDEX objects_category ON objects(category);
+CREATE INDEX object_classes_class ON object_classes(object_class, object_id);
+"""
+
+
+def encode_value(name, value):
+    """Keeps UTF-8 values as str, binary values are stored as {"b64": ...}"""
+    if name.lower() not in binary_attributes:
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    return {"b64": b64encode(value).decode()}
+
+
+def category_key(value):
+    """(objectCategory=person) matches CN=Person,CN=Schema,..., objects are indexed by the lower-cased class name"""
+    return value.split(",")[0].partition("=")[2].lower() if "=" in value else value.lower()
+
+
+def object_row(dn, attributes_dict):
+    """Returns the objects row of an entry and its lower-cased object classes"""
+    values = {name.lower(): values for name, values in attributes_dict.items()}
+    samaccountname = next((value for value in values.get("samaccountname", []) if isinstance(value, str)), None)
+    category = next((value for value in values.get("objectcategory", []) if isinstance(value, str)), None)
+    row = (
+        dn,
+        dn.lower(),
+        dn.partition(",")[2].lower(),
+        samaccountname.lower() if samaccountname is not None else None,
+        category_key(category) if category is not None else None,
+        json.dumps(attributes_dict, separators=(",", ":")),
+    )
+    return row, {value.lower() for value in values.get("objectclass", []) if isinstance(value, str)}
+
+
+def write_snapshot(ldap_connection, path, info, attributes=("*",)):
+    """Streams the default and configuration naming contexts into a SQLite snapshot file, returns the number of objects.
+
+    Every object is a row of `objects` keyed by DN with its attributes as JSON ({name: [values]}, binary values as {"b64": ...}),
+    indexed by DN, parent DN, sAMAccountName, objectCategory and objectClass. `info` (baseDN, domain, ...) goes to the `info` table.
+    The file is written under a temporary name and only replaces `path` once the dump is complete.
+    """
+    naming_contexts = [ldap_connection._baseDN]
+    for entry in ldap_connection.search(searchBase="", scope=ldapasn1_impacket.Scope("baseObject"), attributes=["configurationNamingContext"]):
+        if isinstance(entry, ldapasn1_impacket.SearchResultEntry):
+            naming_contexts += [str(value) for attribute in entry["attributes"] for value in attribute["vals"]]
+
+    count = 0
+    # lower-cased name -> name as returned by the server
+    attribute_names = {}
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.executescript(SNAPSHOT_SCHEMA)
+        rows = []
+
+        def insert_rows():
+            for row, object_classes in rows:
+                object_id = db.execute("INSERT INTO objects (dn, dn_key, parent_key, samaccountname, category, attributes) VALUES (?, ?, ?, ?, ?, ?)", row).lastrowid
+                db.executemany("INSERT INTO object_classes VALUES (?, ?)", [(object_id, object_class) for object_class in object_classes])
+            rows.clear()
+
+        for naming_context in naming_contexts:
+            for entry in paged_search(ldap_connection, "(objectClass=*)", list(attributes), search_base=naming_context, raw=True):
+                attributes_dict = {}
+                for attribute in entry["attributes"]:
+                    name = str(attribute["type"])
+                    attribute_names.setdefault(name.lower(), name)
+                    attributes_dict[name] = [encode_value(name, value.asOctets()) for value in attribute["vals"]]
+                rows.append(object_row(str(entry["objectName"]), attributes_dict))
+                count += 1
+                if len(rows) >= INSERT_BATCH:
+                    insert_rows()
+        insert_rows()
+        db.executescript(SNAPSHOT_INDEXES)
+        snapshot_info = {"snapshot": SNAPSHOT_VERSION, "created": time.time(), "naming_contexts": naming_contexts, "objects": count, "attribute_names": attribute_names, **info}
+        db.executemany("INSERT INTO info VALUES (?, ?)", [(name, json.dumps(value)) for name, value in snapshot_info.items()])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+    return count
+
+
+def get_snapshot(path):
+    """Returns the LDAPSnapshot of the file, each file is only opened once per process"""
+    path = os.path.abspath(os.path.expanduser(path))
+    with snapshots_lock:
+        if path not in snapshots:
+            snapshots[path] = LDAPSnapshot(path)
+        return snapshots[path]
+
+
+def index_conditions(node):
+    """Returns SQL conditions on the indexed columns that every entry matching the parsed filter satisfies.
+
+    Only the equality assertions of the filter itself or of its top-level AND are used, the filter is evaluated on the selected rows anyway.
+    """
+    conditions = []
+    for child in node[1] if node[0] == "and" else [node]:
+        if child[0] != "eq" or not isinstance(child[2], str):
+            continue
+        attribute, value = child[1], child[2]
+        if attribute == "samaccountname":
+            conditions.append(("samaccountname = ?", value.lower()))
+        elif attribute == "objectcategory":
+            conditions.append(("category = ?", category_key(value)))
+        elif attribute == "distinguishedname":
+            conditions.append(("dn_key = ?", value.lower()))
+        elif attribute == "objectclass":
+            conditions.append(("id IN (SELECT object_id FROM object_classes WHERE object_class = ?)", value.lower()))
+    return conditions
+
+
+class LDAPSnapshot:
+    """Offline directory stored in a write_snapshot() file, usable in place of impacket's LDAPConnection.
+
+    search() answers with SearchResultEntry objects like impacket does and search_entries() with entry_to_dict() style dicts,
+    the filters are evaluated locally so the existing enumeration methods and modules run without a DC.
+    The objects stay on disk: a search only reads the rows selected by the indexed attributes of its filter, one at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Every thread reads the file through its own connection
+        self.local = local()
+        try:
+            self.info = {name: json.loads(value) for name, value in self.db.execute("SELECT name, value FROM info")}
+        except sqlite3.Error as e:
+            raise ValueError(f"{path} is not an LDAP snapshot: {e}") from e
+        if self.info.get("snapshot") != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not an LDAP snapshot")
+        # lower-cased name -> name as returned by the server
+        self.attribute_names = self.info["attribute_names"]
+        self._baseDN = self.info["baseDN"]
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(f"{Path(self.path).as_uri()}?mode=ro", uri=True)
+        return db
+
+    def close(self):
+        pass
+
+    def search_entries(self, search_filter="(objectClass=*)", attributes=None, size_limit=0, search_base=None, scope=2):
+        """Yields the entries matching the filter under search_base, restricted to the requested attributes"""
+        matches = compile_filter(search_filter)
+        base = (search_base if search_base is not None else self._baseDN).lower()
+        conditions = index_conditions(parse_filter(search_filter))
+        if scope == 0:
+            conditions.append(("dn_key = ?", base))
+        elif scope == 1:
+            conditions.append(("parent_key = ?", base))
+        where = " AND ".join(condition for condition, _ in conditions) or "1"
+        wanted = {attribute.lower() for attribute in attributes or []}
+        all_attributes = not wanted or "*" in wanted
+        count = 0
+        for dn, dn_key, attributes_json in self.db.execute(f"SELECT dn, dn_key, attributes FROM objects WHERE {where} ORDER BY id", [value for _, value in conditions]):
+            if scope == 2 and base and dn_key != base and not dn_key.endswith(f",{base}"):
+                continue
+            # AD returns distinguishedName with "*", it is added for dumps made with an explicit attribute list
+            entry = {"dn": dn, "distinguishedname": [dn]}
+            for name, values in json.loads(attributes_json).items():
+                entry[name.lower()] = [b64decode(value["b64"]) if isinstance(value, dict) else value for value in values]
+            if not matches(entry):
+                continue
+            yield entry if all_attributes else {name: values for name, values in entry.items() if name == "dn" or name in wanted}
+            count += 1
+            if size_limit and count >= size_limit:
+                return
+
+    def search(self, searchBase=None, scope=None, derefAliases=None, sizeLimit=0, timeLimit=0, typesOnly=False, searchFilter="(objectClass=*)", attributes=None, searchControls=None, perRecordCallback=None):
+        """Same interface as impacket's LDAPConnection.search(), the controls are ignored"""
+        scope = int(ldapasn1_impacket.Scope("wholeSubtree") if scope is None else scope)
+        # Attributes are returned with the spelling of the request, like AD does
+        requested = {attribute.lower(): attribute for attribute in attributes or []}
+        answers = []
+        for entry in self.search_entries(searchFilter, attributes, sizeLimit, searchBase, scope):
+            result = ldapasn1_impacket.SearchResultEntry()
+            result["objectName"] = entry["dn"]
+            partial_attributes = []
+            for name, values in entry.items():
+                if name == "dn":
+                    continue
+                attribute = ldapasn1_impacket.PartialAttribute()
+                attribute["type"] = requested.get(name, self.attribute_names.get(name, name))
+                attribute["vals"].setComponents(*[ldapasn1_impacket.AttributeValue(value if isinstance(value, bytes) else value.encode("utf-8")) for value in values])
+                partial_attributes.append(attribute)
+            result["attributes"].setComponents(*partial_attributes)
+            if perRecordCallback is None:
+                answers.append(result)
+            else:
+                perRecordCallback(result)
+        return answers
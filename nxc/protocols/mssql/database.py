@@ -9,6 +9,7 @@ from sqlalchemy.exc import (
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import SAWarning
 import warnings
+from nxc.database import BatchedWriter, SessionProxy, background_write, queued_write
 from nxc.logger import nxc_logger
 import sys
 
@@ -30,8 +31,9 @@ class database:
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
+        self.writer = BatchedWriter(self.db_engine)
         # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        self.conn = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -84,6 +86,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.conn.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -92,10 +95,12 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.conn.execute(table.delete())
 
+    @background_write
     def add_host(self, ip, hostname, domain, os, instances):
         """
         Check if this host has already been added to the database, if not, add it in.
@@ -144,6 +149,7 @@ class database:
         q = q.on_conflict_do_update(index_elements=self.HostsTable.primary_key, set_=update_columns)
         self.conn.execute(q, hosts)
 
+    @queued_write
     def add_credential(self, credtype, domain, username, password, pillaged_from=None):
         """Check if this credential has already been added to the database, if not add it in."""
         user_rowid = None
@@ -187,6 +193,7 @@ class database:
         nxc_logger.debug(f"add_credential(credtype={credtype}, domain={domain}, username={username}, password={password}, pillaged_from={pillaged_from})")
         return user_rowid
 
+    @queued_write
     def remove_credentials(self, creds_id):
         """Removes a credential ID from the database"""
         del_hosts = []
@@ -195,6 +202,7 @@ class database:
             del_hosts.append(q)
         self.conn.execute(q)
 
+    @background_write
     def add_admin_user(self, credtype, domain, username, password, host, user_id=None):
         if user_id:
             q = select(self.UsersTable).filter(self.UsersTable.c.id == user_id)
@@ -239,6 +247,7 @@ class database:
 
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_admin_relation(self, user_ids=None, host_ids=None):
         q = delete(self.AdminRelationsTable)
         if user_ids:
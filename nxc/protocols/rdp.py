@@ -1,12 +1,15 @@
 import asyncio
+import contextlib
 import os
 from datetime import datetime
 from os import getenv
+from struct import pack, unpack
 from termcolor import colored
 
 from impacket.krb5.ccache import CCache
 
 from nxc.connection import connection
+from nxc.helpers import eventloop
 from nxc.helpers.bloodhound import add_user_bh
 from nxc.logger import NXCAdapter
 from nxc.config import host_info_colors
@@ -16,12 +19,15 @@ from aardwolf.connection import RDPConnection
 from aardwolf.commons.queuedata.constants import VIDEO_FORMAT
 from aardwolf.commons.iosettings import RDPIOSettings
 from aardwolf.commons.target import RDPTarget
-from aardwolf.protocol.x224.constants import SUPP_PROTOCOLS
+from aardwolf.protocol.x224.constants import FAIL_CODE, SUPP_PROTOCOLS
 from asyauth.common.credentials.ntlm import NTLMCredential
 from asyauth.common.credentials.kerberos import KerberosCredential
 from asyauth.common.constants import asyauthSecret
 from asysocks.unicomm.common.target import UniTarget, UniProto
 
+# RDP_NEG_RSP and RDP_NEG_FAILURE types of the X.224 Connection Confirm
+TYPE_RDP_NEG_RSP = 2
+TYPE_RDP_NEG_FAILURE = 3
 
 class rdp(connection):
     def __init__(self, args, db, host):
@@ -31,18 +37,6 @@ class rdp(connection):
         self.iosettings.channels = []
         self.iosettings.video_out_format = VIDEO_FORMAT.RAW
         self.iosettings.clipboard_use_pyperclip = False
-        self.protoflags_nla = [
-            SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.RDP,
-            SUPP_PROTOCOLS.SSL,
-            SUPP_PROTOCOLS.RDP,
-        ]
-        self.protoflags = [
-            SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.RDP,
-            SUPP_PROTOCOLS.SSL,
-            SUPP_PROTOCOLS.RDP,
-            SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.HYBRID,
-            SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.HYBRID_EX,
-        ]
         width, height = args.res.upper().split("X")
         height = int(height)
         width = int(width)
@@ -104,39 +98,27 @@ class rdp(connection):
             self.logger.display(f"{self.server_os} (name:{self.hostname}) (domain:{self.domain}) ({nla})")
         return True
 
+    def fingerprint_attrs(self):
+        return ("hostname", "domain", "server_os", "nla")
+
     def create_conn_obj(self):
         self.target = RDPTarget(ip=self.host, domain="FAKE", port=self.port, timeout=self.args.rdp_timeout)
         self.auth = NTLMCredential(secret="pass", username="user", domain="FAKE", stype=asyauthSecret.PASS)
 
-        self.check_nla()
-
-        for proto in reversed(self.protoflags):
+        if not self.load_fingerprint():
             try:
-                self.iosettings.supported_protocols = proto
-                self.conn = RDPConnection(
-                    iosettings=self.iosettings,
-                    target=self.target,
-                    credentials=self.auth,
-                )
-                asyncio.run(self.connect_rdp())
-            except OSError as e:
-                if "Errno 104" not in str(e):
-                    return False
-            except Exception as e:
-                if "TCPSocket" in str(e):
-                    return False
-                if "Reason:" not in str(e):
-                    try:
-                        info_domain = self.conn.get_extra_info()
-                    except Exception:
-                        pass
-                    else:
-                        self.domain = info_domain["dnsdomainname"]
-                        self.hostname = info_domain["computername"]
-                        self.server_os = info_domain["os_guess"] + " Build " + str(info_domain["os_build"])
-                        self.logger.extra["hostname"] = self.hostname
-                        self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
-                    break
+                negotiation = self.check_nla()
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                self.logger.debug(f"X.224 negotiation with {self.host} failed: {e}")
+                return False
+            # Servers without negotiation (older than Vista) or without TLS have no CredSSP to get the NTLM challenge from
+            if negotiation and (negotiation[0] == TYPE_RDP_NEG_RSP or negotiation == (TYPE_RDP_NEG_FAILURE, FAIL_CODE.HYBRID_REQUIRED_BY_SERVER.value)):
+                self.get_ntlm_info()
+            self.save_fingerprint()
+
+        if self.server_os is not None:
+            self.logger.extra["hostname"] = self.hostname
+            self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
 
         if self.args.domain:
             self.domain = self.args.domain
@@ -156,7 +138,43 @@ class rdp(connection):
         return True
 
     def check_nla(self):
-        for proto in self.protoflags_nla:
+        """Asks for TLS without CredSSP in a single X.224 negotiation, servers requiring NLA refuse with HYBRID_REQUIRED_BY_SERVER.
+
+        Returns the negotiation response like negotiate() does.
+        """
+        negotiation = eventloop.run(self.negotiate(SUPP_PROTOCOLS.SSL), self.host, self.args.host_concurrency)
+        self.nla = negotiation == (TYPE_RDP_NEG_FAILURE, FAIL_CODE.HYBRID_REQUIRED_BY_SERVER.value)
+        return negotiation
+
+    async def negotiate(self, requested_protocols):
+        """Sends a bare X.224 Connection Request, returns the (type, value) of the negotiation response or None if the server sent none.
+
+        value is the selected protocol of a RDP_NEG_RSP or the failure code of a RDP_NEG_FAILURE.
+        """
+
+        async def exchange():
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                # TPKT header, X.224 Connection Request and RDP_NEG_REQ
+                neg_req = pack("<BBHI", 1, 0, 8, int(requested_protocols))
+                x224 = bytes([6 + len(neg_req), 0xE0, 0, 0, 0, 0, 0]) + neg_req
+                writer.write(pack(">BBH", 3, 0, 4 + len(x224)) + x224)
+                await writer.drain()
+                header = await reader.readexactly(4)
+                return await reader.readexactly(unpack(">H", header[2:])[0] - 4)
+            finally:
+                writer.close()
+
+        data = await asyncio.wait_for(exchange(), timeout=self.args.rdp_timeout)
+        # X.224 Connection Confirm: length, CC code, DST-REF, SRC-REF, class, then the optional negotiation response
+        if len(data) < 15 or data[1] & 0xF0 != 0xD0:
+            return None
+        neg_type, _, _, value = unpack("<BBHI", data[7:15])
+        return neg_type, value
+
+    def get_ntlm_info(self):
+        """Reads the hostname, domain and OS build from the NTLM challenge of a CredSSP authentication with fake credentials"""
+        for proto in (SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.HYBRID_EX, SUPP_PROTOCOLS.SSL | SUPP_PROTOCOLS.HYBRID):
             try:
                 self.iosettings.supported_protocols = proto
                 self.conn = RDPConnection(
@@ -164,18 +182,39 @@ class rdp(connection):
                     target=self.target,
                     credentials=self.auth,
                 )
-                asyncio.run(self.connect_rdp())
-                if str(proto) == "SUPP_PROTOCOLS.RDP" or str(proto) == "SUPP_PROTOCOLS.SSL" or str(proto) == "SUPP_PROTOCOLS.SSL|SUPP_PROTOCOLS.RDP":
-                    self.nla = False
+                self.run_async(self.connect_rdp())
+            except Exception as e:
+                if "TCPSocket" in str(e) or "Reason:" in str(e):
+                    continue
+                try:
+                    info_domain = self.conn.get_extra_info()
+                except Exception:
                     return
-            except Exception:
-                pass
+                self.domain = info_domain["dnsdomainname"]
+                self.hostname = info_domain["computername"]
+                self.server_os = info_domain["os_guess"] + " Build " + str(info_domain["os_build"])
+                return
 
     async def connect_rdp(self):
         _, err = await asyncio.wait_for(self.conn.connect(), timeout=self.args.rdp_timeout)
         if err is not None:
             raise err
 
+    async def close_conn(self):
+        if self.conn is not None:
+            with contextlib.suppress(Exception):
+                await asyncio.wait_for(self.conn.terminate(), timeout=self.args.rdp_timeout)
+
+    async def closing(self, coro):
+        try:
+            return await coro
+        finally:
+            await self.close_conn()
+
+    def run_async(self, coro):
+        """Runs the coroutine on the event loop shared by all the threads and closes the RDP connection it leaves open"""
+        return eventloop.run(self.closing(coro), self.host, self.args.host_concurrency)
+
     def kerberos_login(self, domain, username, password="", ntlm_hash="", aesKey="", kdcHost="", useCache=False):
         try:
             lmhash = ""
@@ -219,7 +258,7 @@ class rdp(connection):
                 stype=stype,
             )
             self.conn = RDPConnection(iosettings=self.iosettings, target=self.target, credentials=self.auth)
-            asyncio.run(self.connect_rdp())
+            self.run_async(self.connect_rdp())
 
             self.admin_privs = True
             self.logger.success(
@@ -275,7 +314,7 @@ class rdp(connection):
                 stype=asyauthSecret.PASS,
             )
             self.conn = RDPConnection(iosettings=self.iosettings, target=self.target, credentials=self.auth)
-            asyncio.run(self.connect_rdp())
+            self.run_async(self.connect_rdp())
 
             self.admin_privs = True
             self.logger.success(f"{domain}\\{username}:{process_secret(password)} {self.mark_pwned()}")
@@ -309,7 +348,7 @@ class rdp(connection):
                 stype=asyauthSecret.NT,
             )
             self.conn = RDPConnection(iosettings=self.iosettings, target=self.target, credentials=self.auth)
-            asyncio.run(self.connect_rdp())
+            self.run_async(self.connect_rdp())
 
             self.admin_privs = True
             self.logger.success(f"{self.domain}\\{username}:{process_secret(ntlm_hash)} {self.mark_pwned()}")
@@ -350,7 +389,7 @@ class rdp(connection):
             self.logger.highlight(f"Screenshot saved {filename}")
 
     def screenshot(self):
-        asyncio.run(self.screen())
+        self.run_async(self.screen())
 
     async def nla_screen(self):
         # Otherwise it crash
@@ -368,4 +407,4 @@ class rdp(connection):
 
     def nla_screenshot(self):
         if not self.nla:
-            asyncio.run(self.nla_screen())
+            self.run_async(self.nla_screen())
@@ -7,11 +7,12 @@ from sqlalchemy.exc import (
     NoInspectionAvailable,
     NoSuchTableError,
 )
+from nxc.database import BatchedWriter, SessionProxy, queued_write, FingerprintCache, fingerprints_schema
 from nxc.logger import nxc_logger
 import sys
 
 
-class database:
+class database(FingerprintCache):
     def __init__(self, db_engine):
         self.CredentialsTable = None
         self.HostsTable = None
@@ -20,12 +21,14 @@ class database:
         self.db_path = self.db_engine.url.database
         self.protocol = Path(self.db_path).stem.upper()
         self.metadata = MetaData()
+        self.migrate_fingerprints()
         self.reflect_tables()
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
+        self.writer = BatchedWriter(self.db_engine)
         # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        self.conn = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -47,12 +50,14 @@ class database:
             "server_banner" text
             )"""
         )
+        db_conn.execute(fingerprints_schema)
 
     def reflect_tables(self):
         with self.db_engine.connect():
             try:
                 self.CredentialsTable = Table("credentials", self.metadata, autoload_with=self.db_engine)
                 self.HostsTable = Table("hosts", self.metadata, autoload_with=self.db_engine)
+                self.FingerprintsTable = Table("fingerprints", self.metadata, autoload_with=self.db_engine)
             except (NoInspectionAvailable, NoSuchTableError):
                 print(
                     f"""
@@ -64,6 +69,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.conn.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -72,6 +78,7 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.conn.execute(table.delete())
@@ -4,6 +4,7 @@ def proto_args(parser, std_parser, module_parser):
     rdp_parser.add_argument("--port", type=int, default=3389, help="Custom RDP port")
     rdp_parser.add_argument("--rdp-timeout", type=int, default=5, help="RDP timeout on socket connection, defalut is %(default)ss")
     rdp_parser.add_argument("--nla-screenshot", action="store_true", help="Screenshot RDP login prompt if NLA is disabled")
+    rdp_parser.add_argument("--host-concurrency", type=int, default=1, metavar="CONNECTIONS", help="Maximum number of simultaneous connections to the same host, all the connections run on one shared event loop (default: %(default)s)")
 
     dgroup = rdp_parser.add_mutually_exclusive_group()
     dgroup.add_argument("-d", metavar="DOMAIN", dest="domain", type=str, default=None, help="domain to authenticate to")
@@ -19,7 +19,6 @@ from impacket.dcerpc.v5.rpcrt import DCERPCException
 from impacket.dcerpc.v5.transport import DCERPCTransportFactory, SMBTransport
 from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_GSS_NEGOTIATE
 from impacket.dcerpc.v5.epm import MSRPC_UUID_PORTMAP
-from impacket.dcerpc.v5.samr import SID_NAME_USE
 from impacket.dcerpc.v5.dtypes import MAXIMUM_ALLOWED
 from impacket.krb5.kerberosv5 import SessionKeyDecryptionError
 from impacket.krb5.types import KerberosException, Principal
@@ -29,7 +28,7 @@ from impacket.dcerpc.v5.dcomrt import DCOMConnection
 from impacket.dcerpc.v5.dcom.wmi import CLSID_WbemLevel1Login, IID_IWbemLevel1Login, IWbemLevel1Login
 
 from nxc.config import process_secret, host_info_colors
-from nxc.connection import connection, sem, requires_admin, dcom_FirewallChecker
+from nxc.connection import connection, requires_admin, dcom_FirewallChecker
 from nxc.helpers.misc import gen_random_string, validate_ntlm
 from nxc.logger import NXCAdapter
 from nxc.protocols.smb.firefox import FirefoxTriage
@@ -43,6 +42,8 @@ from nxc.protocols.smb.smbspider import SMBSpider
 from nxc.protocols.smb.passpol import PassPolDump
 from nxc.protocols.smb.samruser import UserSamrDump
 from nxc.protocols.smb.samrfunc import SamrFunc
+from nxc.protocols.smb.ridbrute import RIDBrute
+from nxc.protocols.smb.probe import probe_host
 from nxc.protocols.ldap.gmsa import MSDS_MANAGEDPASSWORD_BLOB
 from nxc.helpers.logger import highlight
 from nxc.helpers.bloodhound import add_user_bh
@@ -65,9 +66,11 @@ from traceback import format_exc
 import logging
 from termcolor import colored
 import contextlib
+from threading import Lock
 
 smb_share_name = gen_random_string(5).upper()
 smb_server = None
+relay_list_lock = Lock()
 
 smb_error_status = [
     "STATUS_ACCOUNT_DISABLED",
@@ -199,9 +202,53 @@ class smb(connection):
 
         return 0
 
+    def fingerprint_attrs(self):
+        return ("hostname", "domain", "server_os", "os_arch", "no_ntlm")
+
+    def fingerprint_complete(self):
+        # without NTLM the hostname and domain are the target and --domain, not values of the host
+        return not self.no_ntlm and super().fingerprint_complete()
+
+    @staticmethod
+    async def probe(args, db, target):
+        """Connects, negotiates and fingerprints the host on the event loop, see nxc/protocols/smb/probe.py"""
+        if args.port != 445:
+            # NetBIOS session service, the probe only speaks direct TCP
+            return {}
+        fingerprint = args.refresh_fingerprint or args.fingerprint_ttl <= 0 or not db.get_fingerprint(target, args.port, args.protocol, args.fingerprint_ttl)
+        return await probe_host(target, args.port, args.smb_timeout, fingerprint)
+
     def enum_host_info(self):
         self.local_ip = self.conn.getSMBServer().get_socket().getsockname()[0]
 
+        # signing comes with the negotiate response of the connection, no extra round-trip
+        try:
+            self.signing = self.conn.isSigningRequired() if self.smbv1 else self.conn._SMBConnection._Connection["RequireSigning"]
+        except Exception as e:
+            self.logger.debug(e)
+
+        if not self.load_fingerprint():
+            self.fingerprint_host()
+            self.save_fingerprint()
+        # signing and SMBv1 come from this connection, not from the cached fingerprint, so the host row is always updated
+        self.db.add_host(
+            self.host,
+            self.hostname,
+            self.domain,
+            self.server_os,
+            self.smbv1,
+            self.signing,
+        )
+        self.logger.extra["hostname"] = self.hostname
+        self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
+
+        if self.args.domain:
+            self.domain = self.args.domain
+        if self.args.local_auth:
+            self.domain = self.hostname
+
+    def fingerprint_host(self):
+        """Anonymous login and DCERPC bind to gather the host information"""
         try:
             self.conn.login("", "")
         except BrokenPipeError:
@@ -214,42 +261,21 @@ class smb(connection):
         self.domain = self.conn.getServerDNSDomainName() if not self.no_ntlm else self.args.domain
         self.hostname = self.conn.getServerName() if not self.no_ntlm else self.host
         self.server_os = self.conn.getServerOS()
-        self.logger.extra["hostname"] = self.hostname
 
         if isinstance(self.server_os.lower(), bytes):
             self.server_os = self.server_os.decode("utf-8")
 
-        try:
-            self.signing = self.conn.isSigningRequired() if self.smbv1 else self.conn._SMBConnection._Connection["RequireSigning"]
-        except Exception as e:
-            self.logger.debug(e)
-
         self.os_arch = self.get_os_arch()
-        self.output_filename = os.path.expanduser(f"~/.nxc/logs/{self.hostname}_{self.host}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}".replace(":", "-"))
 
         if not self.domain:
             self.domain = self.hostname
 
-        self.db.add_host(
-            self.host,
-            self.hostname,
-            self.domain,
-            self.server_os,
-            self.smbv1,
-            self.signing,
-        )
-
         try:
             # DCs seem to want us to logoff first, windows workstations sometimes reset the connection
             self.conn.logoff()
         except Exception as e:
             self.logger.debug(f"Error logging off system: {e}")
 
-        if self.args.domain:
-            self.domain = self.args.domain
-        if self.args.local_auth:
-            self.domain = self.hostname
-
     def print_host_info(self):
         signing = colored(f"signing:{self.signing}", host_info_colors[0], attrs=["bold"]) if self.signing else colored(f"signing:{self.signing}", host_info_colors[1], attrs=["bold"])
         smbv1 = colored(f"SMBv1:{self.smbv1}", host_info_colors[2], attrs=["bold"]) if self.smbv1 else colored(f"SMBv1:{self.smbv1}", host_info_colors[3], attrs=["bold"])
@@ -258,10 +284,8 @@ class smb(connection):
 
     def kerberos_login(self, domain, username, password="", ntlm_hash="", aesKey="", kdcHost="", useCache=False):
         logging.getLogger("impacket").disabled = True
-        # Re-connect since we logged off
         kdc_host = f"{self.hostname}.{self.domain}" if not self.no_ntlm else f"{self.host}"
         self.logger.debug(f"KDC set to: {kdc_host}")
-        self.create_conn_obj(kdc_host)
         lmhash = ""
         nthash = ""
 
@@ -294,7 +318,7 @@ class smb(connection):
                 tgs = kerberos_login_with_S4U(domain, self.hostname, username, password, nthash, lmhash, aesKey, kdcHost, self.args.delegate, serverName, useCache, no_s4u2proxy=self.args.no_s4u2proxy)
                 self.logger.debug(f"Got TGS for {self.args.delegate} through S4U")
 
-            self.conn.kerberosLogin(self.username, password, domain, lmhash, nthash, aesKey, kdcHost, useCache=useCache, TGS=tgs)
+            self.session_setup("kerberosLogin", self.username, password, domain, lmhash, nthash, aesKey, kdcHost, useCache=useCache, TGS=tgs, kdc_host=kdc_host)
             self.check_if_admin()
 
             if username == "":
@@ -352,14 +376,12 @@ class smb(connection):
             return False
 
     def plaintext_login(self, domain, username, password):
-        # Re-connect since we logged off
-        self.create_conn_obj()
         try:
             self.password = password
             self.username = username
             self.domain = domain
 
-            self.conn.login(self.username, self.password, domain)
+            self.session_setup("login", self.username, self.password, domain)
 
             self.check_if_admin()
             self.logger.debug(f"Adding credential: {domain}/{self.username}:{self.password}")
@@ -409,8 +431,6 @@ class smb(connection):
             return False
 
     def hash_login(self, domain, username, ntlm_hash):
-        # Re-connect since we logged off
-        self.create_conn_obj()
         lmhash = ""
         nthash = ""
         try:
@@ -428,7 +448,7 @@ class smb(connection):
             if nthash:
                 self.nthash = nthash
 
-            self.conn.login(self.username, "", domain, lmhash, nthash)
+            self.session_setup("login", self.username, "", domain, lmhash, nthash)
 
             self.check_if_admin()
             user_id = self.db.add_credential("hash", domain, self.username, nthash)
@@ -513,8 +533,36 @@ class smb(connection):
         return True
 
     def create_conn_obj(self, kdc_host=None):
+        if not kdc_host and self.probe_result.get("smbv1") is False:
+            # the probe already tried the SMBv1 negotiate
+            return self.create_smbv3_conn()
         return bool(self.create_smbv1_conn(kdc_host) or self.create_smbv3_conn(kdc_host))
 
+    def conn_reusable(self, remote_host):
+        """True if the negotiated SMB2/3 connection to remote_host has no active session, i.e. the last SESSION_SETUP failed or was logged off.
+
+        SMBv1 connections are always renegotiated.
+        """
+        if self.conn is None or self.conn.getDialect() == SMB_DIALECT or self.conn.getRemoteHost() != remote_host:
+            return False
+        return self.conn._SMBConnection._Session["SessionID"] == 0
+
+    def session_setup(self, method, *args, kdc_host=None, **kwargs):
+        """Runs the SESSION_SETUP (`login` or `kerberosLogin`) of a credential attempt.
+
+        The TCP connection and negotiate are only redone when the current connection can't be reused,
+        or when the server dropped it after the previous attempt.
+        """
+        if not self.conn_reusable(kdc_host if kdc_host else self.host):
+            self.create_conn_obj(kdc_host)
+            return getattr(self.conn, method)(*args, **kwargs)
+        try:
+            return getattr(self.conn, method)(*args, **kwargs)
+        except (OSError, NetBIOSError, NetBIOSTimeout) as e:
+            self.logger.debug(f"Reused connection was closed by the server, reconnecting: {e}")
+            self.create_conn_obj(kdc_host)
+            return getattr(self.conn, method)(*args, **kwargs)
+
     def check_if_admin(self):
         rpctransport = SMBTransport(self.conn.getRemoteHost(), 445, r"\svcctl", smb_connection=self.conn)
         dce = rpctransport.get_dce_rpc()
@@ -535,7 +583,7 @@ class smb(connection):
 
     def gen_relay_list(self):
         if self.server_os.lower().find("windows") != -1 and self.signing is False:
-            with sem, open(self.args.gen_relay_list, "a+") as relay_list:
+            with relay_list_lock, open(self.args.gen_relay_list, "a+") as relay_list:
                 if self.host not in relay_list.read():
                     relay_list.write(self.host + "\n")
 
@@ -1135,57 +1183,58 @@ class smb(connection):
 
         return spider.results
 
-    def rid_brute(self, max_rid=None):
-        entries = []
-        if not max_rid:
-            max_rid = int(self.args.rid_brute)
-
+    def lsarpc_binding(self):
+        """Opens an LSARPC binding and a policy handle with lookup rights, returns (dce, policy_handle)"""
         KNOWN_PROTOCOLS = {
             135: {"bindstr": r"ncacn_ip_tcp:%s", "set_host": False},
             139: {"bindstr": r"ncacn_np:{}[\pipe\lsarpc]", "set_host": True},
             445: {"bindstr": r"ncacn_np:{}[\pipe\lsarpc]", "set_host": True},
         }
 
-        try:
-            full_hostname = self.host if not self.kerberos else self.hostname + "." + self.domain
-            string_binding = KNOWN_PROTOCOLS[self.port]["bindstr"]
-            logging.debug(f"StringBinding {string_binding}")
-            rpc_transport = transport.DCERPCTransportFactory(string_binding)
-            rpc_transport.set_dport(self.port)
+        full_hostname = self.host if not self.kerberos else self.hostname + "." + self.domain
+        string_binding = KNOWN_PROTOCOLS[self.port]["bindstr"]
+        logging.debug(f"StringBinding {string_binding}")
+        rpc_transport = transport.DCERPCTransportFactory(string_binding)
+        rpc_transport.set_dport(self.port)
 
-            if KNOWN_PROTOCOLS[self.port]["set_host"]:
-                rpc_transport.setRemoteHost(full_hostname)
+        if KNOWN_PROTOCOLS[self.port]["set_host"]:
+            rpc_transport.setRemoteHost(full_hostname)
 
-            if hasattr(rpc_transport, "set_credentials"):
-                # This method exists only for selected protocol sequences.
-                rpc_transport.set_credentials(self.username, self.password, self.domain, self.lmhash, self.nthash, self.aesKey)
+        if hasattr(rpc_transport, "set_credentials"):
+            # This method exists only for selected protocol sequences.
+            rpc_transport.set_credentials(self.username, self.password, self.domain, self.lmhash, self.nthash, self.aesKey)
 
-            if self.kerberos:
-                rpc_transport.set_kerberos(self.kerberos, self.kdcHost)
+        if self.kerberos:
+            rpc_transport.set_kerberos(self.kerberos, self.kdcHost)
 
-            dce = rpc_transport.get_dce_rpc()
-            if self.kerberos:
-                dce.set_auth_type(RPC_C_AUTHN_GSS_NEGOTIATE)
-
-            dce.connect()
-        except Exception as e:
-            self.logger.fail(f"Error creating DCERPC connection: {e}")
-            return entries
-
-        # Want encryption? Uncomment next line
-        # But make simultaneous variable <= 100
-
-        # Want fragmentation? Uncomment next line
+        dce = rpc_transport.get_dce_rpc()
+        if self.kerberos:
+            dce.set_auth_type(RPC_C_AUTHN_GSS_NEGOTIATE)
 
+        dce.connect()
         dce.bind(lsat.MSRPC_UUID_LSAT)
         try:
             resp = lsad.hLsarOpenPolicy2(dce, MAXIMUM_ALLOWED | lsat.POLICY_LOOKUP_NAMES)
+        except Exception:
+            dce.disconnect()
+            raise
+        return dce, resp["PolicyHandle"]
+
+    def rid_brute(self, max_rid=None):
+        entries = []
+        if not max_rid:
+            max_rid = int(self.args.rid_brute)
+
+        try:
+            bindings = [self.lsarpc_binding()]
         except lsad.DCERPCSessionError as e:
             self.logger.fail(f"Error connecting: {e}")
             return entries
+        except Exception as e:
+            self.logger.fail(f"Error creating DCERPC connection: {e}")
+            return entries
 
-        policy_handle = resp["PolicyHandle"]
-
+        dce, policy_handle = bindings[0]
         resp = lsad.hLsarQueryInformationPolicy2(
             dce,
             policy_handle,
@@ -1193,43 +1242,31 @@ class smb(connection):
         )
         domain_sid = resp["PolicyInformation"]["PolicyAccountDomainInfo"]["DomainSid"].formatCanonical()
 
-        so_far = 0
-        simultaneous = 1000
-        for _j in range(max_rid // simultaneous + 1):
-            sids_to_check = (max_rid - so_far) % simultaneous if (max_rid - so_far) // simultaneous == 0 else simultaneous
-
-            if sids_to_check == 0:
+        # No point in opening more pipes than there are initial batches to look up
+        for _ in range(min(self.args.rid_brute_pipes, -(-max_rid // 1000)) - 1):
+            try:
+                bindings.append(self.lsarpc_binding())
+            except Exception as e:
+                self.logger.debug(f"Could not open an additional LSARPC binding: {e}")
                 break
 
-            sids = [f"{domain_sid}-{i:d}" for i in range(so_far, so_far + sids_to_check)]
-            try:
-                lsat.hLsarLookupSids(dce, policy_handle, sids, lsat.LSAP_LOOKUP_LEVEL.LsapLookupWksta)
-            except DCERPCException as e:
-                if str(e).find("STATUS_NONE_MAPPED") >= 0:
-                    so_far += simultaneous
-                    continue
-                elif str(e).find("STATUS_SOME_NOT_MAPPED") >= 0:
-                    resp = e.get_packet()
-                else:
-                    raise
+        def store(found):
+            for entry in found:
+                self.logger.highlight(f"{entry['rid']}: {entry['domain']}\\{entry['username']} ({entry['sidtype']})")
+                if entry["sidtype"] == "SidTypeUser":
+                    # no password, so an existing credential of the account is left untouched
+                    self.db.add_credential("plaintext", entry["domain"], entry["username"], None)
+                elif entry["sidtype"] in ("SidTypeGroup", "SidTypeAlias"):
+                    self.db.add_group(entry["domain"], entry["username"], rid=entry["rid"])
 
-            for n, item in enumerate(resp["TranslatedNames"]["Names"]):
-                if item["Use"] != SID_NAME_USE.SidTypeUnknown:
-                    rid = so_far + n
-                    domain = resp["ReferencedDomains"]["Domains"][item["DomainIndex"]]["Name"]
-                    user = item["Name"]
-                    sid_type = SID_NAME_USE.enumItems(item["Use"]).name
-                    self.logger.highlight(f"{rid}: {domain}\\{user} ({sid_type})")
-                    entries.append(
-                        {
-                            "rid": rid,
-                            "domain": domain,
-                            "username": user,
-                            "sidtype": sid_type,
-                        }
-                    )
-            so_far += simultaneous
-        dce.disconnect()
+        rid_brute = RIDBrute(bindings, domain_sid, max_rid, empty_run=self.args.rid_brute_empty, on_results=store)
+        try:
+            entries = rid_brute.run()
+        except Exception as e:
+            self.logger.fail(f"Error looking up RIDs: {e}")
+            entries = sorted(rid_brute.entries, key=lambda entry: entry["rid"])
+        for dce, _ in bindings:
+            dce.disconnect()
         return entries
 
     def put_file(self):
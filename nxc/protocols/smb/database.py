@@ -3,7 +3,7 @@ import warnings
 from datetime import datetime
 from pathlib import Path
 
-from sqlalchemy import MetaData, func, Table, select, delete
+from sqlalchemy import MetaData, func, Table, select, delete, update
 from sqlalchemy.dialects.sqlite import Insert  # used for upsert
 from sqlalchemy.exc import (
     IllegalStateChangeError,
@@ -13,6 +13,7 @@ from sqlalchemy.exc import (
 from sqlalchemy.exc import SAWarning
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from nxc.database import BatchedWriter, SessionProxy, background_write, queued_write, create_indexes, FingerprintCache, fingerprints_schema
 from nxc.logger import nxc_logger
 import sys
 from typing import Optional
@@ -20,8 +21,17 @@ from typing import Optional
 # if there is an issue with SQLAlchemy and a connection cannot be cleaned up properly it spews out annoying warnings
 warnings.filterwarnings("ignore", category=SAWarning)
 
+# (name, table, columns, unique) - the lookup columns used to deduplicate hosts, credentials and relations
+db_indexes = [
+    ("ix_hosts_ip", "hosts", "ip", True),
+    ("ix_users_identity", "users", "lower(domain), lower(username), lower(credtype)", True),
+    ("ix_admin_relations_link", "admin_relations", "userid, hostid", True),
+    ("ix_loggedin_relations_link", "loggedin_relations", "userid, hostid", True),
+    ("ix_group_relations_link", "group_relations", "userid, groupid", False),
+]
 
-class database:
+
+class database(FingerprintCache):
     def __init__(self, db_engine):
         self.HostsTable = None
         self.UsersTable = None
@@ -35,16 +45,26 @@ class database:
         self.DpapiBackupkey = None
         self.DpapiSecrets = None
 
+        # in-process dedup indexes, only ever modified from the writer thread
+        self.host_index = {}  # ip -> host ids
+        self.user_index = {}  # (domain, username, credtype) lower-cased -> user ids
+        self.admin_index = set()  # (userid, hostid)
+
         self.db_engine = db_engine
         self.db_path = self.db_engine.url.database
         self.protocol = Path(self.db_path).stem.upper()
         self.metadata = MetaData()
+        self.migrate_schema()
         self.reflect_tables()
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
+        self.writer = BatchedWriter(self.db_engine)
         # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        self.conn = SessionProxy(Session(), self.writer)
+        # the indexes hold the ids of inserted rows, reload them when those rows are rolled back
+        self.writer.on_rollback = self.warm_indexes
+        self.warm_indexes()
 
     @staticmethod
     def db_schema(db_conn):
@@ -166,6 +186,8 @@ class database:
             UNIQUE(domain)
         )"""
         )
+        db_conn.execute(fingerprints_schema)
+        create_indexes(db_conn.execute, db_indexes)
         # db_conn.execute('''CREATE TABLE "ntds_dumps" (
         #    "id" integer PRIMARY KEY,
         #    "hostid", integer,
@@ -175,6 +197,31 @@ class database:
         #    FOREIGN KEY(hostid) REFERENCES hosts(id)
         #    )''')
 
+    def migrate_schema(self):
+        """Adds the lookup indexes to workspaces that were created before they were part of the schema"""
+        with self.db_engine.connect() as conn:
+            try:
+                create_indexes(conn.exec_driver_sql, db_indexes)
+            except Exception as e:
+                nxc_logger.debug(f"Error creating indexes for the {self.protocol} database: {e}")
+        self.migrate_fingerprints()
+
+    @queued_write
+    def warm_indexes(self):
+        """Loads the dedup keys of the existing hosts, credentials and admin relations into memory"""
+        self.host_index.clear()
+        self.user_index.clear()
+        self.admin_index.clear()
+        for host_id, ip in self.conn.execute(select(self.HostsTable.c.id, self.HostsTable.c.ip)):
+            self.host_index.setdefault(ip, set()).add(host_id)
+        for user_id, domain, username, credtype in self.conn.execute(select(self.UsersTable.c.id, self.UsersTable.c.domain, self.UsersTable.c.username, self.UsersTable.c.credtype)):
+            self.user_index.setdefault(self.user_key(domain, username, credtype), set()).add(user_id)
+        self.admin_index.update(tuple(link) for link in self.conn.execute(select(self.AdminRelationsTable.c.userid, self.AdminRelationsTable.c.hostid)))
+
+    @staticmethod
+    def user_key(domain, username, credtype):
+        return tuple(value.lower() if isinstance(value, str) else value for value in (domain, username, credtype))
+
     def reflect_tables(self):
         with self.db_engine.connect():
             try:
@@ -189,6 +236,7 @@ class database:
                 self.DpapiBackupkey = Table("dpapi_backupkey", self.metadata, autoload_with=self.db_engine)
                 self.ConfChecksTable = Table("conf_checks", self.metadata, autoload_with=self.db_engine)
                 self.ConfChecksResultsTable = Table("conf_checks_results", self.metadata, autoload_with=self.db_engine)
+                self.FingerprintsTable = Table("fingerprints", self.metadata, autoload_with=self.db_engine)
             except (NoInspectionAvailable, NoSuchTableError):
                 print(
                     f"""
@@ -200,6 +248,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.conn.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -208,11 +257,16 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.conn.execute(table.delete())
+        self.host_index.clear()
+        self.user_index.clear()
+        self.admin_index.clear()
 
     # pull/545
+    @background_write
     def add_host(
         self,
         ip,
@@ -226,15 +280,29 @@ class database:
         petitpotam=None,
         dc=None,
     ):
-        """Check if this host has already been added to the database, if not, add it in."""
-        hosts = []
-        updated_ids = []
+        """Check if this host has already been added to the database, if not, add it in.
 
-        q = select(self.HostsTable).filter(self.HostsTable.c.ip == ip)
-        results = self.conn.execute(q).all()
+        A host of the warmed index is updated by id, any other one is inserted directly. Only when the insert hits
+        the UNIQUE index on ip (a row this process does not know about) is the host looked up and updated.
+        """
+        # only update column if it is being passed in
+        host_data = {
+            key: value
+            for key, value in {
+                "hostname": hostname,
+                "domain": domain,
+                "os": os,
+                "smbv1": smbv1,
+                "signing": signing,
+                "spooler": spooler,
+                "zerologon": zerologon,
+                "petitpotam": petitpotam,
+                "dc": dc,
+            }.items()
+            if value is not None
+        }
 
-        # create new host
-        if not results:
+        if ip not in self.host_index:
             new_host = {
                 "ip": ip,
                 "hostname": hostname,
@@ -247,67 +315,35 @@ class database:
                 "zerologon": zerologon,
                 "petitpotam": petitpotam,
             }
-            hosts = [new_host]
-        # update existing hosts data
-        else:
-            for host in results:
-                host_data = host._asdict()
-                # only update column if it is being passed in
-                if ip is not None:
-                    host_data["ip"] = ip
-                if hostname is not None:
-                    host_data["hostname"] = hostname
-                if domain is not None:
-                    host_data["domain"] = domain
-                if os is not None:
-                    host_data["os"] = os
-                if smbv1 is not None:
-                    host_data["smbv1"] = smbv1
-                if signing is not None:
-                    host_data["signing"] = signing
-                if spooler is not None:
-                    host_data["spooler"] = spooler
-                if zerologon is not None:
-                    host_data["zerologon"] = zerologon
-                if petitpotam is not None:
-                    host_data["petitpotam"] = petitpotam
-                if dc is not None:
-                    host_data["dc"] = dc
-                # only add host to be updated if it has changed
-                if host_data not in hosts:
-                    hosts.append(host_data)
-                    updated_ids.append(host_data["id"])
-        nxc_logger.debug(f"Update Hosts: {hosts}")
-
-        # TODO: find a way to abstract this away to a single Upsert call
-        q = Insert(self.HostsTable)  # .returning(self.HostsTable.c.id)
-        update_columns = {col.name: col for col in q.excluded if col.name not in "id"}
-        q = q.on_conflict_do_update(index_elements=self.HostsTable.primary_key, set_=update_columns)
-
-        self.conn.execute(q, hosts)  # .scalar()
-        # we only return updated IDs for now - when RETURNING clause is allowed we can return inserted
-        if updated_ids:
-            nxc_logger.debug(f"add_host() - Host IDs Updated: {updated_ids}")
-            return updated_ids
+            nxc_logger.debug(f"Adding host: {new_host}")
+            result = self.conn.execute(Insert(self.HostsTable).on_conflict_do_nothing(), [new_host])
+            if result.rowcount:
+                self.host_index[ip] = {result.lastrowid}
+                return
+            self.host_index[ip] = {host_id for host_id, in self.conn.execute(select(self.HostsTable.c.id).filter(self.HostsTable.c.ip == ip))}
+
+        updated_ids = list(self.host_index[ip])
+        if host_data:
+            nxc_logger.debug(f"Update Hosts {updated_ids}: {host_data}")
+            if not self.conn.execute(update(self.HostsTable).filter(self.HostsTable.c.id.in_(updated_ids)).values(host_data)).rowcount:
+                # removed from the workspace since the index was warmed
+                del self.host_index[ip]
+                return self.add_host(ip, hostname, domain, os, smbv1, signing, spooler, zerologon, petitpotam, dc)
+        nxc_logger.debug(f"add_host() - Host IDs Updated: {updated_ids}")
+        return updated_ids
 
+    @queued_write
     def add_credential(self, credtype, domain, username, password, group_id=None, pillaged_from=None):
-        """Check if this credential has already been added to the database, if not add it in."""
-        credentials = []
-        groups = []
+        """Check if this credential has already been added to the database, if not add it in.
 
+        Like add_host(), a credential of the warmed index is updated by id and any other one is inserted directly.
+        """
         if (group_id and not self.is_group_valid(group_id)) or (pillaged_from and not self.is_host_valid(pillaged_from)):
             nxc_logger.debug("Invalid group or host")
             return
 
-        q = select(self.UsersTable).filter(
-            func.lower(self.UsersTable.c.domain) == func.lower(domain),
-            func.lower(self.UsersTable.c.username) == func.lower(username),
-            func.lower(self.UsersTable.c.credtype) == func.lower(credtype),
-        )
-        results = self.conn.execute(q).all()
-
-        # add new credential
-        if not results:
+        user_key = self.user_key(domain, username, credtype)
+        if user_key not in self.user_index:
             new_cred = {
                 "credtype": credtype,
                 "domain": domain,
@@ -316,43 +352,42 @@ class database:
                 "groupid": group_id,
                 "pillaged_from": pillaged_from,
             }
-            credentials = [new_cred]
-        # update existing cred data
-        else:
-            for creds in results:
-                # this will include the id, so we don't touch it
-                cred_data = creds._asdict()
-                # only update column if it is being passed in
-                if credtype is not None:
-                    cred_data["credtype"] = credtype
-                if domain is not None:
-                    cred_data["domain"] = domain
-                if username is not None:
-                    cred_data["username"] = username
-                if password is not None:
-                    cred_data["password"] = password
-                if group_id is not None:
-                    cred_data["groupid"] = group_id
-                    groups.append({"userid": cred_data["id"], "groupid": group_id})
-                if pillaged_from is not None:
-                    cred_data["pillaged_from"] = pillaged_from
-                # only add cred to be updated if it has changed
-                if cred_data not in credentials:
-                    credentials.append(cred_data)
-
-        # TODO: find a way to abstract this away to a single Upsert call
-        q_users = Insert(self.UsersTable)  # .returning(self.UsersTable.c.id)
-        update_columns_users = {col.name: col for col in q_users.excluded if col.name not in "id"}
-        q_users = q_users.on_conflict_do_update(index_elements=self.UsersTable.primary_key, set_=update_columns_users)
-        nxc_logger.debug(f"Adding credentials: {credentials}")
-
-        self.conn.execute(q_users, credentials)  # .scalar()
+            nxc_logger.debug(f"Adding credentials: {new_cred}")
+            result = self.conn.execute(Insert(self.UsersTable).on_conflict_do_nothing(), [new_cred])
+            if result.rowcount:
+                self.user_index[user_key] = {result.lastrowid}
+                return
+            q = select(self.UsersTable.c.id).filter(
+                func.lower(self.UsersTable.c.domain) == func.lower(domain),
+                func.lower(self.UsersTable.c.username) == func.lower(username),
+                func.lower(self.UsersTable.c.credtype) == func.lower(credtype),
+            )
+            self.user_index[user_key] = {user_id for user_id, in self.conn.execute(q)}
 
-        if groups:
-            q_groups = Insert(self.GroupRelationsTable)
+        # only update column if it is being passed in
+        cred_data = {
+            key: value
+            for key, value in {
+                "credtype": credtype,
+                "domain": domain,
+                "username": username,
+                "password": password,
+                "groupid": group_id,
+                "pillaged_from": pillaged_from,
+            }.items()
+            if value is not None
+        }
+        user_ids = list(self.user_index[user_key])
+        nxc_logger.debug(f"Updating credentials {user_ids}: {cred_data}")
+        if not self.conn.execute(update(self.UsersTable).filter(self.UsersTable.c.id.in_(user_ids)).values(cred_data)).rowcount:
+            # removed from the workspace since the index was warmed
+            del self.user_index[user_key]
+            return self.add_credential(credtype, domain, username, password, group_id, pillaged_from)
 
-            self.conn.execute(q_groups, groups)
+        if group_id is not None:
+            self.conn.execute(Insert(self.GroupRelationsTable), [{"userid": user_id, "groupid": group_id} for user_id in user_ids])
 
+    @queued_write
     def remove_credentials(self, creds_id):
         """Removes a credential ID from the database"""
         del_hosts = []
@@ -360,7 +395,10 @@ class database:
             q = delete(self.UsersTable).filter(self.UsersTable.c.id == cred_id)
             del_hosts.append(q)
         self.conn.execute(q)
+        removed_ids = {str(cred_id) for cred_id in creds_id}
+        self.user_index = {key: user_ids for key, user_ids in self.user_index.items() if not {str(user_id) for user_id in user_ids} & removed_ids}
 
+    @background_write
     def add_admin_user(self, credtype, domain, username, password, host, user_id=None):
         add_links = []
 
@@ -371,22 +409,14 @@ class database:
 
         if users and hosts:
             for user, host in zip(users, hosts):
-                user_id = user[0]
-                host_id = host[0]
-                link = {"userid": user_id, "hostid": host_id}
-                admin_relations_select = select(self.AdminRelationsTable).filter(
-                    self.AdminRelationsTable.c.userid == user_id,
-                    self.AdminRelationsTable.c.hostid == host_id,
-                )
-                links = self.conn.execute(admin_relations_select).all()
-
-                if not links:
-                    add_links.append(link)
-
-        admin_relations_insert = Insert(self.AdminRelationsTable)
+                link = (user[0], host[0])
+                # links of the warmed index already exist, the UNIQUE index on the link covers the rows it does not know
+                if link not in self.admin_index:
+                    add_links.append({"userid": link[0], "hostid": link[1]})
+                    self.admin_index.add(link)
 
         if add_links:
-            self.conn.execute(admin_relations_insert, add_links)
+            self.conn.execute(Insert(self.AdminRelationsTable).on_conflict_do_nothing(), add_links)
 
     def get_admin_relations(self, user_id=None, host_id=None):
         if user_id:
@@ -398,6 +428,7 @@ class database:
 
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_admin_relation(self, user_ids=None, host_ids=None):
         q = delete(self.AdminRelationsTable)
         if user_ids:
@@ -407,6 +438,8 @@ class database:
             for host_id in host_ids:
                 q = q.filter(self.AdminRelationsTable.c.hostid == host_id)
         self.conn.execute(q)
+        # the filters above can match any subset of the relations, just drop the whole cache
+        self.admin_index.clear()
 
     def is_credential_valid(self, credential_id):
         """Check if this credential ID is valid."""
@@ -505,6 +538,7 @@ class database:
 
         return valid
 
+    @queued_write
     def add_group(self, domain, name, rid=None, member_count_ad=None):
         results = self.get_groups(group_name=name, group_domain=domain)
 
@@ -604,6 +638,7 @@ class database:
 
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_group_relations(self, user_id=None, group_id=None):
         q = delete(self.GroupRelationsTable)
         if user_id:
@@ -647,6 +682,7 @@ class database:
         nxc_logger.debug(f"is_share_valid(shareID={share_id}) => {len(results) > 0}")
         return len(results) > 0
 
+    @background_write
     def add_share(self, host_id, user_id, name, remark, read, write):
         share_data = {
             "hostid": host_id,
@@ -692,6 +728,7 @@ class database:
         return self.conn.execute(q).all()
 
 
+    @queued_write
     def add_domain_backupkey(self, domain: str, pvk: bytes):
         """
         Add domain backupkey
@@ -740,6 +777,7 @@ class database:
         nxc_logger.debug(f"is_dpapi_secret_valid(groupID={dpapi_secret_id}) => {valid}")
         return valid
 
+    @background_write
     def add_dpapi_secrets(
         self,
         host: str,
@@ -802,6 +840,7 @@ class database:
         nxc_logger.debug(f"get_dpapi_secrets(filter_term={filter_term}, host={host}, dpapi_type={dpapi_type}, windows_user={windows_user}, username={username}, url={url}) => {results}")
         return results
 
+    @background_write
     def add_loggedin_relation(self, user_id, host_id):
         relation_query = select(self.LoggedinRelationsTable).filter(
             self.LoggedinRelationsTable.c.userid == user_id,
@@ -832,6 +871,7 @@ class database:
             q = q.filter(self.LoggedinRelationsTable.c.hostid == host_id)
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_loggedin_relations(self, user_id=None, host_id=None):
         q = delete(self.LoggedinRelationsTable)
         if user_id:
@@ -848,6 +888,7 @@ class database:
         q = select(self.ConfChecksResultsTable)
         return self.conn.execute(q).all()
 
+    @queued_write
     def insert_data(self, table, select_results=None, **new_row):
         """
         Insert a new row in the given table.
@@ -882,6 +923,7 @@ class database:
         # we only return updated IDs for now - when RETURNING clause is allowed we can return inserted
         return updated_ids
 
+    @queued_write
     def add_check(self, name, description):
         """Check if this check item has already been added to the database, if not, add it in."""
         q = select(self.ConfChecksTable).filter(self.ConfChecksTable.c.name == name)
@@ -894,6 +936,7 @@ class database:
             nxc_logger.debug(f"add_check() - Checks IDs Updated: {updated_ids}")
             return updated_ids
 
+    @background_write
     def add_check_result(self, host_id, check_id, secure, reasons):
         """Check if this check result has already been added to the database, if not, add it in."""
         q = select(self.ConfChecksResultsTable).filter(self.ConfChecksResultsTable.c.host_id == host_id, self.ConfChecksResultsTable.c.check_id == check_id)
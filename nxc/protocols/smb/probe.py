@@ -0,0 +1,197 @@
+import asyncio
+import os
+import struct
+
+from impacket import ntlm
+from impacket.dcerpc.v5.epm import MSRPC_UUID_PORTMAP
+from impacket.dcerpc.v5.rpcrt import MSRPC_BIND, MSRPC_BINDACK, CtxItem, MSRPCBind, MSRPCBindAck, MSRPCHeader
+from impacket.nt_errors import STATUS_MORE_PROCESSING_REQUIRED, STATUS_NOT_SUPPORTED, STATUS_SUCCESS
+from impacket.smb import SMB, NewSMBPacket, SMBCommand, SMBNTLMDialect_Parameters
+from impacket.smb3 import WIN_VERSIONS
+from impacket.smb3structs import (
+    SMB2_DIALECT_002,
+    SMB2_DIALECT_21,
+    SMB2_DIALECT_30,
+    SMB2_DIALECT_302,
+    SMB2_NEGOTIATE,
+    SMB2_NEGOTIATE_SIGNING_ENABLED,
+    SMB2_NEGOTIATE_SIGNING_REQUIRED,
+    SMB2_SESSION_SETUP,
+    SMB2Negotiate,
+    SMB2Negotiate_Response,
+    SMB2Packet,
+    SMB2SessionSetup,
+    SMB2SessionSetup_Response,
+)
+from impacket.spnego import SPNEGO_NegTokenInit, SPNEGO_NegTokenResp, TypesMech
+from impacket.uuid import uuidtup_to_bin
+
+from nxc.logger import nxc_logger
+
+# NDR64, only 64-bit Windows accepts it as the transfer syntax of the endpoint mapper
+NDR64_SYNTAX = ("71710533-BEBA-4937-8319-B5DBEF9CCC36", "1.0")
+# rpc_provider_reason "proposed_transfer_syntaxes_not_supported"
+TRANSFER_SYNTAXES_NOT_SUPPORTED = 2
+# Same timeout as smb.get_os_arch()
+OS_ARCH_TIMEOUT = 5
+
+
+async def open_connection(host, port, timeout):
+    return await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+
+async def close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+async def send_smb(reader, writer, data, timeout):
+    """Sends an SMB message over direct TCP and returns the next message, both framed by the 4-byte NetBIOS session header"""
+    writer.write(struct.pack(">L", len(data)) + data)
+    header = await asyncio.wait_for(reader.readexactly(4), timeout)
+    return await asyncio.wait_for(reader.readexactly(struct.unpack(">L", header)[0] & 0xFFFFFF), timeout)
+
+
+async def negotiate_smbv1(host, port, timeout):
+    """True if the host accepts the SMBv1 NT LM 0.12 dialect, what smb.create_smbv1_conn() would negotiate"""
+    try:
+        reader, writer = await open_connection(host, port, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        packet = NewSMBPacket()
+        packet["Flags2"] = SMB.FLAGS2_EXTENDED_SECURITY | SMB.FLAGS2_NT_STATUS | SMB.FLAGS2_LONG_NAMES | SMB.FLAGS2_UNICODE
+        negotiate = SMBCommand(SMB.SMB_COM_NEGOTIATE)
+        negotiate["Data"] = b"\x02NT LM 0.12\x00"
+        packet.addCommand(negotiate)
+        resp = NewSMBPacket(data=await send_smb(reader, writer, packet.getData(), timeout))
+        if resp["Command"] != SMB.SMB_COM_NEGOTIATE or resp["ErrorCode"] != 0:
+            return False
+        return SMBNTLMDialect_Parameters(SMBCommand(resp["Data"][0])["Parameters"])["DialectIndex"] != 0xFFFF
+    except Exception as e:
+        nxc_logger.debug(f"SMBv1 negotiate of {host}:{port} failed: {e}")
+        return False
+    finally:
+        await close(writer)
+
+
+async def fingerprint_smbv3(reader, writer, timeout):
+    """Negotiates SMB2/3 and reads the NTLM challenge of an anonymous SESSION_SETUP, like smb.fingerprint_host() does.
+
+    The session is never completed, the connection is closed by the caller after the challenge.
+    Returns the fingerprint attributes of the smb protocol, or only {"no_ntlm": True} when the server refuses NTLM.
+    """
+    packet = SMB2Packet()
+    packet["Command"] = SMB2_NEGOTIATE
+    packet["CreditRequestResponse"] = 1
+    negotiate = SMB2Negotiate()
+    negotiate["SecurityMode"] = SMB2_NEGOTIATE_SIGNING_ENABLED
+    negotiate["ClientGuid"] = os.urandom(16)
+    negotiate["Dialects"] = [SMB2_DIALECT_002, SMB2_DIALECT_21, SMB2_DIALECT_30, SMB2_DIALECT_302]
+    negotiate["DialectCount"] = len(negotiate["Dialects"])
+    packet["Data"] = negotiate
+    resp = SMB2Packet(await send_smb(reader, writer, packet.getData(), timeout))
+    if resp["Status"] != STATUS_SUCCESS:
+        raise ValueError(f"SMB2 negotiate status 0x{resp['Status']:08x}")
+    signing_required = bool(SMB2Negotiate_Response(resp["Data"])["SecurityMode"] & SMB2_NEGOTIATE_SIGNING_REQUIRED)
+
+    blob = SPNEGO_NegTokenInit()
+    blob["MechTypes"] = [TypesMech["NTLMSSP - Microsoft NTLM Security Support Provider"]]
+    blob["MechToken"] = ntlm.getNTLMSSPType1("", "", signing_required).getData()
+    session_setup = SMB2SessionSetup()
+    session_setup["SecurityMode"] = SMB2_NEGOTIATE_SIGNING_ENABLED
+    session_setup["SecurityBufferLength"] = len(blob)
+    session_setup["Buffer"] = blob.getData()
+    packet = SMB2Packet()
+    packet["Command"] = SMB2_SESSION_SETUP
+    packet["CreditRequestResponse"] = 1
+    packet["MessageID"] = 1
+    packet["Data"] = session_setup
+    resp = SMB2Packet(await send_smb(reader, writer, packet.getData(), timeout))
+    if resp["Status"] == STATUS_NOT_SUPPORTED:
+        return {"no_ntlm": True}
+    if resp["Status"] != STATUS_MORE_PROCESSING_REQUIRED:
+        raise ValueError(f"SMB2 session setup status 0x{resp['Status']:08x}")
+
+    challenge = ntlm.NTLMAuthChallenge(SPNEGO_NegTokenResp(SMB2SessionSetup_Response(resp["Data"])["Buffer"])["ResponseToken"])
+    av_pairs = ntlm.AV_PAIRS(challenge["TargetInfoFields"][: challenge["TargetInfoFields_len"]]) if challenge["TargetInfoFields_len"] else None
+    if av_pairs is None or av_pairs[ntlm.NTLMSSP_AV_HOSTNAME] is None:
+        raise ValueError("NTLM challenge without a computer name")
+    hostname = av_pairs[ntlm.NTLMSSP_AV_HOSTNAME][1].decode("utf-16le")
+    domain = av_pairs[ntlm.NTLMSSP_AV_DNS_DOMAINNAME][1].decode("utf-16le") if av_pairs[ntlm.NTLMSSP_AV_DNS_DOMAINNAME] is not None else ""
+
+    # Same OS string as impacket's SMB3.getServerOS()
+    server_os = ""
+    version = challenge.fields.get("Version", b"")
+    if len(version) >= 4:
+        build = struct.unpack("<H", version[2:4])[0]
+        server_os = f"{WIN_VERSIONS[build]} Build {build}" if build in WIN_VERSIONS else f"Windows {version[0]}.{version[1]} Build {build}"
+    return {"hostname": hostname, "domain": domain or hostname, "server_os": server_os, "no_ntlm": False}
+
+
+async def get_os_arch(host, timeout=OS_ARCH_TIMEOUT):
+    """Async smb.get_os_arch(): binds the endpoint mapper with NDR64, 64 if accepted, 32 if the syntax is refused, 0 if unknown"""
+    try:
+        reader, writer = await open_connection(host, 135, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return 0
+    try:
+        item = CtxItem()
+        item["AbstractSyntax"] = MSRPC_UUID_PORTMAP
+        item["TransferSyntax"] = uuidtup_to_bin(NDR64_SYNTAX)
+        item["ContextID"] = 0
+        item["TransItems"] = 1
+        bind = MSRPCBind()
+        bind.addCtxItem(item)
+        packet = MSRPCHeader()
+        packet["type"] = MSRPC_BIND
+        packet["pduData"] = bind.getData()
+        packet["call_id"] = 1
+        writer.write(packet.get_packet())
+        header = await asyncio.wait_for(reader.readexactly(16), timeout)
+        body = await asyncio.wait_for(reader.readexactly(struct.unpack("<H", header[8:10])[0] - 16), timeout)
+        resp = MSRPCHeader(header + body)
+        if resp["type"] != MSRPC_BINDACK:
+            return 0
+        result = MSRPCBindAck(resp.getData()).getCtxItem(1)
+        if result["Result"] == 0:
+            return 64
+        return 32 if result["Reason"] == TRANSFER_SYNTAXES_NOT_SUPPORTED else 0
+    except Exception as e:
+        nxc_logger.debug(f"Error retrieving os arch of {host}: {e}")
+        return 0
+    finally:
+        await close(writer)
+
+
+async def probe_host(host, port, timeout, fingerprint=True):
+    """Connect, negotiate and fingerprint stage of the smb protocol, run on the event loop before the target gets a thread.
+
+    Returns None if the port does not accept the connection. Otherwise returns whether SMBv1 is supported and, if
+    `fingerprint` is set and the host speaks SMB2/3 and answers the NTLM challenge, the fingerprint_attrs() of the smb protocol.
+    """
+    try:
+        reader, writer = await open_connection(host, port, timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        nxc_logger.debug(f"SMB probe of {host}:{port} could not connect: {e}")
+        return None
+    smbv1 = asyncio.ensure_future(negotiate_smbv1(host, port, timeout))
+    info = {}
+    try:
+        if fingerprint:
+            info = await fingerprint_smbv3(reader, writer, timeout)
+    except Exception as e:
+        nxc_logger.debug(f"SMB2 fingerprint of {host}:{port} failed: {e}")
+    finally:
+        await close(writer)
+
+    if await smbv1:
+        # SMBv1 hosts are fingerprinted over their SMBv1 connection, which reports a different OS string
+        return {"smbv1": True}
+    info["smbv1"] = False
+    if "hostname" in info:
+        info["os_arch"] = await get_os_arch(host)
+    return info
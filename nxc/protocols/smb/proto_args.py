@@ -44,6 +44,8 @@ def proto_args(parser, std_parser, module_parser):
     egroup.add_argument("--local-groups", nargs="?", const="", metavar="GROUP", help="enumerate local groups, if a group is specified then its members are enumerated")
     egroup.add_argument("--pass-pol", action="store_true", help="dump password policy")
     egroup.add_argument("--rid-brute", nargs="?", type=int, const=4000, metavar="MAX_RID", help="enumerate users by bruteforcing RID's (default: 4000)")
+    egroup.add_argument("--rid-brute-pipes", type=int, default=4, metavar="PIPES", help="number of LSARPC connections the RIDs are looked up over in parallel (default: 4)")
+    egroup.add_argument("--rid-brute-empty", type=int, default=10000, metavar="RIDS", help="stop the RID bruteforce after this many RIDs without result past the last one found, 0 to always go up to MAX_RID (default: 10000)")
     egroup.add_argument("--wmi", metavar="QUERY", type=str, help="issues the specified WMI query")
     egroup.add_argument("--wmi-namespace", metavar="NAMESPACE", default="root\\cimv2", help="WMI Namespace (default: root\\cimv2)")
 
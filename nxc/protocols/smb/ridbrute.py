@@ -0,0 +1,104 @@
+import time
+from threading import Lock, Thread
+
+from impacket.dcerpc.v5 import lsat
+from impacket.dcerpc.v5.rpcrt import DCERPCException
+from impacket.dcerpc.v5.samr import SID_NAME_USE
+
+# LSA_MAXIMUM_LOOKUP_SIDS_COUNT, the server rejects bigger LsarLookupSids requests
+MAX_BATCH = 20480
+MIN_BATCH = 50
+
+
+class RIDBrute:
+    """Looks up the RIDs of a domain SID with LsarLookupSids over several LSARPC bindings in parallel.
+
+    Every binding gets its own thread that claims the next range of RIDs each time its previous lookup is done.
+    The range size of a binding doubles while its lookups answer in less than half of `target_time` and is halved
+    when they take longer than `target_time`. A lookup the server rejects is split in two and retried.
+    The search stops at `max_rid`, or once `empty_run` RIDs past the highest RID found so far returned nothing.
+    """
+
+    def __init__(self, bindings, domain_sid, max_rid, empty_run=0, batch_size=1000, target_time=1.0, on_results=None):
+        # bindings: (dce, policy_handle) of each LSARPC connection
+        self.bindings = bindings
+        self.domain_sid = domain_sid
+        self.max_rid = max_rid
+        self.empty_run = empty_run
+        self.batch_size = max(MIN_BATCH, min(batch_size, MAX_BATCH))
+        self.target_time = target_time
+        self.on_results = on_results
+        self.next_rid = 0
+        self.last_found = 0
+        self.entries = []
+        self.error = None
+        self.lock = Lock()
+
+    def run(self):
+        """Returns the entries found ordered by RID, raises the first error of the bindings after the others are done"""
+        threads = [Thread(target=self.worker, args=binding, daemon=True) for binding in self.bindings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.entries.sort(key=lambda entry: entry["rid"])
+        if self.error:
+            raise self.error
+        return self.entries
+
+    def claim(self, size):
+        with self.lock:
+            if self.error or self.next_rid >= self.max_rid:
+                return None
+            if self.empty_run and self.next_rid - self.last_found > self.empty_run:
+                return None
+            start = self.next_rid
+            self.next_rid = min(self.max_rid, start + size)
+            return start, self.next_rid
+
+    def worker(self, dce, policy_handle):
+        batch_size = self.batch_size
+        try:
+            while rids := self.claim(batch_size):
+                start_time = time.monotonic()
+                entries, split = self.lookup(dce, policy_handle, *rids)
+                elapsed = time.monotonic() - start_time
+                if split or elapsed > self.target_time:
+                    batch_size = max(MIN_BATCH, batch_size // 2)
+                elif elapsed < self.target_time / 2:
+                    batch_size = min(MAX_BATCH, batch_size * 2)
+                if entries:
+                    with self.lock:
+                        self.entries += entries
+                        self.last_found = max(self.last_found, entries[-1]["rid"])
+                    if self.on_results:
+                        self.on_results(entries)
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+
+    def lookup(self, dce, policy_handle, start, end):
+        """Returns the entries of the RIDs start to end - 1 and whether the range had to be split"""
+        sids = [f"{self.domain_sid}-{rid:d}" for rid in range(start, end)]
+        try:
+            resp = lsat.hLsarLookupSids(dce, policy_handle, sids, lsat.LSAP_LOOKUP_LEVEL.LsapLookupWksta)
+        except DCERPCException as e:
+            if "STATUS_NONE_MAPPED" in str(e):
+                return [], False
+            if "STATUS_SOME_NOT_MAPPED" in str(e):
+                resp = e.get_packet()
+            elif end - start > MIN_BATCH:
+                middle = (start + end) // 2
+                first, _ = self.lookup(dce, policy_handle, start, middle)
+                second, _ = self.lookup(dce, policy_handle, middle, end)
+                return first + second, True
+            else:
+                raise
+
+        domains = [domain["Name"] for domain in resp["ReferencedDomains"]["Domains"]]
+        unknown = SID_NAME_USE.SidTypeUnknown
+        return [
+            {"rid": rid, "domain": domains[item["DomainIndex"]], "username": item["Name"], "sidtype": SID_NAME_USE.enumItems(item["Use"]).name}
+            for rid, item in zip(range(start, end), resp["TranslatedNames"]["Names"])
+            if item["Use"] != unknown
+        ], False
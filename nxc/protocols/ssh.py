@@ -1,16 +1,16 @@
 import paramiko
 import re
+import socket
 import uuid
 import logging
 import time
 
-from io import StringIO
 from nxc.config import process_secret
 from nxc.connection import connection, highlight
 from nxc.logger import NXCAdapter
+from nxc.protocols.ssh.keys import key_files, load_private_key
 from paramiko.ssh_exception import (
     AuthenticationException,
-    NoValidConnectionsError,
     SSHException,
 )
 
@@ -21,6 +21,10 @@ class ssh(connection):
         self.remote_version = "Unknown SSH Version"
         self.server_os_platform = "Linux"
         self.user_principal = "root"
+        # Transport kept between authentication attempts of the same user, see get_transport()
+        self.transport = None
+        self.transport_user = None
+        self.auth_attempts = 0
         super().__init__(args, db, host)
 
     def proto_flow(self):
@@ -32,12 +36,15 @@ class ssh(connection):
             if self.remote_version == "Unknown SSH Version":
                 self.conn.close()
                 return
-            if self.login():
-                if hasattr(self.args, "module") and self.args.module:
-                    self.call_modules()
-                else:
-                    self.call_cmd_args()
-                self.conn.close()
+            try:
+                if self.login():
+                    if hasattr(self.args, "module") and self.args.module:
+                        self.call_modules()
+                    else:
+                        self.call_cmd_args()
+                    self.conn.close()
+            finally:
+                self.close_transport()
 
     def proto_logger(self):
         logging.getLogger("paramiko").disabled = True
@@ -56,8 +63,6 @@ class ssh(connection):
         return True
 
     def enum_host_info(self):
-        if self.conn._transport.remote_version:
-            self.remote_version = self.conn._transport.remote_version
         self.logger.debug(f"Remote version: {self.remote_version}")
         self.db.add_host(self.host, self.port, self.remote_version)
 
@@ -65,15 +70,75 @@ class ssh(connection):
         self.conn = paramiko.SSHClient()
         self.conn.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
-            self.conn.connect(self.host, port=self.port, timeout=self.args.ssh_timeout, look_for_keys=False, allow_agent=False)
-        except AuthenticationException:
-            return True
-        except SSHException:
-            return True
-        except NoValidConnectionsError:
-            return False
+            remote_version = self.grab_banner()
         except OSError:
             return False
+        if remote_version:
+            self.remote_version = remote_version
+        return True
+
+    def grab_banner(self):
+        """Reads the identification string the server sends before the key exchange (RFC 4253 section 4.2), None if there is none"""
+        with socket.create_connection((self.host, self.port), timeout=self.args.ssh_timeout) as sock:
+            sock.sendall(f"SSH-2.0-{paramiko.Transport._CLIENT_ID}\r\n".encode())
+            banner = sock.makefile("rb")
+            # The server may send other lines before the identification string
+            for _ in range(50):
+                line = banner.readline(256)
+                if not line:
+                    return None
+                if line.startswith(b"SSH-"):
+                    return line.decode("utf-8", errors="replace").strip()
+        return None
+
+    def get_transport(self, username):
+        """Returns a Transport to authenticate username on.
+
+        The key exchange is the expensive part of a login attempt, so the Transport is kept for the next attempts until
+        --auth-tries failures were made on it or the server closed it. OpenSSH does not let the username change on a
+        connection, so a new user gets a new Transport.
+        """
+        if self.transport is not None and (not self.transport.is_active() or self.transport_user != username or self.auth_attempts >= self.args.auth_tries):
+            self.close_transport()
+        if self.transport is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.args.ssh_timeout)
+            transport = paramiko.Transport(sock)
+            try:
+                transport.start_client(timeout=self.args.ssh_timeout)
+            except Exception:
+                transport.close()
+                raise
+            self.transport = transport
+            self.transport_user = username
+            self.auth_attempts = 0
+        return self.transport
+
+    def close_transport(self):
+        if self.transport is not None and self.transport is not self.conn._transport:
+            self.transport.close()
+        self.transport = None
+
+    def authenticate(self, username, password=None, pkey=None):
+        """Authenticates on the shared Transport and hands it to self.conn, raises AuthenticationException on failure"""
+        for retry in (False, True):
+            transport = self.get_transport(username)
+            try:
+                if pkey is not None:
+                    transport.auth_publickey(username, pkey)
+                else:
+                    transport.auth_password(username, password)
+            except AuthenticationException:
+                self.auth_attempts += 1
+                # A server closing the connection after too many failures may not have checked this credential
+                if transport.is_active() or retry:
+                    raise
+            else:
+                # The authenticated Transport is not reused for other attempts, commands are run on it through self.conn
+                if self.conn._transport is not None:
+                    self.conn.close()
+                self.conn._transport = transport
+                self.transport = None
+                return
 
     def check_if_admin(self):
         self.admin_privs = False
@@ -186,25 +251,25 @@ class ssh(connection):
         self.username = username
         self.password = password
         private_key = ""
+        key_file = self.args.key_file
         stdout = None
         try:
             if self.args.key_file or private_key:
                 self.logger.debug("Logging in with key")
+                keys = key_files(self.args.key_file) if self.args.key_file else ((None, private_key),)
+                if not keys:
+                    raise SSHException(f"No private key found in {self.args.key_file}")
 
-                if self.args.key_file:
-                    with open(self.args.key_file) as f:
-                        private_key = f.read()
-
-                pkey = paramiko.RSAKey.from_private_key(StringIO(private_key))
-                self.conn.connect(
-                    self.host,
-                    port=self.port,
-                    username=username,
-                    passphrase=password if password != "" else None,
-                    pkey=pkey,
-                    look_for_keys=False,
-                    allow_agent=False,
-                )
+                # Every key of a directory is tried, the error of the last one is reported if none works
+                for index, (key_file, private_key) in enumerate(keys):
+                    try:
+                        pkey = load_private_key(private_key, password if password != "" else None)
+                        self.authenticate(username, pkey=pkey)
+                        break
+                    except (AuthenticationException, paramiko.PasswordRequiredException, SSHException, ValueError) as e:
+                        self.logger.debug(f"{username} with key {key_file}: {e}")
+                        if index == len(keys) - 1:
+                            raise
 
                 cred_id = self.db.add_credential(
                     "key",
@@ -215,14 +280,7 @@ class ssh(connection):
 
             else:
                 self.logger.debug(f"Logging {self.host} with username: {self.username}, password: {self.password}")
-                self.conn.connect(
-                    self.host,
-                    port=self.port,
-                    username=username,
-                    password=password,
-                    look_for_keys=False,
-                    allow_agent=False,
-                )
+                self.authenticate(username, password=password)
                 cred_id = self.db.add_credential("plaintext", username, password)
 
             # Some IOT devices will not raise exception in self.conn._transport.auth_password / self.conn._transport.auth_publickey
@@ -230,12 +288,11 @@ class ssh(connection):
             stdout = stdout.read().decode(self.args.codec, errors="ignore")
         except Exception as e:
             if self.args.key_file:
-                password = f"{process_secret(password)} (keyfile: {self.args.key_file})"
+                password = f"{process_secret(password)} (keyfile: {key_file})"
             if "OpenSSH private key file checkints do not match" in str(e):
                 self.logger.fail(f"{username}:{password} - Could not decrypt key file, wrong password")
             else:
                 self.logger.fail(f"{username}:{password} {e}")
-            self.conn.close()
             return False
         else:
             shell_access = False
@@ -280,7 +337,7 @@ class ssh(connection):
                         )
 
             if self.args.key_file:
-                password = f"{process_secret(password)} (keyfile: {self.args.key_file})"
+                password = f"{process_secret(password)} (keyfile: {key_file})"
 
             display_shell_access = "{} {} {}".format(
                 f"({self.user_principal})" if self.admin_privs else f"(non {self.user_principal})",
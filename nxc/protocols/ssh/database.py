@@ -11,6 +11,7 @@ import os
 from pathlib import Path
 import configparser
 
+from nxc.database import BatchedWriter, SessionProxy, background_write, queued_write
 from nxc.logger import nxc_logger
 from nxc.paths import NXC_PATH
 import sys
@@ -37,7 +38,8 @@ class database:
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
-        self.sess = Session()
+        self.writer = BatchedWriter(self.db_engine)
+        self.sess = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -106,6 +108,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.sess.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -114,10 +117,12 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.sess.execute(table.delete())
 
+    @background_write
     def add_host(self, host, port, banner, os=None):
         """Check if this host has already been added to the database, if not, add it in."""
         hosts = []
@@ -168,6 +173,7 @@ class database:
             nxc_logger.debug(f"add_host() - Host IDs Updated: {updated_ids}")
             return updated_ids
 
+    @queued_write
     def add_credential(self, credtype, username, password, key=None):
         """Check if this credential has already been added to the database, if not add it in."""
         credentials = []
@@ -232,6 +238,7 @@ class database:
         else:
             return credentials
 
+    @queued_write
     def remove_credentials(self, creds_id):
         """Removes a credential ID from the database"""
         del_hosts = []
@@ -240,6 +247,7 @@ class database:
             del_hosts.append(q)
         self.sess.execute(q)
 
+    @queued_write
     def add_key(self, cred_id, key):
         # check if key relation already exists
         check_q = self.sess.execute(select(self.KeysTable).filter(self.KeysTable.c.credid == cred_id)).all()
@@ -262,6 +270,7 @@ class database:
             q = q.filter(self.KeysTable.c.credid == cred_id)
         return self.sess.execute(q).all()
 
+    @background_write
     def add_admin_user(self, credtype, username, secret, host_id=None, cred_id=None):
         add_links = []
 
@@ -306,6 +315,7 @@ class database:
 
         return self.sess.execute(q).all()
 
+    @queued_write
     def remove_admin_relation(self, cred_ids=None, host_ids=None):
         q = delete(self.AdminRelationsTable)
         if cred_ids:
@@ -397,6 +407,7 @@ class database:
         q = select(self.CredentialsTable).filter(func.lower(self.CredentialsTable.c.username) == func.lower(username))
         return self.sess.execute(q).all()
 
+    @background_write
     def add_loggedin_relation(self, cred_id, host_id, shell=False):
         relation_query = select(self.LoggedinRelationsTable).filter(
             self.LoggedinRelationsTable.c.credid == cred_id,
@@ -429,6 +440,7 @@ class database:
             q = q.filter(self.LoggedinRelationsTable.c.shell == shell)
         return self.sess.execute(q).all()
 
+    @queued_write
     def remove_loggedin_relations(self, cred_id=None, host_id=None):
         q = delete(self.LoggedinRelationsTable)
         if cred_id:
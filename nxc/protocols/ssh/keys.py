@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+from base64 import b64decode
+from concurrent.futures import Future
+from functools import lru_cache
+from io import StringIO
+from threading import Lock
+
+import paramiko
+
+# Key type of the public key blob of OpenSSH keys -> PKey class
+openssh_key_types = {
+    "ssh-rsa": paramiko.RSAKey,
+    "ssh-ed25519": paramiko.Ed25519Key,
+    "ecdsa-sha2-nistp256": paramiko.ECDSAKey,
+    "ecdsa-sha2-nistp384": paramiko.ECDSAKey,
+    "ecdsa-sha2-nistp521": paramiko.ECDSAKey,
+}
+pem_key_types = {"RSA": paramiko.RSAKey, "EC": paramiko.ECDSAKey}
+all_key_classes = [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key]
+
+# Larger files in a key directory are not private keys
+MAX_KEY_SIZE = 64 * 1024
+
+# (sha256 of the key, passphrase) -> Future of the PKey
+parsed_keys = {}
+parsed_keys_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def key_files(path):
+    """Returns the (path, text) of the key file, or of every private key file of the directory, the files are read once per run"""
+    if not os.path.isdir(path):
+        with open(path) as f:
+            return ((path, f.read()),)
+    keys = []
+    for name in sorted(os.listdir(path)):
+        key_path = os.path.join(path, name)
+        if not os.path.isfile(key_path) or os.path.getsize(key_path) > MAX_KEY_SIZE:
+            continue
+        try:
+            with open(key_path) as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        if "PRIVATE KEY-----" in text:
+            keys.append((key_path, text))
+    return tuple(keys)
+
+
+def key_classes(text):
+    """Guesses the PKey class of the key from its unencrypted header, so the passphrase KDF only runs for the right class"""
+    header = re.search(r"-----BEGIN ([A-Z]+ )?PRIVATE KEY-----", text)
+    key_type = header.group(1).strip() if header and header.group(1) else None
+    if key_type == "OPENSSH":
+        try:
+            body = text[header.end():text.index("-----END")]
+            data = b64decode("".join(body.split()))
+            # openssh-key-v1 format: magic, cipher, kdf, kdf options, number of keys, then the unencrypted public keys
+            message = paramiko.Message(data[len(b"openssh-key-v1\x00"):])
+            for _ in range(3):
+                message.get_string()
+            message.get_int()
+            public_key_type = paramiko.Message(message.get_binary()).get_text()
+        except Exception:
+            return all_key_classes
+        return [openssh_key_types[public_key_type]] if public_key_type in openssh_key_types else all_key_classes
+    return [pem_key_types[key_type]] if key_type in pem_key_types else all_key_classes
+
+
+def parse_private_key(text, passphrase=None):
+    error = None
+    for key_class in key_classes(text):
+        try:
+            return key_class.from_private_key(StringIO(text), password=passphrase)
+        except paramiko.PasswordRequiredException:
+            raise
+        except (paramiko.SSHException, ValueError) as e:
+            error = e
+    raise error
+
+
+def load_private_key(text, passphrase=None):
+    """Returns the RSA, ECDSA or Ed25519 PKey of the private key text decrypted with passphrase.
+
+    Each (key, passphrase) is parsed once per run, concurrent callers wait for the first parsing. Failures (wrong
+    passphrase, unsupported key) are cached too and raised again to every caller.
+    """
+    cache_key = (hashlib.sha256(text.encode()).digest(), passphrase)
+    with parsed_keys_lock:
+        future = parsed_keys.get(cache_key)
+        owner = future is None
+        if owner:
+            future = parsed_keys[cache_key] = Future()
+    if owner:
+        try:
+            future.set_result(parse_private_key(text, passphrase))
+        except Exception as e:
+            future.set_exception(e)
+    return future.result()
@@ -1,10 +1,12 @@
 import asyncio
+import contextlib
 import os
 from datetime import datetime
 
 from aardwolf.commons.target import RDPTarget
 
 from nxc.connection import connection
+from nxc.helpers import eventloop
 from nxc.helpers.logger import highlight
 from nxc.logger import NXCAdapter
 from aardwolf.vncconnection import VNCConnection
@@ -53,7 +55,7 @@ class vnc(connection):
             self.target = RDPTarget(ip=self.host, port=self.port)
             credential = UniCredential(protocol=asyauthProtocol.PLAIN, stype=asyauthSecret.NONE)
             self.conn = VNCConnection(target=self.target, credentials=credential, iosettings=self.iosettings)
-            asyncio.run(self.connect_vnc(True))
+            self.run_async(self.connect_vnc(True))
         except Exception as e:
             self.logger.debug(str(e))
             if "Server supports:" not in str(e):
@@ -68,6 +70,21 @@ class vnc(connection):
             raise err
         return True
 
+    async def close_conn(self):
+        if self.conn is not None:
+            with contextlib.suppress(Exception):
+                await asyncio.wait_for(self.conn.terminate(), timeout=self.args.vnc_sleep + 5)
+
+    async def closing(self, coro):
+        try:
+            return await coro
+        finally:
+            await self.close_conn()
+
+    def run_async(self, coro):
+        """Runs the coroutine on the event loop shared by all the threads and closes the VNC connection it leaves open"""
+        return eventloop.run(self.closing(coro), self.host, self.args.host_concurrency)
+
     def plaintext_login(self, username, password):
         try:
             stype = asyauthSecret.PASS
@@ -79,7 +96,7 @@ class vnc(connection):
                 credentials=self.credential,
                 iosettings=self.iosettings,
             )
-            asyncio.run(self.connect_vnc())
+            self.run_async(self.connect_vnc())
 
             self.admin_privs = True
             self.logger.success(
@@ -114,4 +131,4 @@ class vnc(connection):
             self.logger.highlight(f"Screenshot saved {filename}")
 
     def screenshot(self):
-        asyncio.run(self.screen())
+        self.run_async(self.screen())
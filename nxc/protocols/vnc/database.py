@@ -8,6 +8,7 @@ from sqlalchemy.exc import (
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import SAWarning
 import warnings
+from nxc.database import BatchedWriter, SessionProxy, queued_write
 from nxc.logger import nxc_logger
 import sys
 
@@ -29,8 +30,9 @@ class database:
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
+        self.writer = BatchedWriter(self.db_engine)
         # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        self.conn = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -69,6 +71,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.conn.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -77,6 +80,7 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.conn.execute(table.delete())
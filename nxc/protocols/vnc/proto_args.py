@@ -2,6 +2,7 @@ def proto_args(parser, std_parser, module_parser):
     vnc_parser = parser.add_parser("vnc", help="own stuff using VNC", parents=[std_parser, module_parser])
     vnc_parser.add_argument("--port", type=int, default=5900, help="Custom VNC port")
     vnc_parser.add_argument("--vnc-sleep", type=int, default=5, help="VNC Sleep on socket connection to avoid rate limit")
+    vnc_parser.add_argument("--host-concurrency", type=int, default=1, metavar="CONNECTIONS", help="Maximum number of simultaneous connections to the same host, all the connections run on one shared event loop (default: %(default)s)")
 
     egroup = vnc_parser.add_argument_group("Screenshot", "VNC Server")
     egroup.add_argument("--screenshot", action="store_true", help="Screenshot VNC if connection success")
@@ -8,16 +8,17 @@ import xml.etree.ElementTree as ET
 from io import StringIO
 from datetime import datetime
 from pypsrp.wsman import NAMESPACES
-from pypsrp.client import Client
 
 from impacket.smbconnection import SMBConnection
 from impacket.examples.secretsdump import LocalOperations, LSASecrets, SAMHashes
 
 from nxc.config import process_secret
 from nxc.connection import connection
+from nxc.helpers import eventloop
 from nxc.helpers.bloodhound import add_user_bh
 from nxc.helpers.misc import gen_random_string
 from nxc.logger import NXCAdapter
+from nxc.protocols.winrm import transport
 
 
 urllib3.disable_warnings()
@@ -51,10 +52,15 @@ class winrm(connection):
             }
         )
 
+    def fingerprint_attrs(self):
+        return () if self.args.no_smb else ("hostname", "domain", "server_os")
+
     def enum_host_info(self):
         # smb no open, specify the domain
         if self.args.no_smb:
             self.domain = self.args.domain
+        elif self.load_fingerprint():
+            self.logger.extra["hostname"] = self.hostname
         else:
             try:
                 smb_conn = SMBConnection(self.host, self.host, None, timeout=5)
@@ -85,6 +91,9 @@ class winrm(connection):
                     smb_conn.logoff()
 
                 self.db.add_host(self.host, self.port, self.hostname, self.domain, self.server_os)
+                # without NTLM the hostname and domain are the target and --domain, not values of the host
+                if not no_ntlm:
+                    self.save_fingerprint()
 
         if self.args.domain:
             self.domain = self.args.domain
@@ -127,15 +136,26 @@ class winrm(connection):
             )
             endpoints[protocol]["ssl"] = (protocol != "http")
 
+        if self.args.async_probe:
+            urls = [endpoints[protocol]["url"] for protocol in endpoints]
+            self.logger.debug(f"Requesting URLs: {', '.join(urls)}")
+            url, status_code, auth_type, errors = eventloop.run(transport.probe_first(urls, self.args.http_timeout))
+            for error_url, e in errors:
+                self.logger.info(f"Error connecting to WinRM service {error_url}: {e!r}")
+            if url is None:
+                return False
+            self.logger.debug(f"Received response code: {status_code}")
+            protocol = next(protocol for protocol in endpoints if endpoints[protocol]["url"] == url)
+            self.use_endpoint(endpoints[protocol], auth_type)
+            return True
+
         for protocol in endpoints:
             self.port = endpoints[protocol]["port"]
             try:
                 self.logger.debug(f"Requesting URL: {endpoints[protocol]['url']}")
-                res = requests.post(endpoints[protocol]["url"], verify=False, timeout=self.args.http_timeout)
-                self.logger.debug(f"Received response code: {res.status_code}")
-                self.auth_type = res.headers["WWW-Authenticate"] if "WWW-Authenticate" in res.headers else "NOAUTH"
-                self.endpoint = endpoints[protocol]["url"]
-                self.ssl = endpoints[protocol]["ssl"]
+                status_code, auth_type = transport.probe(endpoints[protocol]["url"], self.args.http_timeout, self.args.threads)
+                self.logger.debug(f"Received response code: {status_code}")
+                self.use_endpoint(endpoints[protocol], auth_type)
                 return True
             except requests.exceptions.Timeout as e:
                 self.logger.info(f"Connection Timed out to WinRM service: {e}")
@@ -146,6 +166,17 @@ class winrm(connection):
                     self.logger.info(f"Other ConnectionError to WinRM service: {e}")
         return False
 
+    def use_endpoint(self, endpoint, auth_type):
+        self.port = endpoint["port"]
+        self.auth_type = auth_type
+        self.endpoint = endpoint["url"]
+        self.ssl = endpoint["ssl"]
+
+    def close_failed_conn(self):
+        # Closing the client keeps the TLS session for the next attempt
+        with contextlib.suppress(Exception):
+            self.conn.close()
+
     def check_if_admin(self):
         wsman = self.conn.wsman
         wsen = NAMESPACES["wsen"]
@@ -165,15 +196,7 @@ class winrm(connection):
         self.username = username
         self.domain = domain
         try:
-            self.conn = Client(
-                self.host,
-                port=self.port,
-                auth="ntlm",
-                username=f"{self.domain}\\{self.username}",
-                password=self.password,
-                ssl=self.ssl,
-                cert_validation=False,
-            )
+            self.conn = transport.client(self.host, self.port, self.ssl, f"{self.domain}\\{self.username}", self.password)
 
             self.check_if_admin()
             self.logger.success(f"{self.domain}\\{self.username}:{process_secret(self.password)} {self.mark_pwned()}")
@@ -191,6 +214,7 @@ class winrm(connection):
                 add_user_bh(self.username, self.domain, self.logger, self.config)
             return True
         except Exception as e:
+            self.close_failed_conn()
             if "with ntlm" in str(e):
                 self.logger.fail(f"{self.domain}\\{self.username}:{process_secret(self.password)}")
             else:
@@ -213,15 +237,7 @@ class winrm(connection):
         self.domain = domain
 
         try:
-            self.conn = Client(
-                self.host,
-                port=self.port,
-                auth="ntlm",
-                username=f"{self.domain}\\{self.username}",
-                password=f"{self.lmhash}:{self.nthash}",
-                ssl=self.ssl,
-                cert_validation=False,
-            )
+            self.conn = transport.client(self.host, self.port, self.ssl, f"{self.domain}\\{self.username}", f"{self.lmhash}:{self.nthash}")
 
             self.check_if_admin()
             self.logger.success(f"{self.domain}\\{self.username}:{process_secret(nthash)} {self.mark_pwned()}")
@@ -235,6 +251,7 @@ class winrm(connection):
             return True
 
         except Exception as e:
+            self.close_failed_conn()
             if "with ntlm" in str(e):
                 self.logger.fail(f"{self.domain}\\{self.username}:{process_secret(self.nthash)}")
             else:
@@ -7,11 +7,12 @@ from sqlalchemy.exc import (
     NoInspectionAvailable,
     NoSuchTableError,
 )
+from nxc.database import BatchedWriter, SessionProxy, background_write, queued_write, FingerprintCache, fingerprints_schema
 from nxc.logger import nxc_logger
 import sys
 
 
-class database:
+class database(FingerprintCache):
     def __init__(self, db_engine):
         self.HostsTable = None
         self.UsersTable = None
@@ -22,12 +23,14 @@ class database:
         self.db_path = self.db_engine.url.database
         self.protocol = Path(self.db_path).stem.upper()
         self.metadata = MetaData()
+        self.migrate_fingerprints()
         self.reflect_tables()
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
         Session = scoped_session(session_factory)
+        self.writer = BatchedWriter(self.db_engine)
         # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        self.conn = SessionProxy(Session(), self.writer)
 
     @staticmethod
     def db_schema(db_conn):
@@ -70,6 +73,7 @@ class database:
             FOREIGN KEY(hostid) REFERENCES hosts(id)
         )"""
         )
+        db_conn.execute(fingerprints_schema)
 
     def reflect_tables(self):
         with self.db_engine.connect():
@@ -78,6 +82,7 @@ class database:
                 self.UsersTable = Table("users", self.metadata, autoload_with=self.db_engine)
                 self.AdminRelationsTable = Table("admin_relations", self.metadata, autoload_with=self.db_engine)
                 self.LoggedinRelationsTable = Table("loggedin_relations", self.metadata, autoload_with=self.db_engine)
+                self.FingerprintsTable = Table("fingerprints", self.metadata, autoload_with=self.db_engine)
             except (NoInspectionAvailable, NoSuchTableError):
                 print(
                     f"""
@@ -89,6 +94,7 @@ class database:
                 sys.exit()
 
     def shutdown_db(self):
+        self.writer.shutdown()
         try:
             self.conn.close()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
@@ -97,10 +103,12 @@ class database:
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @queued_write
     def clear_database(self):
         for table in self.metadata.sorted_tables:
             self.conn.execute(table.delete())
 
+    @background_write
     def add_host(self, ip, port, hostname, domain, os=None):
         """
         Check if this host has already been added to the database, if not, add it in.
@@ -149,6 +157,7 @@ class database:
         q = q.on_conflict_do_update(index_elements=self.HostsTable.primary_key, set_=update_columns)
         self.conn.execute(q, hosts)
 
+    @queued_write
     def add_credential(self, credtype, domain, username, password, pillaged_from=None):
         """Check if this credential has already been added to the database, if not add it in."""
         domain = domain.split(".")[0].upper()
@@ -209,6 +218,7 @@ class database:
         q_users = q_users.on_conflict_do_update(index_elements=self.UsersTable.primary_key, set_=update_columns_users)
         self.conn.execute(q_users, credentials)  # .scalar()
 
+    @queued_write
     def remove_credentials(self, creds_id):
         """Removes a credential ID from the database"""
         del_hosts = []
@@ -217,6 +227,7 @@ class database:
             del_hosts.append(q)
         self.conn.execute(q)
 
+    @background_write
     def add_admin_user(self, credtype, domain, username, password, host, user_id=None):
         domain = domain.split(".")[0]
         add_links = []
@@ -262,6 +273,7 @@ class database:
 
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_admin_relation(self, user_ids=None, host_ids=None):
         q = delete(self.AdminRelationsTable)
         if user_ids:
@@ -361,6 +373,7 @@ class database:
         )
         return self.conn.execute(q).all()
 
+    @background_write
     def add_loggedin_relation(self, user_id, host_id):
         relation_query = select(self.LoggedinRelationsTable).filter(
             self.LoggedinRelationsTable.c.userid == user_id,
@@ -387,6 +400,7 @@ class database:
             q = q.filter(self.LoggedinRelationsTable.c.hostid == host_id)
         return self.conn.execute(q).all()
 
+    @queued_write
     def remove_loggedin_relations(self, user_id=None, host_id=None):
         q = delete(self.LoggedinRelationsTable)
         if user_id:
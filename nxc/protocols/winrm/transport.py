@@ -0,0 +1,173 @@
+import asyncio
+import ssl
+from collections import OrderedDict
+from http.client import parse_headers
+from io import BytesIO
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from pypsrp.client import Client
+from requests.adapters import HTTPAdapter
+from requests.utils import default_user_agent
+
+# TLS sessions kept for resumption, one per server name, the least recently used are dropped first
+MAX_SESSIONS = 4096
+# Idle connections kept per host by the probe session, a host is probed by one thread at a time
+POOL_MAXSIZE = 2
+
+session = None
+session_lock = Lock()
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+    def close(self):
+        # TLS 1.3 tickets arrive after the handshake, the session is only resumable once one was read
+        self.context.remember(self)
+        super().close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client context without certificate validation that resumes the last TLS session of the server name.
+
+    The session of every connection is remembered after its handshake and again when it is closed, the next
+    connection to the same server name offers it and skips the certificate exchange and the key agreement when
+    the server accepts it. Sessions only resume with the context that created them, so a single context is shared
+    by all the WinRM connections of the process.
+    """
+
+    sslsocket_class = ResumingSSLSocket
+
+    def __new__(cls):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self):
+        super().__init__()
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.sessions = OrderedDict()
+        self.sessions_lock = Lock()
+
+    def session_for(self, server_hostname):
+        with self.sessions_lock:
+            tls_session = self.sessions.get(server_hostname)
+            if tls_session is not None:
+                self.sessions.move_to_end(server_hostname)
+            return tls_session
+
+    def remember(self, ssl_object):
+        """Keeps the session of the SSLSocket or SSLObject if it can be resumed"""
+        try:
+            tls_session = ssl_object.session
+            tls13 = ssl_object.version() == "TLSv1.3"
+        except (OSError, ValueError):
+            return
+        if not ssl_object.server_hostname or tls_session is None:
+            return
+        if not (tls_session.has_ticket or (tls_session.id and not tls13)):
+            return
+        with self.sessions_lock:
+            self.sessions[ssl_object.server_hostname] = tls_session
+            self.sessions.move_to_end(ssl_object.server_hostname)
+            if len(self.sessions) > MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True, server_hostname=None, session=None):
+        if session is None and server_hostname:
+            session = self.session_for(server_hostname)
+        ssl_sock = super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs, server_hostname, session)
+        if do_handshake_on_connect:
+            self.remember(ssl_sock)
+        return ssl_sock
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and server_hostname:
+            session = self.session_for(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+ssl_context = ResumingSSLContext()
+
+
+class ProbeAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, ssl_context=ssl_context, **kwargs)
+
+
+def get_session(pool_connections):
+    """Returns the requests session shared by the endpoint probes of all the hosts.
+
+    It keeps a connection pool for each of the last `pool_connections` hosts and its HTTPS connections use the
+    shared TLS context. It never authenticates, the NTLM logins run on the connections of their own client.
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = ProbeAdapter(pool_connections=pool_connections, pool_maxsize=POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
+def probe(url, timeout, pool_connections):
+    """Returns the status code and the WWW-Authenticate header ("NOAUTH" without one) of an anonymous POST to url"""
+    res = get_session(pool_connections).post(url, verify=False, timeout=timeout)
+    return res.status_code, res.headers.get("WWW-Authenticate", "NOAUTH")
+
+
+async def probe_async(url):
+    parts = urlsplit(url)
+    https = parts.scheme == "https"
+    reader, writer = await asyncio.open_connection(
+        parts.hostname,
+        parts.port,
+        ssl=ssl_context if https else None,
+        server_hostname=parts.hostname if https else None,
+    )
+    try:
+        writer.write(f"POST {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: {default_user_agent()}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        if https:
+            ssl_context.remember(writer.get_extra_info("ssl_object"))
+    finally:
+        writer.close()
+    status_line, _, header_block = head.partition(b"\r\n")
+    headers = parse_headers(BytesIO(header_block))
+    return int(status_line.split()[1]), ", ".join(headers.get_all("WWW-Authenticate", [])) or "NOAUTH"
+
+
+async def probe_first(urls, timeout):
+    """Probes all the urls at once and returns the url, status code and WWW-Authenticate header of the first one in
+    order that answers, with the (url, error) of the urls before it. The probes still running are then cancelled.
+    """
+    tasks = [asyncio.ensure_future(asyncio.wait_for(probe_async(url), timeout)) for url in urls]
+    errors = []
+    try:
+        for url, task in zip(urls, tasks):
+            try:
+                status_code, auth_type = await task
+            except Exception as e:
+                errors.append((url, e))
+            else:
+                return url, status_code, auth_type, errors
+        return None, None, None, errors
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+
+def client(host, port, use_ssl, username, password):
+    """Returns a pypsrp NTLM client with a connection pool of its own, NTLM over HTTP authenticates the connection
+    and not the requests. Its HTTPS connections resume the TLS sessions of the shared context.
+    """
+    conn = Client(host, port=port, auth="ntlm", username=username, password=password, ssl=use_ssl, cert_validation=False)
+    if use_ssl:
+        # The requests session of the transport is otherwise only built on the first message
+        transport = conn.wsman.transport
+        transport.session = transport._build_session()
+        transport.session.get_adapter("https://").poolmanager.connection_pool_kw["ssl_context"] = ssl_context
+    return conn
@@ -0,0 +1,72 @@
+import pytest
+from impacket.ldap.ldap import LDAPFilterSyntaxError
+
+from nxc.protocols.ldap.filter import compile_filter, parse_filter
+
+DOMAIN_SID = b"\x01\x05\x00\x00\x00\x00\x00\x05\x15\x00\x00\x00\x01\x00\x00\x00\x02\x00\x00\x00\x03\x00\x00\x00"
+USER = {
+    "dn": "CN=John Doe,CN=Users,DC=corp,DC=local",
+    "objectclass": ["top", "person", "organizationalPerson", "user"],
+    "objectcategory": ["CN=Person,CN=Schema,CN=Configuration,DC=corp,DC=local"],
+    "samaccountname": ["jdoe"],
+    "useraccountcontrol": ["66082"],  # NORMAL_ACCOUNT | DONT_EXPIRE_PASSWORD | ACCOUNTDISABLE
+    "admincount": ["1"],
+    "description": ["Password: Summer2024!"],
+    "objectsid": [DOMAIN_SID + b"\xe9\x03\x00\x00"],
+}
+
+
+@pytest.mark.parametrize(
+    ("search_filter", "expected"),
+    [
+        ("(sAMAccountName=jdoe)", True),
+        ("(samaccountname=JDOE)", True),
+        ("sAMAccountName=jdoe", True),
+        ("(objectCategory=person)", True),
+        ("(objectCategory=computer)", False),
+        ("(&(objectClass=user)(adminCount=1))", True),
+        ("(&(objectClass=user)(!(adminCount=1)))", False),
+        ("(|(sAMAccountName=nobody)(description=*pass*))", True),
+        ("(description=Password:*2024!)", True),
+        ("(description=*winter*)", False),
+        ("(mail=*)", False),
+        ("(!(mail=*))", True),
+        ("(adminCount>=1)", True),
+        ("(adminCount<=0)", False),
+        ("(userAccountControl:1.2.840.113556.1.4.803:=2)", True),
+        ("(userAccountControl:1.2.840.113556.1.4.803:=66050)", True),
+        ("(userAccountControl:1.2.840.113556.1.4.803:=524288)", False),
+        ("(userAccountControl:1.2.840.113556.1.4.804:=524290)", True),
+        ("(userAccountControl:1.2.840.113556.1.4.804:=524288)", False),
+        ("(objectSid=S-1-5-21-1-2-3-1001)", True),
+        ("(objectSid=S-1-5-21-1-2-3-500)", False),
+        ("(sAMAccountName=\\6adoe)", True),
+        ("(memberOf:1.2.840.113556.1.4.1941:=CN=Admins,DC=corp,DC=local)", False),
+    ],
+)
+def test_compile_filter(search_filter, expected):
+    assert compile_filter(search_filter)(USER) is expected
+
+
+def test_parse_filter():
+    assert parse_filter("(&(cn=a*b*c)(!(x=*)))") == ("and", [("sub", "cn", "a", ["b"], "c"), ("not", ("present", "x"))])
+    assert parse_filter("(uac:dn:1.2.840.113556.1.4.803:=2)") == ("ext", "uac", "1.2.840.113556.1.4.803", "2", True)
+    assert parse_filter("(description=a>=b)") == ("eq", "description", "a>=b")
+    assert parse_filter("(description=x:=y)") == ("eq", "description", "x:=y")
+    assert parse_filter("(adminCount>=1)") == ("ge", "admincount", "1")
+    for invalid in ("(cn=a", "(&(cn=a)", "(cn=a))", "(cn)"):
+        with pytest.raises(LDAPFilterSyntaxError):
+            parse_filter(invalid)
+
+
+def test_compile_filter_operator_in_value():
+    assert compile_filter("(description=a>=b)")({"description": ["a>=b"]})
+    assert compile_filter("(description=x:=y)")({"description": ["x:=y"]})
+    assert not compile_filter("(description=a>=b)")({"description": ["b"]})
+
+
+def test_compile_filter_binary_attribute():
+    # \41\42 decodes to valid UTF-8, \ff\fe does not, both must match the raw bytes of the entry
+    assert compile_filter("(objectGUID=\\41\\42)")({"objectguid": [b"AB"]})
+    assert compile_filter("(objectGUID=\\ff\\fe)")({"objectguid": [b"\xff\xfe"]})
+    assert not compile_filter("(objectGUID=\\41\\43)")({"objectguid": [b"AB"]})
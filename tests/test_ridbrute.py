@@ -0,0 +1,103 @@
+import pytest
+from impacket.dcerpc.v5 import lsat
+from impacket.dcerpc.v5.rpcrt import DCERPCException
+from impacket.dcerpc.v5.samr import SID_NAME_USE
+
+from nxc.protocols.smb import ridbrute
+from nxc.protocols.smb.ridbrute import MIN_BATCH, RIDBrute
+
+DOMAIN_SID = "S-1-5-21-1-2-3"
+
+
+class FakeLsa:
+    """Stands in for hLsarLookupSids, maps the RIDs in `users` and records the size of every lookup it answers"""
+
+    def __init__(self, users=(), max_sids=None, elapsed=0.0):
+        self.users = set(users)
+        self.max_sids = max_sids
+        self.elapsed = elapsed
+        self.clock = 0.0
+        self.sizes = []
+
+    def monotonic(self):
+        return self.clock
+
+    def lookup_sids(self, dce, policy_handle, sids, lookup_level):
+        if self.max_sids and len(sids) > self.max_sids:
+            raise DCERPCException("STATUS_TOO_MANY_SIDS")
+        self.sizes.append(len(sids))
+        self.clock += self.elapsed
+        rids = [int(sid.rsplit("-", 1)[1]) for sid in sids]
+        if not self.users.intersection(rids):
+            raise DCERPCException("STATUS_NONE_MAPPED")
+        return {
+            "ReferencedDomains": {"Domains": [{"Name": "TEST"}]},
+            "TranslatedNames": {
+                "Names": [
+                    {"DomainIndex": 0, "Name": f"user{rid}", "Use": SID_NAME_USE.SidTypeUser if rid in self.users else SID_NAME_USE.SidTypeUnknown}
+                    for rid in rids
+                ]
+            },
+        }
+
+
+@pytest.fixture()
+def fake_lsa(monkeypatch):
+    def make(**kwargs):
+        fake = FakeLsa(**kwargs)
+        monkeypatch.setattr(lsat, "hLsarLookupSids", fake.lookup_sids)
+        monkeypatch.setattr(ridbrute.time, "monotonic", fake.monotonic)
+        return fake
+
+    return make
+
+
+def test_claim():
+    rid_brute = RIDBrute([], DOMAIN_SID, 250)
+    assert rid_brute.claim(100) == (0, 100)
+    assert rid_brute.claim(100) == (100, 200)
+    assert rid_brute.claim(100) == (200, 250)
+    assert rid_brute.claim(100) is None
+
+
+def test_lookup_entries(fake_lsa):
+    fake_lsa(users=[500, 512, 1103])
+    entries = RIDBrute([(None, None)], DOMAIN_SID, 2000).run()
+    assert [entry["rid"] for entry in entries] == [500, 512, 1103]
+    assert entries[0] == {"rid": 500, "domain": "TEST", "username": "user500", "sidtype": "SidTypeUser"}
+
+
+def test_batch_grows_on_fast_lookups(fake_lsa):
+    fake = fake_lsa(elapsed=0.1)
+    RIDBrute([(None, None)], DOMAIN_SID, 1000, batch_size=100, target_time=1.0).run()
+    assert fake.sizes == [100, 200, 400, 300]
+
+
+def test_batch_shrinks_on_slow_lookups(fake_lsa):
+    fake = fake_lsa(elapsed=2.0)
+    RIDBrute([(None, None)], DOMAIN_SID, 1000, batch_size=400, target_time=1.0).run()
+    assert fake.sizes[:4] == [400, 200, 100, MIN_BATCH]
+    assert set(fake.sizes[4:]) == {MIN_BATCH}
+
+
+def test_split_on_rejected_lookup(fake_lsa):
+    fake = fake_lsa(users=[10, 350], max_sids=100)
+    rid_brute = RIDBrute([(None, None)], DOMAIN_SID, 400, batch_size=400)
+    entries, split = rid_brute.lookup(None, None, 0, 400)
+    assert split
+    assert fake.sizes == [100, 100, 100, 100]
+    assert [entry["rid"] for entry in entries] == [10, 350]
+
+
+def test_split_stops_at_min_batch(fake_lsa):
+    fake_lsa(max_sids=MIN_BATCH - 1)
+    with pytest.raises(DCERPCException):
+        RIDBrute([(None, None)], DOMAIN_SID, 400, batch_size=400).run()
+
+
+def test_empty_run_stops_search(fake_lsa):
+    fake = fake_lsa(users=[5])
+    entries = RIDBrute([(None, None)], DOMAIN_SID, 100000, empty_run=500, batch_size=100).run()
+    assert [entry["rid"] for entry in entries] == [5]
+    # 0-100, 100-300 and 300-700, the next claim starts more than 500 RIDs after the last user
+    assert fake.sizes == [100, 200, 400]
@@ -1,6 +1,6 @@
 import os
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from nxc.nxcdb import delete_workspace, NXCDBMenu
@@ -123,20 +123,81 @@ def test_update_host(db, sess):
     assert host.dc is False
 
 
-def test_add_credential():
-    pass
+def test_add_credential(db):
+    db.add_credential("plaintext", "TEST.DEV", "user", "password")
+    db.add_credential("plaintext", "test.dev", "USER", "new_password")
+    credentials = db.get_credentials()
+    assert len(credentials) == 1
+    assert credentials[0].password == "new_password"
 
 
-def test_update_credential():
-    pass
+def test_queued_writes_flush(db, sess, monkeypatch):
+    monkeypatch.setattr(db.writer, "flush_interval", 60)
+    db.add_credential("hash", "TEST.DEV", "user", "31d6cfe0d16ae931b73c59d7e0c089c0")
+    db.writer.flush()
+    assert len(sess.execute(select(db.UsersTable)).all()) == 1
+
+
+def test_failed_write_rolls_back_alone(db, sess, monkeypatch):
+    monkeypatch.setattr(db.writer, "flush_interval", 60)
+
+    def add_host_and_fail():
+        db.add_host("127.0.0.2", "localhost2", "TEST.DEV", "Windows Testing 2.0", False, True)
+        raise ValueError("write failed")
+
+    db.add_host("127.0.0.1", "localhost", "TEST.DEV", "Windows Testing 2.0", False, True)
+    failed = db.writer.submit(add_host_and_fail)
+    db.writer.flush()
+    with pytest.raises(ValueError):
+        failed.result()
+    assert [host.ip for host in sess.execute(select(db.HostsTable)).all()] == ["127.0.0.1"]
+    assert "127.0.0.2" not in db.host_index
+
+
+def test_failed_commit_fails_batch(db, sess, monkeypatch):
+    monkeypatch.setattr(db.writer, "flush_interval", 60)
+
+    def fail_commit():
+        raise OSError("disk I/O error")
+
+    # only the writer thread touches its connection, so the commit can be swapped from here while it waits
+    monkeypatch.setattr(db.writer.conn, "commit", fail_commit)
+    written = db.writer.submit(db.add_host.__wrapped__, db, "127.0.0.1", "localhost", "TEST.DEV", "Windows Testing 2.0", False, True)
+    db.writer.flush()
+    monkeypatch.undo()
+    with pytest.raises(OSError):
+        written.result()
+    assert sess.execute(select(db.HostsTable)).all() == []
+    assert "127.0.0.1" not in db.host_index
+
+
+def test_fingerprint_cache(db):
+    db.add_fingerprint("127.0.0.1", 445, "smb", {"hostname": "localhost", "os_arch": 64})
+    db.add_fingerprint("127.0.0.1", 445, "smb", {"hostname": "localhost2", "os_arch": 64})
+    assert db.get_fingerprint("127.0.0.1", 445, "smb", 60) == {"hostname": "localhost2", "os_arch": 64}
+    assert db.get_fingerprint("127.0.0.1", 139, "smb", 60) is None
+    assert db.get_fingerprint("127.0.0.1", 445, "smb", -1) is None
+
+
+def test_update_credential(db, sess):
+    # a row written outside of this database object, so it is not in the warmed index
+    sess.execute(Insert(db.UsersTable), [{"credtype": "plaintext", "domain": "TEST.DEV", "username": "user", "password": "password"}])
+    db.add_credential("plaintext", "test.dev", "USER", "new_password")
+    credentials = db.get_credentials()
+    assert len(credentials) == 1
+    assert credentials[0].password == "new_password"
 
 
 def test_remove_credential():
     pass
 
 
-def test_add_admin_user():
-    pass
+def test_add_admin_user(db):
+    db.add_host("127.0.0.1", "localhost", "TEST.DEV", "Windows Testing 2023", False, True)
+    db.add_credential("plaintext", "TEST.DEV", "user", "password")
+    db.add_admin_user("plaintext", "TEST.DEV", "user", "password", "127.0.0.1")
+    db.add_admin_user("plaintext", "test.dev", "USER", "password", "127.0.0.1")
+    assert len(db.get_admin_relations()) == 1
 
 
 def test_get_admin_relations():